@@ -0,0 +1,36 @@
+from bisect import bisect_right
+from typing import Dict, Iterable, List
+
+
+class AchievementIndex:
+    """Achievement targets compiled into sorted per-stat lists.
+
+    The achievements a stat change unlocks are the ones with a target in
+    (old, new], found with two bisects instead of a scan over every entry.
+    """
+
+    def __init__(self, achievements: Iterable[Dict]) -> None:
+        by_stat: Dict[str, List] = {}
+        for a in achievements:
+            stat = a.get('stat')
+            target = int(a.get('target', 0) or 0)
+            if not stat or target <= 0:
+                continue
+            by_stat.setdefault(stat, []).append((target, str(a.get('id')), a))
+
+        self._targets: Dict[str, List[int]] = {}
+        self._defs: Dict[str, List[Dict]] = {}
+        for stat, items in by_stat.items():
+            items.sort(key=lambda item: (item[0], item[1]))
+            self._targets[stat] = [target for target, _, _ in items]
+            self._defs[stat] = [a for _, _, a in items]
+
+    def crossed(self, stat: str, old: int, new: int) -> List[Dict]:
+        """Achievements of stat whose target lies in (old, new]."""
+        targets = self._targets.get(stat)
+        if not targets or new <= old:
+            return []
+        return self._defs[stat][bisect_right(targets, old):bisect_right(targets, new)]
+
+    def all(self) -> List[Dict]:
+        return [a for defs in self._defs.values() for a in defs]
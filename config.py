@@ -121,6 +121,10 @@ SATURDAY_FARM_POOL = [
 
 REFERRAL_REWARD = 100
 
+# Недельный топ: награды за 1-е, 2-е, ... место и сколько мест хранится в архиве
+SEASON_REWARDS = [5000, 3000, 2000, 1000, 1000, 500, 500, 500, 500, 500]
+SEASON_ARCHIVE_TOP = 50
+
 CRYSTAL_SHOP = {
     "stars_500": {
         "name": "⭐ 500 звезд",
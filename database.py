@@ -1,379 +1,1067 @@
 import aiosqlite
 import asyncio
+import hashlib
+import json
+import logging
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 import random
+import time
+from collections import OrderedDict
 from typing import List, Dict, Optional, Tuple
 
+from achievements import AchievementIndex
+from ranking import RankIndex
+
+logger = logging.getLogger(__name__)
+
 DB_NAME = "game_bot.db"
 
-async def init_db():
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                stars INTEGER DEFAULT 200,
-                crystals INTEGER DEFAULT 0,
-                xp INTEGER DEFAULT 0,
-                level INTEGER DEFAULT 1,
-                last_collect TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS case_drops (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                case_type TEXT,
-                reward_text TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS global_quests (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                quest_type TEXT,
-                title TEXT,
-                goal_value INTEGER,
-                progress_value INTEGER DEFAULT 0,
-                start_time TIMESTAMP,
-                end_time TIMESTAMP,
-                status TEXT DEFAULT 'active',
-                reward_buff_multiplier REAL DEFAULT 1.0,
-                reward_buff_seconds INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS global_buffs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                buff_type TEXT,
-                multiplier REAL DEFAULT 1.0,
-                start_time TIMESTAMP,
-                end_time TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS contests (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                title TEXT,
-                description TEXT,
-                reward TEXT,
-                how_to TEXT,
-                created_by INTEGER,
-                status TEXT DEFAULT 'active',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS user_farm_auctions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                seller_id INTEGER,
-                farm_type TEXT,
-                starting_price INTEGER,
-                current_bid INTEGER,
-                current_bidder_id INTEGER,
-                end_time TIMESTAMP,
-                status TEXT DEFAULT 'active',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (seller_id) REFERENCES users (user_id),
-                FOREIGN KEY (current_bidder_id) REFERENCES users (user_id)
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS user_nft_auctions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                seller_id INTEGER,
-                nft_type TEXT,
-                starting_price INTEGER,
-                current_bid INTEGER,
-                current_bidder_id INTEGER,
-                end_time TIMESTAMP,
-                status TEXT DEFAULT 'active',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (seller_id) REFERENCES users (user_id),
-                FOREIGN KEY (current_bidder_id) REFERENCES users (user_id)
-            )
-        """)
-        
+# Сколько соединений держим открытыми между запросами
+DB_POOL_SIZE = 4
+
+# PRAGMA-профиль, применяется к каждому соединению.
+# journal_mode=WAL: читатели не блокируют писателя и наоборот.
+DB_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -16000,      # отрицательное значение — в КиБ (≈16 МБ)
+    "mmap_size": 134217728,    # 128 МБ
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,      # мс
+}
+
+# Раз в сколько секунд сбрасывать WAL в основной файл
+WAL_CHECKPOINT_INTERVAL = 300
+
+# Сколько часов действует активация фермы
+FARM_ACTIVE_HOURS = 6
+
+# Сколько пользователей пересчитывать за одну транзакцию в топе по доходу
+INCOME_REFRESH_BATCH = 1000
+
+# Группировка мелких записей (add_stars, add_crystals, ...) в одну транзакцию.
+# Выключено по умолчанию: запись ждёт до WRITE_COALESCE_DELAY_MS мс,
+# зато пачка из многих операций платит за один commit.
+WRITE_COALESCE_ENABLED = False
+WRITE_COALESCE_DELAY_MS = 5
+WRITE_COALESCE_MAX_OPS = 200
+
+# Вклад в глобальное задание копится в памяти и записывается раз в столько мс;
+# неудачная смена задания повторяется через GLOBAL_QUEST_RETRY_SECONDS
+GLOBAL_QUEST_FLUSH_MS = 500
+GLOBAL_QUEST_RETRY_SECONDS = 60
+
+# Прирост user_stats копится в памяти и пишется пачкой раз в столько мс
+STAT_FLUSH_MS = 1000
+
+# Кэш строк users в памяти процесса (LRU + TTL).
+# Любая функция, меняющая users, обязана вызвать _invalidate_user().
+USER_CACHE_ENABLED = True
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 60  # секунд
+
+# Имена из Telegram (username, full_name), которые бот видит во входящих апдейтах
+IDENTITY_CACHE_SIZE = 20000
+# Префиксы игроков (user_settings.prefix); "" кэшируется тоже — у большинства префикса нет
+PREFIX_CACHE_SIZE = 5000
+
+_pool: List[aiosqlite.Connection] = []
+_pool_open = False
+_background_tasks: List[asyncio.Task] = []
+
+# сезон, для которого снимки балансов уже гарантированно есть
+_snapshot_season_key: Optional[str] = None
+# архив сезонов меняется только при rollover — ответы кэшируем до него
+_season_archive_cache: Dict[Tuple[int, int], List[Dict]] = {}
+
+# Рейтинги в памяти: по балансу и по приросту за сезон.
+# _invalidate_user() помечает игрока, строка перечитывается при следующем чтении рейтинга.
+_balance_ranks = RankIndex()
+_season_ranks = RankIndex()
+_ranks_season_key: Optional[str] = None
+_rank_dirty: set = set()
+_ranks_lock = asyncio.Lock()
+
+_write_queue: List[Tuple[List[Tuple[str, tuple]], asyncio.Future]] = []
+_write_timer: Optional[asyncio.TimerHandle] = None
+_write_lock = asyncio.Lock()
+_flush_tasks: set = set()
+_write_stats = {"batches": 0, "ops": 0, "max_batch": 0, "flush_ms_total": 0.0, "flush_ms_max": 0.0}
+
+
+async def _open_connection() -> aiosqlite.Connection:
+    db = await aiosqlite.connect(DB_NAME)
+    db.row_factory = aiosqlite.Row
+    for name, value in DB_PRAGMAS.items():
+        await db.execute(f"PRAGMA {name} = {value}")
+    return db
+
+
+async def _release_connection(db: aiosqlite.Connection) -> None:
+    try:
+        if db.in_transaction:
+            await db.rollback()
+    except Exception:
+        # соединение в непонятном состоянии — в пул его не возвращаем
         try:
-            await db.execute("ALTER TABLE users ADD COLUMN internal_id INTEGER")
-            await db.commit()
-        except:
+            await db.close()
+        except Exception:
             pass
+        return
 
-        try:
-            await db.execute("ALTER TABLE users ADD COLUMN crystals INTEGER DEFAULT 0")
+    db.row_factory = aiosqlite.Row
+    if _pool_open and len(_pool) < DB_POOL_SIZE:
+        _pool.append(db)
+    else:
+        await db.close()
+
+
+@asynccontextmanager
+async def get_db():
+    """Borrows a connection from the pool.
+
+    If the pool is empty (or not initialized yet) a temporary connection
+    is opened. On return an unfinished transaction is rolled back.
+    """
+    db = _pool.pop() if _pool else await _open_connection()
+    try:
+        yield db
+    finally:
+        await _release_connection(db)
+
+
+async def _write(statements: List[Tuple[str, tuple]], user_ids: Tuple = ()) -> None:
+    """Runs statements as one unit; with coalescing on, shares a commit with other writers.
+
+    user_ids lists the users rows touched, so their cache entries are dropped after commit.
+    """
+    global _write_timer
+    if not WRITE_COALESCE_ENABLED:
+        async with get_db() as db:
+            for sql, params in statements:
+                await db.execute(sql, params)
             await db.commit()
-        except:
-            pass
+        _invalidate_user(*user_ids)
+        return
 
-        try:
-            await db.execute("ALTER TABLE users ADD COLUMN xp INTEGER DEFAULT 0")
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    _write_queue.append((statements, fut))
+    if len(_write_queue) >= WRITE_COALESCE_MAX_OPS:
+        _start_write_flush()
+    elif _write_timer is None:
+        _write_timer = loop.call_later(WRITE_COALESCE_DELAY_MS / 1000, _start_write_flush)
+    try:
+        await fut
+    finally:
+        _invalidate_user(*user_ids)
+
+
+def _start_write_flush() -> None:
+    global _write_timer
+    if _write_timer is not None:
+        _write_timer.cancel()
+        _write_timer = None
+    task = asyncio.get_running_loop().create_task(_flush_writes())
+    _flush_tasks.add(task)
+    task.add_done_callback(_flush_tasks.discard)
+
+
+async def _run_statements(statements: List[Tuple[str, tuple]]) -> Optional[Exception]:
+    try:
+        async with get_db() as db:
+            for sql, params in statements:
+                await db.execute(sql, params)
             await db.commit()
-        except:
-            pass
+    except Exception as e:
+        return e
+    return None
+
 
+async def _flush_writes() -> None:
+    async with _write_lock:
+        batch = _write_queue[:]
+        _write_queue.clear()
+        if not batch:
+            return
+
+        started = time.perf_counter()
+        errors: List[Optional[Exception]] = [None] * len(batch)
         try:
-            await db.execute("ALTER TABLE users ADD COLUMN level INTEGER DEFAULT 1")
-            await db.commit()
-        except:
-            pass
-        
+            async with get_db() as db:
+                await db.execute("BEGIN")
+                for statements, _ in batch:
+                    for sql, params in statements:
+                        await db.execute(sql, params)
+                await db.commit()
+        except Exception:
+            # одна битая операция не должна ронять всю пачку — повторяем по одной
+            errors = [await _run_statements(statements) for statements, _ in batch]
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        _write_stats["batches"] += 1
+        _write_stats["ops"] += len(batch)
+        _write_stats["max_batch"] = max(_write_stats["max_batch"], len(batch))
+        _write_stats["flush_ms_total"] += elapsed_ms
+        _write_stats["flush_ms_max"] = max(_write_stats["flush_ms_max"], elapsed_ms)
+
+        for (_, fut), err in zip(batch, errors):
+            if fut.done():
+                continue
+            if err is None:
+                fut.set_result(None)
+            else:
+                fut.set_exception(err)
+
+
+async def flush_pending_writes() -> None:
+    """Writes out everything queued by the coalescer and waits for in-flight flushes."""
+    if _write_queue:
+        _start_write_flush()
+    while _flush_tasks:
+        await asyncio.gather(*list(_flush_tasks), return_exceptions=True)
+
+
+def get_write_stats() -> Dict:
+    stats = dict(_write_stats)
+    batches = stats["batches"]
+    stats["avg_batch"] = stats["ops"] / batches if batches else 0.0
+    stats["flush_ms_avg"] = stats["flush_ms_total"] / batches if batches else 0.0
+    stats["pending"] = len(_write_queue)
+    return stats
+
+
+async def _wal_checkpoint_loop() -> None:
+    while True:
+        await asyncio.sleep(WAL_CHECKPOINT_INTERVAL)
         try:
-            await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_internal_id ON users(internal_id)")
-        except:
+            async with get_db() as db:
+                await db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        except Exception as e:
+            logger.warning(f"WAL checkpoint failed: {e}")
+
+
+def start_db_tasks() -> None:
+    """Starts periodic maintenance tasks. Call after init_db()."""
+    if str(DB_PRAGMAS.get("journal_mode", "")).upper() == "WAL":
+        _background_tasks.append(asyncio.create_task(_wal_checkpoint_loop()))
+    _background_tasks.append(asyncio.create_task(_season_rollover_loop()))
+
+
+async def close_db() -> None:
+    global _pool_open
+    try:
+        await flush_global_quest_progress()
+    except Exception as e:
+        logger.error(f"Global quest flush failed: {e}")
+    if _stat_flush_timer is not None:
+        _stat_flush_timer.cancel()
+    _start_stat_flush()
+    await flush_pending_writes()
+    if _write_stats["batches"]:
+        stats = get_write_stats()
+        logger.info(
+            "Write coalescer: %d ops in %d batches (avg %.1f, max %d), flush avg %.2f ms, max %.2f ms",
+            stats["ops"], stats["batches"], stats["avg_batch"], stats["max_batch"],
+            stats["flush_ms_avg"], stats["flush_ms_max"],
+        )
+
+    for task in _background_tasks:
+        task.cancel()
+    for task in _background_tasks:
+        try:
+            await task
+        except asyncio.CancelledError:
             pass
-        
-        cursor = await db.execute("SELECT COUNT(*) FROM users WHERE internal_id IS NULL")
-        null_count = (await cursor.fetchone())[0]
-        if null_count > 0:
-            cursor = await db.execute("SELECT user_id FROM users WHERE internal_id IS NULL ORDER BY created_at")
-            users = await cursor.fetchall()
-            for idx, (user_id,) in enumerate(users, start=1):
-                cursor = await db.execute("SELECT MAX(internal_id) FROM users WHERE internal_id IS NOT NULL")
-                result = await cursor.fetchone()
-                max_id = result[0] if result[0] is not None else 0
-                new_id = max_id + idx
-                await db.execute("UPDATE users SET internal_id = ? WHERE user_id = ?", (new_id, user_id))
-            await db.commit()
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS farms (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                farm_type TEXT,
-                purchased_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_activated TIMESTAMP,
-                is_active BOOLEAN DEFAULT 0,
-                speed_level INTEGER DEFAULT 1,
-                cap_level INTEGER DEFAULT 1,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        """)
+    _background_tasks.clear()
+    await _stop_global_timers()
 
+    if str(DB_PRAGMAS.get("journal_mode", "")).upper() == "WAL":
         try:
-            await db.execute("ALTER TABLE farms ADD COLUMN speed_level INTEGER DEFAULT 1")
-            await db.commit()
-        except:
+            async with get_db() as db:
+                await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except Exception as e:
+            logger.warning(f"WAL checkpoint failed: {e}")
+
+    _pool_open = False
+    while _pool:
+        db = _pool.pop()
+        try:
+            await db.close()
+        except Exception:
             pass
 
+
+async def _table_columns(db: aiosqlite.Connection, table: str) -> set:
+    cursor = await db.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in await cursor.fetchall()}
+
+
+async def _add_column_if_missing(db: aiosqlite.Connection, table: str, column: str, decl: str) -> None:
+    if column not in await _table_columns(db, table):
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+async def _migration_1_base_schema(db: aiosqlite.Connection) -> None:
+    """Base schema: tables of the bot before versioned migrations.
+
+    Idempotent — old databases already have most of it.
+    """
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            stars INTEGER DEFAULT 200,
+            crystals INTEGER DEFAULT 0,
+            xp INTEGER DEFAULT 0,
+            level INTEGER DEFAULT 1,
+            last_collect TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS case_drops (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            case_type TEXT,
+            reward_text TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS global_quests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            quest_type TEXT,
+            title TEXT,
+            goal_value INTEGER,
+            progress_value INTEGER DEFAULT 0,
+            start_time TIMESTAMP,
+            end_time TIMESTAMP,
+            status TEXT DEFAULT 'active',
+            reward_buff_multiplier REAL DEFAULT 1.0,
+            reward_buff_seconds INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS global_buffs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            buff_type TEXT,
+            multiplier REAL DEFAULT 1.0,
+            start_time TIMESTAMP,
+            end_time TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS contests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT,
+            description TEXT,
+            reward TEXT,
+            how_to TEXT,
+            created_by INTEGER,
+            status TEXT DEFAULT 'active',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS user_farm_auctions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            seller_id INTEGER,
+            farm_type TEXT,
+            starting_price INTEGER,
+            current_bid INTEGER,
+            current_bidder_id INTEGER,
+            end_time TIMESTAMP,
+            status TEXT DEFAULT 'active',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (seller_id) REFERENCES users (user_id),
+            FOREIGN KEY (current_bidder_id) REFERENCES users (user_id)
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS user_nft_auctions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            seller_id INTEGER,
+            nft_type TEXT,
+            starting_price INTEGER,
+            current_bid INTEGER,
+            current_bidder_id INTEGER,
+            end_time TIMESTAMP,
+            status TEXT DEFAULT 'active',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (seller_id) REFERENCES users (user_id),
+            FOREIGN KEY (current_bidder_id) REFERENCES users (user_id)
+        )
+    """)
+
+    await _add_column_if_missing(db, "users", "internal_id", "INTEGER")
+    await _add_column_if_missing(db, "users", "crystals", "INTEGER DEFAULT 0")
+    await _add_column_if_missing(db, "users", "xp", "INTEGER DEFAULT 0")
+    await _add_column_if_missing(db, "users", "level", "INTEGER DEFAULT 1")
+    await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_internal_id ON users(internal_id)")
+
+    cursor = await db.execute("SELECT user_id FROM users WHERE internal_id IS NULL ORDER BY created_at")
+    users = await cursor.fetchall()
+    if users:
+        cursor = await db.execute("SELECT MAX(internal_id) FROM users WHERE internal_id IS NOT NULL")
+        result = await cursor.fetchone()
+        max_id = result[0] if result[0] is not None else 0
+        await db.executemany(
+            "UPDATE users SET internal_id = ? WHERE user_id = ?",
+            [(max_id + idx, row[0]) for idx, row in enumerate(users, start=1)]
+        )
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS farms (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            farm_type TEXT,
+            purchased_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_activated TIMESTAMP,
+            is_active BOOLEAN DEFAULT 0,
+            speed_level INTEGER DEFAULT 1,
+            cap_level INTEGER DEFAULT 1,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    """)
+
+    await _add_column_if_missing(db, "farms", "speed_level", "INTEGER DEFAULT 1")
+    await _add_column_if_missing(db, "farms", "cap_level", "INTEGER DEFAULT 1")
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS farm_trades (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            seller_id INTEGER,
+            buyer_id INTEGER,
+            farm_id INTEGER,
+            price INTEGER,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (seller_id) REFERENCES users (user_id),
+            FOREIGN KEY (buyer_id) REFERENCES users (user_id),
+            FOREIGN KEY (farm_id) REFERENCES farms (id)
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS nfts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            nft_type TEXT,
+            purchased_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER PRIMARY KEY,
+            stars_collected INTEGER DEFAULT 0,
+            farms_bought INTEGER DEFAULT 0,
+            cases_opened INTEGER DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS user_achievements (
+            user_id INTEGER,
+            achievement_id TEXT,
+            claimed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, achievement_id),
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS season_snapshots (
+            user_id INTEGER,
+            season_key TEXT,
+            start_stars INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, season_key),
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS season_archive (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            season_key TEXT,
+            rank INTEGER,
+            user_id INTEGER,
+            internal_id INTEGER,
+            season_score INTEGER,
+            reward_stars INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS user_items (
+            user_id INTEGER,
+            item_key TEXT,
+            qty INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, item_key),
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS user_settings (
+            user_id INTEGER PRIMARY KEY,
+            prefix TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS item_auctions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            seller_id INTEGER,
+            item_key TEXT,
+            qty INTEGER,
+            starting_price INTEGER,
+            current_bid INTEGER,
+            current_bidder_id INTEGER,
+            end_time TIMESTAMP,
+            status TEXT DEFAULT 'active',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (seller_id) REFERENCES users (user_id),
+            FOREIGN KEY (current_bidder_id) REFERENCES users (user_id)
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS referrals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            referrer_id INTEGER,
+            referred_id INTEGER,
+            reward_given BOOLEAN DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (referrer_id) REFERENCES users (user_id),
+            FOREIGN KEY (referred_id) REFERENCES users (user_id),
+            UNIQUE(referred_id)
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS auctions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            farm_type TEXT,
+            starting_price INTEGER,
+            current_bid INTEGER,
+            current_bidder_id INTEGER,
+            end_time TIMESTAMP,
+            status TEXT DEFAULT 'active',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (current_bidder_id) REFERENCES users (user_id)
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS bans (
+            user_id INTEGER PRIMARY KEY,
+            reason TEXT,
+            banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            banned_by INTEGER
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_id INTEGER PRIMARY KEY,
+            chat_type TEXT,
+            title TEXT,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS saturday_offers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            offer_date TEXT,
+            farm_key TEXT,
+            name TEXT,
+            income_per_hour INTEGER,
+            price_stars INTEGER DEFAULT 0,
+            price_crystals INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'active',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # Farm upgrades table for income boosts
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS farm_upgrades (
+            farm_id INTEGER PRIMARY KEY,
+            income_boost REAL DEFAULT 1.0,
+            upgrade_level INTEGER DEFAULT 0,
+            last_upgraded TIMESTAMP,
+            FOREIGN KEY (farm_id) REFERENCES farms (id)
+        )
+    """)
+
+    # NFT Listings table for the NFT marketplace
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS nft_listings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            seller_id INTEGER NOT NULL,
+            nft_type TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            fee_pct REAL NOT NULL,
+            status TEXT DEFAULT 'active',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sold_at TIMESTAMP NULL,
+            buyer_id INTEGER NULL,
+            FOREIGN KEY (seller_id) REFERENCES users (user_id),
+            FOREIGN KEY (buyer_id) REFERENCES users (user_id)
+        )
+    """)
+
+
+async def _migration_2_hot_path_indexes(db: aiosqlite.Connection) -> None:
+    """Secondary indexes for per-user lookups and active-lot listings."""
+    indexes = [
+        "CREATE INDEX IF NOT EXISTS idx_farms_user_type ON farms(user_id, farm_type)",
+        "CREATE INDEX IF NOT EXISTS idx_nfts_user_type ON nfts(user_id, nft_type)",
+        "CREATE INDEX IF NOT EXISTS idx_nfts_type ON nfts(nft_type)",
+        "CREATE INDEX IF NOT EXISTS idx_case_drops_user ON case_drops(user_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_id)",
+        "CREATE INDEX IF NOT EXISTS idx_nft_listings_active ON nft_listings(status, price, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_auctions_active ON auctions(status, end_time)",
+        "CREATE INDEX IF NOT EXISTS idx_user_farm_auctions_active ON user_farm_auctions(status, end_time)",
+        "CREATE INDEX IF NOT EXISTS idx_user_nft_auctions_active ON user_nft_auctions(status, end_time)",
+        "CREATE INDEX IF NOT EXISTS idx_item_auctions_active ON item_auctions(status, end_time)",
+        "CREATE INDEX IF NOT EXISTS idx_season_snapshots_season ON season_snapshots(season_key)",
+        "CREATE INDEX IF NOT EXISTS idx_users_stars ON users(stars)",
+    ]
+    for sql in indexes:
+        await db.execute(sql)
+
+
+async def _migration_3_farm_holdings(db: aiosqlite.Connection) -> None:
+    """Per-user farm aggregates by type, kept in sync with farms by triggers."""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS farm_holdings (
+            user_id INTEGER NOT NULL,
+            farm_type TEXT NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            active INTEGER NOT NULL DEFAULT 0,
+            speed_level_sum INTEGER NOT NULL DEFAULT 0,
+            cap_level_sum INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, farm_type)
+        ) WITHOUT ROWID
+    """)
+    # для погашения просроченных активаций одним UPDATE
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_farms_user_active ON farms(user_id, is_active, last_activated)"
+    )
+
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_farms_holdings_insert AFTER INSERT ON farms
+        BEGIN
+            INSERT INTO farm_holdings (user_id, farm_type, total, active, speed_level_sum, cap_level_sum)
+            SELECT NEW.user_id, NEW.farm_type, 1, COALESCE(NEW.is_active, 0) != 0,
+                   COALESCE(NEW.speed_level, 1), COALESCE(NEW.cap_level, 1)
+            WHERE NEW.user_id IS NOT NULL AND NEW.farm_type IS NOT NULL
+            ON CONFLICT (user_id, farm_type) DO UPDATE SET
+                total = total + 1,
+                active = active + excluded.active,
+                speed_level_sum = speed_level_sum + excluded.speed_level_sum,
+                cap_level_sum = cap_level_sum + excluded.cap_level_sum;
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_farms_holdings_delete AFTER DELETE ON farms
+        BEGIN
+            UPDATE farm_holdings SET
+                total = total - 1,
+                active = active - (COALESCE(OLD.is_active, 0) != 0),
+                speed_level_sum = speed_level_sum - COALESCE(OLD.speed_level, 1),
+                cap_level_sum = cap_level_sum - COALESCE(OLD.cap_level, 1)
+            WHERE user_id = OLD.user_id AND farm_type = OLD.farm_type;
+            DELETE FROM farm_holdings
+            WHERE user_id = OLD.user_id AND farm_type = OLD.farm_type AND total <= 0;
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_farms_holdings_update
+        AFTER UPDATE OF user_id, farm_type, is_active, speed_level, cap_level ON farms
+        BEGIN
+            UPDATE farm_holdings SET
+                total = total - 1,
+                active = active - (COALESCE(OLD.is_active, 0) != 0),
+                speed_level_sum = speed_level_sum - COALESCE(OLD.speed_level, 1),
+                cap_level_sum = cap_level_sum - COALESCE(OLD.cap_level, 1)
+            WHERE user_id = OLD.user_id AND farm_type = OLD.farm_type;
+            INSERT INTO farm_holdings (user_id, farm_type, total, active, speed_level_sum, cap_level_sum)
+            SELECT NEW.user_id, NEW.farm_type, 1, COALESCE(NEW.is_active, 0) != 0,
+                   COALESCE(NEW.speed_level, 1), COALESCE(NEW.cap_level, 1)
+            WHERE NEW.user_id IS NOT NULL AND NEW.farm_type IS NOT NULL
+            ON CONFLICT (user_id, farm_type) DO UPDATE SET
+                total = total + 1,
+                active = active + excluded.active,
+                speed_level_sum = speed_level_sum + excluded.speed_level_sum,
+                cap_level_sum = cap_level_sum + excluded.cap_level_sum;
+            DELETE FROM farm_holdings
+            WHERE user_id = OLD.user_id AND farm_type = OLD.farm_type AND total <= 0;
+        END
+    """)
+
+    await db.execute("DELETE FROM farm_holdings")
+    await db.execute("""
+        INSERT INTO farm_holdings (user_id, farm_type, total, active, speed_level_sum, cap_level_sum)
+        SELECT user_id, farm_type, COUNT(*),
+               SUM(COALESCE(is_active, 0) != 0),
+               SUM(COALESCE(speed_level, 1)),
+               SUM(COALESCE(cap_level, 1))
+        FROM farms
+        WHERE user_id IS NOT NULL AND farm_type IS NOT NULL
+        GROUP BY user_id, farm_type
+    """)
+
+
+async def _migration_4_farm_rates(db: aiosqlite.Connection) -> None:
+    """Lookup of income/hour and cap hours per farm type and level; filled by _fill_farm_rates."""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS farm_rates (
+            farm_type TEXT NOT NULL,
+            level INTEGER NOT NULL,
+            income_per_hour INTEGER NOT NULL,
+            cap_hours REAL NOT NULL,
+            PRIMARY KEY (farm_type, level)
+        ) WITHOUT ROWID
+    """)
+
+
+async def _migration_5_income_rate(db: aiosqlite.Connection) -> None:
+    """Stored income/minute per user for the income leaderboard, marked dirty by triggers."""
+    await _add_column_if_missing(db, "users", "income_base", "INTEGER DEFAULT 0")
+    await _add_column_if_missing(db, "users", "income_boost", "REAL DEFAULT 1.0")
+    await _add_column_if_missing(db, "users", "income_rate", "REAL DEFAULT 0")
+    await _add_column_if_missing(db, "users", "income_dirty", "INTEGER DEFAULT 1")
+    await _add_column_if_missing(db, "users", "income_until", "TEXT")
+
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_income_rate ON users(income_rate DESC, user_id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_income_dirty ON users(income_dirty) WHERE income_dirty = 1")
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_income_until ON users(income_until) WHERE income_until IS NOT NULL"
+    )
+
+    # множитель глобального баффа, под который посчитаны income_rate
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS income_rate_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            buff_multiplier REAL NOT NULL DEFAULT 1.0
+        )
+    """)
+    await db.execute("INSERT OR IGNORE INTO income_rate_state (id, buff_multiplier) VALUES (1, 1.0)")
+
+    mark = "UPDATE users SET income_dirty = 1 WHERE user_id = {} AND income_dirty != 1;"
+    triggers = {
+        "trg_farms_income_insert": ("AFTER INSERT ON farms", mark.format("NEW.user_id")),
+        "trg_farms_income_delete": ("AFTER DELETE ON farms", mark.format("OLD.user_id")),
+        "trg_farms_income_update": (
+            "AFTER UPDATE OF user_id, farm_type, is_active, last_activated ON farms",
+            mark.format("OLD.user_id") + mark.format("NEW.user_id"),
+        ),
+        "trg_nfts_income_insert": ("AFTER INSERT ON nfts", mark.format("NEW.user_id")),
+        "trg_nfts_income_delete": ("AFTER DELETE ON nfts", mark.format("OLD.user_id")),
+        "trg_nfts_income_update": (
+            "AFTER UPDATE OF user_id, nft_type ON nfts",
+            mark.format("OLD.user_id") + mark.format("NEW.user_id"),
+        ),
+        "trg_users_income_level": (
+            "AFTER UPDATE OF level ON users WHEN OLD.level IS NOT NEW.level",
+            mark.format("NEW.user_id"),
+        ),
+    }
+    for name, (event, body) in triggers.items():
+        await db.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END")
+
+
+async def _migration_6_seasons(db: aiosqlite.Connection) -> None:
+    """Per-season bookkeeping and a covering index for the season leaderboard."""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS seasons (
+            season_key TEXT PRIMARY KEY,
+            snapshot_at TIMESTAMP,
+            archived_at TIMESTAMP
+        )
+    """)
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_season_snapshots_season_start
+        ON season_snapshots(season_key, user_id, start_stars)
+    """)
+    await db.execute("DROP INDEX IF EXISTS idx_season_snapshots_season")
+    # сезоны, для которых снимки уже были сделаны старым кодом
+    await db.execute("""
+        INSERT OR IGNORE INTO seasons (season_key, snapshot_at)
+        SELECT season_key, MIN(created_at) FROM season_snapshots GROUP BY season_key
+    """)
+
+
+async def _migration_7_season_archive_index(db: aiosqlite.Connection) -> None:
+    """Index for reading the archive season by season in rank order."""
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_season_archive_season_rank
+        ON season_archive(season_key, rank)
+    """)
+
+
+async def _migration_8_user_identities(db: aiosqlite.Connection) -> None:
+    """Telegram names seen in updates, so rendering and @username lookups stay local."""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS user_identities (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT COLLATE NOCASE,
+            full_name TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_user_identities_username
+        ON user_identities(username) WHERE username IS NOT NULL
+    """)
+
+
+async def _migration_9_nft_supply(db: aiosqlite.Connection) -> None:
+    """Per-type mint counter, so limited-edition checks are one row read."""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS nft_supply (
+            nft_type TEXT PRIMARY KEY,
+            minted INTEGER NOT NULL DEFAULT 0,
+            max_supply INTEGER
+        ) WITHOUT ROWID
+    """)
+    # выпущенные = у игроков + выставленные на аукцион/маркет (они временно удалены из nfts)
+    await db.execute("""
+        INSERT OR REPLACE INTO nft_supply (nft_type, minted)
+        SELECT nft_type, COUNT(*) FROM (
+            SELECT nft_type FROM nfts
+            UNION ALL
+            SELECT nft_type FROM user_nft_auctions WHERE status = 'active'
+            UNION ALL
+            SELECT nft_type FROM nft_listings WHERE status = 'active'
+        )
+        GROUP BY nft_type
+    """)
+
+
+async def _migration_10_nft_holdings(db: aiosqlite.Connection) -> None:
+    """Per-type NFT quantities and a per-user total, kept in sync with nfts by triggers."""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS nft_holdings (
+            user_id INTEGER NOT NULL,
+            nft_type TEXT NOT NULL,
+            qty INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, nft_type)
+        ) WITHOUT ROWID
+    """)
+    await _add_column_if_missing(db, "users", "nft_count", "INTEGER DEFAULT 0")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_nft_count ON users(nft_count DESC, user_id)")
+
+    add = """
+        INSERT INTO nft_holdings (user_id, nft_type, qty)
+        SELECT NEW.user_id, NEW.nft_type, 1
+        WHERE NEW.user_id IS NOT NULL AND NEW.nft_type IS NOT NULL
+        ON CONFLICT (user_id, nft_type) DO UPDATE SET qty = qty + 1;
+        UPDATE users SET nft_count = COALESCE(nft_count, 0) + 1
+        WHERE user_id = NEW.user_id AND NEW.nft_type IS NOT NULL;
+    """
+    remove = """
+        UPDATE nft_holdings SET qty = qty - 1 WHERE user_id = OLD.user_id AND nft_type = OLD.nft_type;
+        DELETE FROM nft_holdings WHERE user_id = OLD.user_id AND nft_type = OLD.nft_type AND qty <= 0;
+        UPDATE users SET nft_count = COALESCE(nft_count, 0) - 1
+        WHERE user_id = OLD.user_id AND OLD.nft_type IS NOT NULL;
+    """
+    triggers = {
+        "trg_nfts_holdings_insert": ("AFTER INSERT ON nfts", add),
+        "trg_nfts_holdings_delete": ("AFTER DELETE ON nfts", remove),
+        "trg_nfts_holdings_update": ("AFTER UPDATE OF user_id, nft_type ON nfts", remove + add),
+    }
+    for name, (event, body) in triggers.items():
+        await db.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END")
+
+    await db.execute("DELETE FROM nft_holdings")
+    await db.execute("""
+        INSERT INTO nft_holdings (user_id, nft_type, qty)
+        SELECT user_id, nft_type, COUNT(*) FROM nfts
+        WHERE user_id IS NOT NULL AND nft_type IS NOT NULL
+        GROUP BY user_id, nft_type
+    """)
+    await db.execute("""
+        UPDATE users SET nft_count = COALESCE(
+            (SELECT SUM(qty) FROM nft_holdings h WHERE h.user_id = users.user_id), 0
+        )
+    """)
+    # буст теперь считается по количествам — пересчитать сохранённые income_rate
+    await db.execute("UPDATE users SET income_dirty = 1")
+
+
+async def _migration_11_quest_contributions(db: aiosqlite.Connection) -> None:
+    """Per-user contribution to each global quest."""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS quest_contributions (
+            quest_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (quest_id, user_id)
+        ) WITHOUT ROWID
+    """)
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_quest_contributions_top "
+        "ON quest_contributions(quest_id, amount DESC, user_id)"
+    )
+
+
+async def _migration_12_config_sync(db: aiosqlite.Connection) -> None:
+    """Hashes of config-derived tables, so startup rebuilds them only after a config change."""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS config_sync (
+            name TEXT PRIMARY KEY,
+            hash TEXT NOT NULL
+        ) WITHOUT ROWID
+    """)
+    rows = await _farm_rate_rows()
+    await _fill_farm_rates(db, rows, _config_hash(rows))
+    rows = _nft_supply_rows()
+    await _fill_nft_supply(db, rows, _config_hash(rows))
+
+
+async def _migration_13_achievement_backfill(db: aiosqlite.Connection) -> None:
+    """One-time grant of achievements reached before unlocks were wired up."""
+    rows = _achievement_rows()
+    await _grant_reached_achievements(db, rows, _config_hash(rows))
+
+
+async def _migration_14_season_close(db: aiosqlite.Connection) -> None:
+    """Balances frozen at the season boundary, so a late rollover pays the right scores.
+
+    The first stars change of a user after the season's ends_at stores the
+    balance before it (OLD.stars) in season_snapshots.end_stars; users with
+    no change since then still hold their end balance in users.stars.
+    """
+    await _add_column_if_missing(db, "season_snapshots", "end_stars", "INTEGER")
+    await _add_column_if_missing(db, "seasons", "ends_at", "TEXT")
+    cursor = await db.execute("SELECT season_key FROM seasons WHERE ends_at IS NULL")
+    await db.executemany(
+        "UPDATE seasons SET ends_at = ? WHERE season_key = ?",
+        [(_season_ends_at(row[0]), row[0]) for row in await cursor.fetchall()]
+    )
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_season_close
+        AFTER UPDATE OF stars ON users WHEN OLD.stars IS NOT NEW.stars
+        BEGIN
+            UPDATE season_snapshots SET end_stars = OLD.stars
+            WHERE user_id = OLD.user_id AND end_stars IS NULL
+              AND season_key IN (
+                  SELECT season_key FROM seasons
+                  WHERE archived_at IS NULL AND ends_at <= datetime('now', 'localtime')
+              );
+        END
+    """)
+    # сезоны, закончившиеся до появления триггера: баланс на границе уже не восстановить
+    cursor = await db.execute(
+        "SELECT season_key FROM seasons WHERE archived_at IS NULL AND ends_at <= datetime('now', 'localtime')"
+    )
+    missed = [row[0] for row in await cursor.fetchall()]
+    if missed:
+        marks = ",".join("?" * len(missed))
+        await db.execute(f"UPDATE seasons SET archived_at = CURRENT_TIMESTAMP WHERE season_key IN ({marks})", missed)
+        await db.execute(f"DELETE FROM season_snapshots WHERE season_key IN ({marks})", missed)
+        logger.warning("Seasons %s ended before end balances were tracked, archived without rewards", missed)
+
+
+# Миграции схемы: (версия, шаг). Новые шаги — только в конец списка.
+_MIGRATIONS = [
+    (1, _migration_1_base_schema),
+    (2, _migration_2_hot_path_indexes),
+    (3, _migration_3_farm_holdings),
+    (4, _migration_4_farm_rates),
+    (5, _migration_5_income_rate),
+    (6, _migration_6_seasons),
+    (7, _migration_7_season_archive_index),
+    (8, _migration_8_user_identities),
+    (9, _migration_9_nft_supply),
+    (10, _migration_10_nft_holdings),
+    (11, _migration_11_quest_contributions),
+    (12, _migration_12_config_sync),
+    (13, _migration_13_achievement_backfill),
+    (14, _migration_14_season_close),
+]
+
+
+async def _get_schema_version(db: aiosqlite.Connection) -> int:
+    try:
+        cursor = await db.execute("SELECT MAX(version) FROM schema_version")
+    except aiosqlite.OperationalError:
+        return 0
+    row = await cursor.fetchone()
+    return int(row[0] or 0)
+
+
+async def _run_migrations(db: aiosqlite.Connection) -> None:
+    current = await _get_schema_version(db)
+    pending = [(v, step) for v, step in _MIGRATIONS if v > current]
+    if not pending:
+        return
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await db.commit()
+
+    for version, step in pending:
+        await db.execute("BEGIN IMMEDIATE")
         try:
-            await db.execute("ALTER TABLE farms ADD COLUMN cap_level INTEGER DEFAULT 1")
+            await step(db)
+            await db.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
             await db.commit()
-        except:
-            pass
+        except Exception:
+            await db.rollback()
+            raise
+        logger.info(f"Schema migrated to version {version} ({step.__name__})")
 
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS farm_trades (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                seller_id INTEGER,
-                buyer_id INTEGER,
-                farm_id INTEGER,
-                price INTEGER,
-                status TEXT DEFAULT 'pending',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (seller_id) REFERENCES users (user_id),
-                FOREIGN KEY (buyer_id) REFERENCES users (user_id),
-                FOREIGN KEY (farm_id) REFERENCES farms (id)
-            )
-        """)
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS nfts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                nft_type TEXT,
-                purchased_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS user_stats (
-                user_id INTEGER PRIMARY KEY,
-                stars_collected INTEGER DEFAULT 0,
-                farms_bought INTEGER DEFAULT 0,
-                cases_opened INTEGER DEFAULT 0,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS user_achievements (
-                user_id INTEGER,
-                achievement_id TEXT,
-                claimed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (user_id, achievement_id),
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS season_snapshots (
-                user_id INTEGER,
-                season_key TEXT,
-                start_stars INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (user_id, season_key),
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS season_archive (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                season_key TEXT,
-                rank INTEGER,
-                user_id INTEGER,
-                internal_id INTEGER,
-                season_score INTEGER,
-                reward_stars INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS user_items (
-                user_id INTEGER,
-                item_key TEXT,
-                qty INTEGER DEFAULT 0,
-                PRIMARY KEY (user_id, item_key),
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        """)
 
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS user_settings (
-                user_id INTEGER PRIMARY KEY,
-                prefix TEXT,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS item_auctions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                seller_id INTEGER,
-                item_key TEXT,
-                qty INTEGER,
-                starting_price INTEGER,
-                current_bid INTEGER,
-                current_bidder_id INTEGER,
-                end_time TIMESTAMP,
-                status TEXT DEFAULT 'active',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (seller_id) REFERENCES users (user_id),
-                FOREIGN KEY (current_bidder_id) REFERENCES users (user_id)
-            )
-        """)
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS referrals (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                referrer_id INTEGER,
-                referred_id INTEGER,
-                reward_given BOOLEAN DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (referrer_id) REFERENCES users (user_id),
-                FOREIGN KEY (referred_id) REFERENCES users (user_id),
-                UNIQUE(referred_id)
-            )
-        """)
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS auctions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                farm_type TEXT,
-                starting_price INTEGER,
-                current_bid INTEGER,
-                current_bidder_id INTEGER,
-                end_time TIMESTAMP,
-                status TEXT DEFAULT 'active',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (current_bidder_id) REFERENCES users (user_id)
-            )
-        """)
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS bans (
-                user_id INTEGER PRIMARY KEY,
-                reason TEXT,
-                banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                banned_by INTEGER
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS chats (
-                chat_id INTEGER PRIMARY KEY,
-                chat_type TEXT,
-                title TEXT,
-                added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS saturday_offers (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                offer_date TEXT,
-                farm_key TEXT,
-                name TEXT,
-                income_per_hour INTEGER,
-                price_stars INTEGER DEFAULT 0,
-                price_crystals INTEGER DEFAULT 0,
-                status TEXT DEFAULT 'active',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Farm upgrades table for income boosts
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS farm_upgrades (
-                farm_id INTEGER PRIMARY KEY,
-                income_boost REAL DEFAULT 1.0,
-                upgrade_level INTEGER DEFAULT 0,
-                last_upgraded TIMESTAMP,
-                FOREIGN KEY (farm_id) REFERENCES farms (id)
-            )
-        """)
-        
-        # NFT Listings table for the NFT marketplace
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS nft_listings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                seller_id INTEGER NOT NULL,
-                nft_type TEXT NOT NULL,
-                price INTEGER NOT NULL,
-                fee_pct REAL NOT NULL,
-                status TEXT DEFAULT 'active',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                sold_at TIMESTAMP NULL,
-                buyer_id INTEGER NULL,
-                FOREIGN KEY (seller_id) REFERENCES users (user_id),
-                FOREIGN KEY (buyer_id) REFERENCES users (user_id)
-            )
-        """)
+async def init_db(pragmas: Optional[Dict] = None):
+    global _pool_open
+    if pragmas:
+        DB_PRAGMAS.update(pragmas)
+    async with get_db() as db:
+        await _run_migrations(db)
+        await _sync_farm_rates(db)
+        await _sync_nft_supply(db)
+        await _sync_achievements(db)
 
-        await db.commit()
+    _pool_open = True
+    while len(_pool) < DB_POOL_SIZE:
+        _pool.append(await _open_connection())
+    await _sync_ranks()
+    await _load_active_buffs()
+    await _rotate_global_quest()
 
 
 async def add_case_drop(user_id: int, case_type: str, reward_text: str) -> None:
     case_type = (case_type or "").strip()[:32]
     reward_text = (reward_text or "").strip()[:256]
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            "INSERT INTO case_drops (user_id, case_type, reward_text) VALUES (?, ?, ?)",
-            (user_id, case_type, reward_text)
-        )
-        await db.commit()
+    await _write([(
+        "INSERT INTO case_drops (user_id, case_type, reward_text) VALUES (?, ?, ?)",
+        (user_id, case_type, reward_text)
+    )])
 
 
 async def get_case_drops(user_id: int, limit: int = 20) -> List[Dict]:
@@ -382,7 +1070,7 @@ async def get_case_drops(user_id: int, limit: int = 20) -> List[Dict]:
         limit = 20
     if limit > 50:
         limit = 50
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             "SELECT case_type, reward_text, created_at FROM case_drops WHERE user_id = ? ORDER BY id DESC LIMIT ?",
@@ -392,41 +1080,179 @@ async def get_case_drops(user_id: int, limit: int = 20) -> List[Dict]:
         return [dict(r) for r in rows]
 
 
+# Глобальные баффы и глобальное задание живут в памяти: загружаются в init_db,
+# а окончание баффа, истечение и смена задания обрабатываются таймерами.
+# Чтения (расчёт буста, /quests) в SQLite не ходят.
+_active_buffs: Optional[List[Dict]] = None  # действующие баффы, новые первыми
+_active_buffs_timer: Optional[asyncio.TimerHandle] = None
+_active_buffs_generation = 0
+
+_global_quest: Optional[Dict] = None
+_global_quest_timer: Optional[asyncio.TimerHandle] = None
+_global_quest_lock = asyncio.Lock()
+_global_quest_tasks: set = set()
+# вклад в глобальное задание копится здесь и уходит в строку одним UPDATE раз в GLOBAL_QUEST_FLUSH_MS
+# ключ — id задания, к которому относится вклад: сброс после смены задания пишет его туда же
+_quest_pending: Dict[int, int] = {}
+_quest_contrib_pending: Dict[Tuple[int, int], int] = {}
+_quest_flush_timer: Optional[asyncio.TimerHandle] = None
+
+
+def _seconds_until(iso_time: Optional[str], now: datetime) -> Optional[float]:
+    try:
+        return max((datetime.fromisoformat(iso_time) - now).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _set_active_buffs(buffs: List[Dict]) -> None:
+    """Keeps only running buffs and arms a timer on the earliest end."""
+    global _active_buffs, _active_buffs_timer
+    now = datetime.now()
+    running = []
+    for buff in buffs:
+        left = _seconds_until(buff.get('end_time'), now)
+        if left:
+            running.append((left, buff))
+    running.sort(key=lambda item: int(item[1]['id']), reverse=True)
+
+    if _active_buffs_timer is not None:
+        _active_buffs_timer.cancel()
+        _active_buffs_timer = None
+    _active_buffs = [buff for _, buff in running]
+    if running:
+        delay = min(left for left, _ in running)
+        _active_buffs_timer = asyncio.get_running_loop().call_later(delay, _expire_active_buffs)
+
+
+def _expire_active_buffs() -> None:
+    if _active_buffs is not None:
+        _set_active_buffs(_active_buffs)
+
+
+async def _load_active_buffs() -> None:
+    while True:
+        generation = _active_buffs_generation
+        async with get_db() as db:
+            db.row_factory = aiosqlite.Row
+            cursor = await db.execute(
+                "SELECT * FROM global_buffs WHERE end_time > ? ORDER BY id DESC",
+                (datetime.now().isoformat(),)
+            )
+            rows = await cursor.fetchall()
+        # новый бафф, запущенный во время запроса, мог в выборку не попасть
+        if generation == _active_buffs_generation:
+            _set_active_buffs([dict(r) for r in rows])
+            return
+
+
 async def get_active_global_buff() -> Optional[Dict]:
-    now = datetime.now().isoformat()
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            "SELECT * FROM global_buffs WHERE end_time > ? ORDER BY id DESC LIMIT 1",
-            (now,)
-        )
-        row = await cursor.fetchone()
-        return dict(row) if row else None
+    if _active_buffs is None:
+        await _load_active_buffs()
+    return _active_buffs[0] if _active_buffs else None
 
 
 async def activate_global_buff(multiplier: float, seconds: int, buff_type: str = 'income') -> None:
+    async with get_db() as db:
+        buff = await _insert_global_buff(db, multiplier, seconds, buff_type)
+        await db.commit()
+    _publish_global_buff(buff)
+
+
+async def _insert_global_buff(db: aiosqlite.Connection, multiplier: float, seconds: int,
+                              buff_type: str) -> Optional[Dict]:
+    """Inserts the buff row on db without committing; None if seconds <= 0."""
     multiplier = float(multiplier or 1.0)
     seconds = int(seconds or 0)
     if seconds <= 0:
-        return
+        return None
     start = datetime.now()
     end = start + timedelta(seconds=seconds)
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            "INSERT INTO global_buffs (buff_type, multiplier, start_time, end_time) VALUES (?, ?, ?, ?)",
-            (buff_type, multiplier, start.isoformat(), end.isoformat())
+    cursor = await db.execute(
+        "INSERT INTO global_buffs (buff_type, multiplier, start_time, end_time) VALUES (?, ?, ?, ?)",
+        (buff_type, multiplier, start.isoformat(), end.isoformat())
+    )
+    return {
+        'id': cursor.lastrowid,
+        'buff_type': buff_type,
+        'multiplier': multiplier,
+        'start_time': start.isoformat(),
+        'end_time': end.isoformat(),
+    }
+
+
+def _publish_global_buff(buff: Optional[Dict]) -> None:
+    """Call after the commit that inserted buff."""
+    global _active_buffs_generation
+    if buff is None:
+        return
+    _active_buffs_generation += 1
+    if _active_buffs is not None:
+        _set_active_buffs([buff] + _active_buffs)
+
+
+def _set_global_quest(quest: Dict) -> None:
+    """Publishes the active quest and arms the expiry timer on its end_time."""
+    global _global_quest, _global_quest_timer
+    if _global_quest_timer is not None:
+        _global_quest_timer.cancel()
+        _global_quest_timer = None
+    _global_quest = quest
+    delay = _seconds_until(quest.get('end_time'), datetime.now())
+    if delay is not None:
+        _global_quest_timer = asyncio.get_running_loop().call_later(delay, _on_global_quest_timer)
+
+
+async def _stop_global_timers() -> None:
+    global _active_buffs, _global_quest, _active_buffs_timer, _global_quest_timer, _quest_flush_timer
+    for timer in (_active_buffs_timer, _global_quest_timer, _quest_flush_timer):
+        if timer is not None:
+            timer.cancel()
+    _active_buffs_timer = _global_quest_timer = _quest_flush_timer = None
+    for task in list(_global_quest_tasks):
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    _global_quest_tasks.clear()
+    _active_buffs = None
+    _global_quest = None
+
+
+def _on_global_quest_timer() -> None:
+    task = asyncio.create_task(_rotate_global_quest_safe())
+    _global_quest_tasks.add(task)
+    task.add_done_callback(_global_quest_tasks.discard)
+
+
+async def _rotate_global_quest_safe() -> None:
+    global _global_quest_timer
+    try:
+        async with _global_quest_lock:
+            # вклад, набранный до истечения, засчитывается уходящему заданию
+            await _flush_global_quest_locked()
+            await _rotate_global_quest_locked()
+    except Exception as e:
+        logger.error(f"Global quest rotation failed: {e}")
+        _global_quest_timer = asyncio.get_running_loop().call_later(
+            GLOBAL_QUEST_RETRY_SECONDS, _on_global_quest_timer
         )
-        await db.commit()
 
 
-async def get_or_create_global_quest() -> Dict:
-    """Creates a default global quest if none is active.
+async def _rotate_global_quest() -> Dict:
+    async with _global_quest_lock:
+        return await _rotate_global_quest_locked()
+
+
+async def _rotate_global_quest_locked() -> Dict:
+    """Fails an expired quest, starts a new one if none is active and loads it into memory.
 
     Default quest: collect stars server-wide within 24h.
     Reward: income multiplier buff for 3h.
     """
     now = datetime.now()
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         await db.execute("BEGIN IMMEDIATE")
 
@@ -435,18 +1261,16 @@ async def get_or_create_global_quest() -> Dict:
         )
         row = await cursor.fetchone()
         if row:
-            q = dict(row)
-            end_time = q.get('end_time')
+            end_time = row['end_time']
             if end_time:
                 try:
-                    end_dt = datetime.fromisoformat(end_time)
-                    if end_dt <= now:
+                    if datetime.fromisoformat(end_time) <= now:
                         await db.execute(
                             "UPDATE global_quests SET status = 'failed' WHERE id = ?",
-                            (int(q['id']),)
+                            (int(row['id']),)
                         )
                         row = None
-                except Exception:
+                except ValueError:
                     pass
 
         if not row:
@@ -473,65 +1297,175 @@ async def get_or_create_global_quest() -> Dict:
             row = await cursor.fetchone()
 
         await db.commit()
-        return dict(row)
+    _set_global_quest(dict(row))
+    return dict(row)
+
+
+async def get_or_create_global_quest() -> Dict:
+    """Returns the active global quest from memory, with not yet flushed progress included."""
+    if _global_quest is None:
+        await _rotate_global_quest()
+    q = dict(_global_quest)
+    q['progress_value'] = int(q.get('progress_value', 0) or 0) + _quest_pending.get(int(q['id']), 0)
+    return q
 
 
-async def add_global_quest_progress(amount: int) -> Dict:
+async def add_global_quest_progress(amount: int, user_id: Optional[int] = None) -> Dict:
+    """Adds to the in-memory accumulator; the row is updated by the next flush."""
+    global _quest_flush_timer
     amount = int(amount or 0)
-    if amount <= 0:
-        return await get_or_create_global_quest()
+    if amount > 0:
+        if _global_quest is None or _global_quest.get('status') != 'active':
+            # завершённое задание, которое ещё не сменилось, вклад не принимает
+            await _rotate_global_quest()
+        quest_id = int(_global_quest['id'])
+        _quest_pending[quest_id] = _quest_pending.get(quest_id, 0) + amount
+        if user_id is not None:
+            key = (quest_id, int(user_id))
+            _quest_contrib_pending[key] = _quest_contrib_pending.get(key, 0) + amount
+        if _quest_flush_timer is None:
+            _quest_flush_timer = asyncio.get_running_loop().call_later(
+                GLOBAL_QUEST_FLUSH_MS / 1000, _start_quest_flush
+            )
+    return await get_or_create_global_quest()
 
-    now = datetime.now()
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        await db.execute("BEGIN IMMEDIATE")
 
-        cursor = await db.execute(
-            "SELECT * FROM global_quests WHERE status = 'active' ORDER BY id DESC LIMIT 1"
-        )
-        row = await cursor.fetchone()
-        if not row:
-            await db.commit()
-            return await get_or_create_global_quest()
-
-        q = dict(row)
-        end_time = q.get('end_time')
-        if end_time:
-            try:
-                if datetime.fromisoformat(end_time) <= now:
-                    await db.execute(
-                        "UPDATE global_quests SET status = 'failed' WHERE id = ?",
-                        (int(q['id']),)
-                    )
-                    await db.commit()
-                    return await get_or_create_global_quest()
-            except Exception:
-                pass
+def _start_quest_flush() -> None:
+    global _quest_flush_timer
+    _quest_flush_timer = None
+    task = asyncio.get_running_loop().create_task(_flush_global_quest_safe())
+    _global_quest_tasks.add(task)
+    task.add_done_callback(_global_quest_tasks.discard)
 
-        new_progress = int(q.get('progress_value', 0) or 0) + amount
-        goal = int(q.get('goal_value', 0) or 0)
 
-        if goal > 0 and new_progress >= goal:
-            await db.execute(
-                "UPDATE global_quests SET progress_value = ?, status = 'completed' WHERE id = ?",
-                (new_progress, int(q['id']))
+async def _flush_global_quest_safe() -> None:
+    global _quest_flush_timer
+    try:
+        await flush_global_quest_progress()
+    except Exception as e:
+        logger.error(f"Global quest flush failed: {e}")
+        if _quest_pending and _quest_flush_timer is None:
+            _quest_flush_timer = asyncio.get_running_loop().call_later(
+                GLOBAL_QUEST_RETRY_SECONDS, _start_quest_flush
             )
-            mult = float(q.get('reward_buff_multiplier', 1.0) or 1.0)
-            secs = int(q.get('reward_buff_seconds', 0) or 0)
+
+
+async def flush_global_quest_progress() -> None:
+    """Writes the accumulated contribution to the active quest row."""
+    async with _global_quest_lock:
+        await _flush_global_quest_locked()
+
+
+async def _flush_global_quest_locked() -> None:
+    global _quest_pending, _quest_contrib_pending
+    if not _quest_pending:
+        return
+    pending, contributions = _quest_pending, _quest_contrib_pending
+    _quest_pending, _quest_contrib_pending = {}, {}
+    active_id = int(_global_quest['id']) if _global_quest is not None else None
+    progress = None
+    completed = False
+    buff = None
+    try:
+        async with get_db() as db:
+            await db.execute("BEGIN IMMEDIATE")
+            for quest_id, amount in pending.items():
+                cursor = await db.execute(
+                    "UPDATE global_quests SET progress_value = progress_value + ? WHERE id = ?",
+                    (amount, quest_id)
+                )
+                if cursor.rowcount != 1:
+                    logger.warning("Global quest %s not found, dropping %d progress", quest_id, amount)
+            if contributions:
+                await db.executemany(
+                    """INSERT INTO quest_contributions (quest_id, user_id, amount) VALUES (?, ?, ?)
+                       ON CONFLICT (quest_id, user_id) DO UPDATE SET amount = amount + excluded.amount""",
+                    [(quest_id, uid, value) for (quest_id, uid), value in contributions.items()]
+                )
+            if active_id in pending:
+                # цель пересечена этим сбросом; условие по status даёт ровно одно срабатывание,
+                # а награда пишется в той же транзакции, что и смена статуса
+                cursor = await db.execute(
+                    """UPDATE global_quests SET status = 'completed'
+                       WHERE id = ? AND status = 'active' AND goal_value > 0 AND progress_value >= goal_value
+                         AND (end_time IS NULL OR end_time > ?)""",
+                    (active_id, datetime.now().isoformat())
+                )
+                completed = cursor.rowcount == 1
+                if completed:
+                    buff = await _insert_global_buff(
+                        db,
+                        _global_quest.get('reward_buff_multiplier', 1.0),
+                        _global_quest.get('reward_buff_seconds', 0),
+                        'income',
+                    )
+                cursor = await db.execute(
+                    "SELECT progress_value FROM global_quests WHERE id = ?", (active_id,)
+                )
+                row = await cursor.fetchone()
+                progress = int(row[0] or 0) if row else None
             await db.commit()
-            await activate_global_buff(mult, secs, buff_type='income')
-            # start a new quest next time user opens /quests or contributes
-            q['progress_value'] = new_progress
-            q['status'] = 'completed'
-            return q
+    except Exception:
+        for quest_id, amount in pending.items():
+            _quest_pending[quest_id] = _quest_pending.get(quest_id, 0) + amount
+        for key, value in contributions.items():
+            _quest_contrib_pending[key] = _quest_contrib_pending.get(key, 0) + value
+        raise
+
+    if progress is not None:
+        _global_quest['progress_value'] = progress
+    if completed:
+        _global_quest['status'] = 'completed'
+        _publish_global_buff(buff)
+        await _replace_completed_quest_locked()
+
+
+async def _replace_completed_quest_locked() -> None:
+    """Starts the next quest; on failure the quest timer retries it."""
+    global _global_quest_timer
+    try:
+        await _rotate_global_quest_locked()
+    except Exception as e:
+        logger.error(f"Global quest rotation failed: {e}")
+        if _global_quest_timer is not None:
+            _global_quest_timer.cancel()
+        _global_quest_timer = asyncio.get_running_loop().call_later(
+            GLOBAL_QUEST_RETRY_SECONDS, _on_global_quest_timer
+        )
 
-        await db.execute(
-            "UPDATE global_quests SET progress_value = ? WHERE id = ?",
-            (new_progress, int(q['id']))
+
+async def get_global_quest_top(quest_id: Optional[int] = None, limit: int = 10) -> List[Dict]:
+    """Top contributors of a quest (the active one by default), read through the index.
+
+    Contributions still in the accumulator are added on top, so the order is exact.
+    """
+    if quest_id is None:
+        quest_id = int((await get_or_create_global_quest())['id'])
+    quest_id, limit = int(quest_id), int(limit)
+    pending = {uid: value for (qid, uid), value in _quest_contrib_pending.items() if qid == quest_id}
+
+    async with get_db() as db:
+        cursor = await db.execute(
+            """SELECT user_id, amount FROM quest_contributions
+               WHERE quest_id = ? ORDER BY amount DESC, user_id ASC LIMIT ?""",
+            (quest_id, limit)
         )
-        await db.commit()
-        q['progress_value'] = new_progress
-        return q
+        totals = {int(uid): int(amount) for uid, amount in await cursor.fetchall()}
+        # игрок вне сохранённого топа может войти в него за счёт несброшенного вклада
+        outside = [uid for uid in pending if uid not in totals]
+        for i in range(0, len(outside), 500):
+            chunk = outside[i:i + 500]
+            cursor = await db.execute(
+                f"SELECT user_id, amount FROM quest_contributions WHERE quest_id = ? "
+                f"AND user_id IN ({','.join('?' * len(chunk))})",
+                (quest_id, *chunk)
+            )
+            totals.update({int(uid): int(amount) for uid, amount in await cursor.fetchall()})
+    for uid, value in pending.items():
+        totals[uid] = totals.get(uid, 0) + value
+
+    top = sorted(totals.items(), key=lambda item: (-item[1], item[0]))[:limit]
+    return [{'user_id': uid, 'amount': amount} for uid, amount in top]
 
 
 def farm_speed_multiplier(speed_level: int) -> float:
@@ -570,7 +1504,7 @@ async def upgrade_farm(user_id: int, farm_id: int, kind: str) -> Tuple[bool, str
     if kind not in ("speed", "cap"):
         return False, "Неверный тип апгрейда"
 
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         await db.execute("BEGIN IMMEDIATE")
         try:
@@ -603,12 +1537,13 @@ async def upgrade_farm(user_id: int, farm_id: int, kind: str) -> Tuple[bool, str
                     await db.rollback()
                     return False, "Скорость уже на максимуме"
                 cost = farm_upgrade_cost(base_price, current)
-                ok = await spend_stars(user_id, cost)
+                ok = await _debit(db, user_id, stars=cost)
                 if not ok:
                     await db.rollback()
                     return False, "Недостаточно звезд"
                 await db.execute("UPDATE farms SET speed_level = speed_level + 1 WHERE id = ?", (int(farm_id),))
                 await db.commit()
+                _invalidate_user(user_id)
                 return True, f"⚡ Скорость улучшена до {current + 1} уровня (-{cost} ⭐)"
 
             current = int(farm.get('cap_level', 1) or 1)
@@ -616,12 +1551,13 @@ async def upgrade_farm(user_id: int, farm_id: int, kind: str) -> Tuple[bool, str
                 await db.rollback()
                 return False, "Лимит уже на максимуме"
             cost = farm_upgrade_cost(base_price, current)
-            ok = await spend_stars(user_id, cost)
+            ok = await _debit(db, user_id, stars=cost)
             if not ok:
                 await db.rollback()
                 return False, "Недостаточно звезд"
             await db.execute("UPDATE farms SET cap_level = cap_level + 1 WHERE id = ?", (int(farm_id),))
             await db.commit()
+            _invalidate_user(user_id)
             return True, f"📦 Лимит улучшен до {current + 1} уровня (-{cost} ⭐)"
         except Exception:
             await db.rollback()
@@ -629,7 +1565,7 @@ async def upgrade_farm(user_id: int, farm_id: int, kind: str) -> Tuple[bool, str
 
 
 async def get_active_contests() -> List[Dict]:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             "SELECT * FROM contests WHERE status = 'active' ORDER BY created_at DESC"
@@ -641,7 +1577,7 @@ async def get_active_contests() -> List[Dict]:
 async def add_contest(title: str, description: str, reward: str, how_to: str, created_by: int) -> bool:
     if not (title or description or reward or how_to):
         return False
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         await db.execute(
             "INSERT INTO contests (title, description, reward, how_to, created_by, status) VALUES (?, ?, ?, ?, ?, 'active')",
             (title, description, reward, how_to, created_by)
@@ -651,36 +1587,70 @@ async def add_contest(title: str, description: str, reward: str, how_to: str, cr
 
 
 async def clear_contests() -> None:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         await db.execute("UPDATE contests SET status = 'ended' WHERE status = 'active'")
         await db.commit()
 
 
+_prefix_cache: "OrderedDict[int, str]" = OrderedDict()
+# растёт при каждой смене префикса: загрузка, начатая до смены, в кэш не пишет
+_prefix_generation = 0
+
+
+async def get_user_prefixes(user_ids) -> Dict[int, str]:
+    """{user_id: prefix} for all user_ids ("" if none): cache first, then one IN query."""
+    result: Dict[int, str] = {}
+    missing = []
+    for user_id in dict.fromkeys(int(u) for u in user_ids if u is not None):
+        prefix = _prefix_cache.get(user_id)
+        if prefix is None:
+            missing.append(user_id)
+            continue
+        _prefix_cache.move_to_end(user_id)
+        result[user_id] = prefix
+
+    if missing:
+        generation = _prefix_generation
+        async with get_db() as db:
+            for i in range(0, len(missing), 500):
+                chunk = missing[i:i + 500]
+                cursor = await db.execute(
+                    f"SELECT user_id, prefix FROM user_settings WHERE user_id IN ({','.join('?' * len(chunk))})",
+                    chunk
+                )
+                found = {r[0]: r[1] or "" for r in await cursor.fetchall()}
+                for user_id in chunk:
+                    result[user_id] = found.get(user_id, "")
+        if generation == _prefix_generation:
+            for user_id in missing:
+                _prefix_cache[user_id] = result[user_id]
+        while len(_prefix_cache) > PREFIX_CACHE_SIZE:
+            _prefix_cache.popitem(last=False)
+    return result
+
+
 async def get_user_prefix(user_id: int) -> str:
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute(
-            "SELECT prefix FROM user_settings WHERE user_id = ?",
-            (user_id,)
-        )
-        row = await cursor.fetchone()
-        return row[0] if row and row[0] else ""
+    return (await get_user_prefixes([user_id]))[int(user_id)]
 
 
 async def set_user_prefix(user_id: int, prefix: Optional[str]) -> bool:
+    global _prefix_generation
     prefix = (prefix or "").strip()
     if len(prefix) > 24:
         prefix = prefix[:24]
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         await db.execute(
             "INSERT INTO user_settings (user_id, prefix) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET prefix=excluded.prefix",
             (user_id, prefix or None)
         )
         await db.commit()
+    _prefix_generation += 1
+    _prefix_cache.pop(int(user_id), None)
     return True
 
 
 async def get_user_items(user_id: int) -> List[Dict]:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             "SELECT item_key, qty FROM user_items WHERE user_id = ? AND qty > 0 ORDER BY item_key ASC",
@@ -694,7 +1664,7 @@ async def add_item(user_id: int, item_key: str, qty: int = 1) -> bool:
     if qty <= 0:
         return False
 
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         await db.execute(
             "INSERT INTO user_items (user_id, item_key, qty) VALUES (?, ?, ?) ON CONFLICT(user_id, item_key) DO UPDATE SET qty = qty + excluded.qty",
             (user_id, item_key, qty)
@@ -708,9 +1678,9 @@ async def get_farm_dynamic_price(user_id: int, farm_type: str) -> int:
     if farm_type not in FARM_TYPES:
         return 0
     base_price = int(FARM_TYPES[farm_type]["price"])
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         cursor = await db.execute(
-            "SELECT COUNT(*) FROM farms WHERE user_id = ? AND farm_type = ?",
+            "SELECT total FROM farm_holdings WHERE user_id = ? AND farm_type = ?",
             (user_id, farm_type)
         )
         row = await cursor.fetchone()
@@ -728,15 +1698,17 @@ async def buy_farm_dynamic(user_id: int, farm_type: str, price: int) -> bool:
         return False
     if price <= 0:
         return False
-    if await spend_stars(user_id, price):
-        async with aiosqlite.connect(DB_NAME) as db:
-            await db.execute(
-                "INSERT INTO farms (user_id, farm_type, last_activated, is_active) VALUES (?, ?, ?, 0)",
-                (user_id, farm_type, datetime.now().isoformat())
-            )
-            await db.commit()
-        return True
-    return False
+    async with get_db() as db:
+        if not await _debit(db, user_id, stars=price):
+            await db.rollback()
+            return False
+        await db.execute(
+            "INSERT INTO farms (user_id, farm_type, last_activated, is_active) VALUES (?, ?, ?, 0)",
+            (user_id, farm_type, datetime.now().isoformat())
+        )
+        await db.commit()
+    _invalidate_user(user_id)
+    return True
 
 
 async def create_user_farm_auction(seller_id: int, farm_type: str, starting_price: int, duration_hours: int = 24) -> tuple[int, str]:
@@ -753,7 +1725,7 @@ async def create_user_farm_auction(seller_id: int, farm_type: str, starting_pric
     if starting_price > max_start:
         return 0, f"Максимальная стартовая цена: {max_start} ⭐"
 
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         # забираем у продавца одну ферму данного типа
         cursor = await db.execute(
             "SELECT id FROM farms WHERE user_id = ? AND farm_type = ? ORDER BY id ASC LIMIT 1",
@@ -793,7 +1765,7 @@ async def create_user_nft_auction(seller_id: int, nft_type: str, starting_price:
     if starting_price > max_start:
         return 0, f"Максимальная стартовая цена: {max_start} ⭐"
 
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         cursor = await db.execute(
             "SELECT id FROM nfts WHERE user_id = ? AND nft_type = ? ORDER BY id ASC LIMIT 1",
             (seller_id, nft_type)
@@ -812,6 +1784,7 @@ async def create_user_nft_auction(seller_id: int, nft_type: str, starting_price:
                 (seller_id, nft_type, starting_price, starting_price, end_time.isoformat())
             )
             await db.commit()
+            _nfts_changed(seller_id)
             return cur.lastrowid, ""
         except Exception:
             await db.rollback()
@@ -819,7 +1792,7 @@ async def create_user_nft_auction(seller_id: int, nft_type: str, starting_price:
 
 
 async def get_active_user_auctions() -> Dict[str, List[Dict]]:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cur1 = await db.execute(
             "SELECT * FROM user_farm_auctions WHERE status = 'active' AND end_time > datetime('now') ORDER BY end_time ASC"
@@ -832,8 +1805,41 @@ async def get_active_user_auctions() -> Dict[str, List[Dict]]:
         return {"farms": farms, "nfts": nfts}
 
 
+async def _apply_bid(db: aiosqlite.Connection, table: str, auction_id: int, user_id: int,
+                     bid_amount: int, prev_bid: int, prev_bidder: Optional[int]) -> Tuple[bool, str]:
+    """Refund the previous bidder, debit the new one and move the lot in one transaction."""
+    await db.execute("BEGIN IMMEDIATE")
+    try:
+        # ставка проходит, только если лот не перебили с момента чтения
+        cursor = await db.execute(
+            f"UPDATE {table} SET current_bid = ?, current_bidder_id = ? "
+            "WHERE id = ? AND status = 'active' AND current_bid = ?",
+            (bid_amount, user_id, auction_id, prev_bid)
+        )
+        if cursor.rowcount != 1:
+            await db.rollback()
+            return False, "Ставку уже перебили, попробуйте снова"
+
+        if prev_bidder:
+            await db.execute(
+                "UPDATE users SET stars = stars + ? WHERE user_id = ?",
+                (prev_bid, int(prev_bidder))
+            )
+
+        if not await _debit(db, user_id, stars=bid_amount):
+            await db.rollback()
+            return False, "Недостаточно звезд"
+
+        await db.commit()
+        _invalidate_user(user_id, prev_bidder)
+        return True, f"Ставка принята: {bid_amount} ⭐"
+    except Exception:
+        await db.rollback()
+        return False, "Ошибка при ставке"
+
+
 async def place_user_farm_bid(auction_id: int, user_id: int, bid_amount: int) -> tuple[bool, str]:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             "SELECT * FROM user_farm_auctions WHERE id = ? AND status = 'active'",
@@ -860,35 +1866,14 @@ async def place_user_farm_bid(auction_id: int, user_id: int, bid_amount: int) ->
         if int(a.get('seller_id')) == int(user_id):
             return False, "Нельзя ставить на свой лот"
 
-        user_stars = await get_user_stars(user_id)
-        if user_stars < bid_amount:
-            return False, "Недостаточно звезд"
-
-        await db.execute("BEGIN IMMEDIATE")
-        try:
-            prev_bidder = a.get('current_bidder_id')
-            prev_bid = int(a.get('current_bid') or 0)
-            if prev_bidder:
-                await add_stars(int(prev_bidder), prev_bid)
-
-            ok = await spend_stars(user_id, bid_amount)
-            if not ok:
-                await db.rollback()
-                return False, "Недостаточно звезд"
-
-            await db.execute(
-                "UPDATE user_farm_auctions SET current_bid = ?, current_bidder_id = ? WHERE id = ?",
-                (bid_amount, user_id, auction_id)
-            )
-            await db.commit()
-            return True, f"Ставка принята: {bid_amount} ⭐"
-        except Exception:
-            await db.rollback()
-            return False, "Ошибка при ставке"
+        return await _apply_bid(
+            db, "user_farm_auctions", auction_id, user_id, bid_amount,
+            current_bid, a.get('current_bidder_id')
+        )
 
 
 async def end_user_farm_auction(auction_id: int) -> Optional[Dict]:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             "SELECT * FROM user_farm_auctions WHERE id = ?",
@@ -912,7 +1897,7 @@ async def end_user_farm_auction(auction_id: int) -> Optional[Dict]:
         if winner_id:
             await add_stars(seller_id, int(a.get('current_bid') or 0))
             # передать ферму победителю
-            async with aiosqlite.connect(DB_NAME) as db2:
+            async with get_db() as db2:
                 await db2.execute(
                     "INSERT INTO farms (user_id, farm_type, last_activated, is_active) VALUES (?, ?, ?, 0)",
                     (int(winner_id), farm_type, datetime.now().isoformat())
@@ -920,7 +1905,7 @@ async def end_user_farm_auction(auction_id: int) -> Optional[Dict]:
                 await db2.commit()
         else:
             # ставок нет — вернуть ферму продавцу
-            async with aiosqlite.connect(DB_NAME) as db2:
+            async with get_db() as db2:
                 await db2.execute(
                     "INSERT INTO farms (user_id, farm_type, last_activated, is_active) VALUES (?, ?, ?, 0)",
                     (seller_id, farm_type, datetime.now().isoformat())
@@ -931,7 +1916,7 @@ async def end_user_farm_auction(auction_id: int) -> Optional[Dict]:
 
 
 async def place_user_nft_bid(auction_id: int, user_id: int, bid_amount: int) -> tuple[bool, str]:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             "SELECT * FROM user_nft_auctions WHERE id = ? AND status = 'active'",
@@ -958,35 +1943,14 @@ async def place_user_nft_bid(auction_id: int, user_id: int, bid_amount: int) ->
         if int(a.get('seller_id')) == int(user_id):
             return False, "Нельзя ставить на свой лот"
 
-        user_stars = await get_user_stars(user_id)
-        if user_stars < bid_amount:
-            return False, "Недостаточно звезд"
-
-        await db.execute("BEGIN IMMEDIATE")
-        try:
-            prev_bidder = a.get('current_bidder_id')
-            prev_bid = int(a.get('current_bid') or 0)
-            if prev_bidder:
-                await add_stars(int(prev_bidder), prev_bid)
-
-            ok = await spend_stars(user_id, bid_amount)
-            if not ok:
-                await db.rollback()
-                return False, "Недостаточно звезд"
-
-            await db.execute(
-                "UPDATE user_nft_auctions SET current_bid = ?, current_bidder_id = ? WHERE id = ?",
-                (bid_amount, user_id, auction_id)
-            )
-            await db.commit()
-            return True, f"Ставка принята: {bid_amount} ⭐"
-        except Exception:
-            await db.rollback()
-            return False, "Ошибка при ставке"
+        return await _apply_bid(
+            db, "user_nft_auctions", auction_id, user_id, bid_amount,
+            current_bid, a.get('current_bidder_id')
+        )
 
 
 async def end_user_nft_auction(auction_id: int) -> Optional[Dict]:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             "SELECT * FROM user_nft_auctions WHERE id = ?",
@@ -1008,19 +1972,21 @@ async def end_user_nft_auction(auction_id: int) -> Optional[Dict]:
 
         if winner_id:
             await add_stars(seller_id, int(a.get('current_bid') or 0))
-            async with aiosqlite.connect(DB_NAME) as db2:
+            async with get_db() as db2:
                 await db2.execute(
                     "INSERT INTO nfts (user_id, nft_type) VALUES (?, ?)",
                     (int(winner_id), nft_type)
                 )
                 await db2.commit()
+            _nfts_changed(winner_id)
         else:
-            async with aiosqlite.connect(DB_NAME) as db2:
+            async with get_db() as db2:
                 await db2.execute(
                     "INSERT INTO nfts (user_id, nft_type) VALUES (?, ?)",
                     (seller_id, nft_type)
                 )
                 await db2.commit()
+            _nfts_changed(seller_id)
 
         return a
 
@@ -1028,7 +1994,7 @@ async def end_user_nft_auction(auction_id: int) -> Optional[Dict]:
 async def remove_item(user_id: int, item_key: str, qty: int = 1) -> bool:
     if qty <= 0:
         return False
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         await db.execute("BEGIN IMMEDIATE")
         cursor = await db.execute(
             "SELECT qty FROM user_items WHERE user_id = ? AND item_key = ?",
@@ -1059,7 +2025,7 @@ async def transfer_stars(from_user_id: int, to_user_id: int, amount: int) -> boo
     if amount <= 0:
         return False
 
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         await db.execute("BEGIN IMMEDIATE")
         cursor = await db.execute(
             "SELECT COALESCE(stars, 0) FROM users WHERE user_id = ?",
@@ -1080,13 +2046,14 @@ async def transfer_stars(from_user_id: int, to_user_id: int, amount: int) -> boo
             (amount, to_user_id)
         )
         await db.commit()
+        _invalidate_user(from_user_id, to_user_id)
         return True
 
 
 async def transfer_item(from_user_id: int, to_user_id: int, item_key: str, qty: int) -> bool:
     if qty <= 0:
         return False
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         await db.execute("BEGIN IMMEDIATE")
         cursor = await db.execute(
             "SELECT qty FROM user_items WHERE user_id = ? AND item_key = ?",
@@ -1122,7 +2089,7 @@ async def create_item_auction(seller_id: int, item_key: str, qty: int, starting_
     if qty <= 0 or starting_price <= 0 or duration_hours <= 0:
         return None
 
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         await db.execute("BEGIN IMMEDIATE")
         cursor = await db.execute(
             "SELECT qty FROM user_items WHERE user_id = ? AND item_key = ?",
@@ -1156,7 +2123,7 @@ async def create_item_auction(seller_id: int, item_key: str, qty: int, starting_
 
 
 async def get_active_item_auctions() -> List[Dict]:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             "SELECT * FROM item_auctions WHERE status = 'active' AND end_time > datetime('now') ORDER BY end_time ASC"
@@ -1166,7 +2133,7 @@ async def get_active_item_auctions() -> List[Dict]:
 
 
 async def place_item_bid(auction_id: int, user_id: int, bid_amount: int) -> tuple[bool, str]:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             "SELECT * FROM item_auctions WHERE id = ? AND status = 'active'",
@@ -1190,26 +2157,14 @@ async def place_item_bid(auction_id: int, user_id: int, bid_amount: int) -> tupl
         if bid_amount <= current_bid:
             return False, f"Ставка должна быть больше {current_bid} ⭐"
 
-        user_stars = await get_user_stars(user_id)
-        if user_stars < bid_amount:
-            return False, "Недостаточно звезд"
-
-        await db.execute("BEGIN IMMEDIATE")
-
-        if auction_dict.get('current_bidder_id'):
-            await add_stars(auction_dict['current_bidder_id'], auction_dict['current_bid'])
-
-        await spend_stars(user_id, bid_amount)
-        await db.execute(
-            "UPDATE item_auctions SET current_bid = ?, current_bidder_id = ? WHERE id = ?",
-            (bid_amount, user_id, auction_id)
+        return await _apply_bid(
+            db, "item_auctions", auction_id, user_id, bid_amount,
+            current_bid, auction_dict.get('current_bidder_id')
         )
-        await db.commit()
-        return True, f"Ставка принята: {bid_amount} ⭐"
 
 
 async def end_item_auction(auction_id: int) -> Optional[Dict]:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             "SELECT * FROM item_auctions WHERE id = ?",
@@ -1238,15 +2193,224 @@ async def end_item_auction(auction_id: int) -> Optional[Dict]:
         return auction_dict
 
 async def get_next_internal_id() -> int:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         cursor = await db.execute("SELECT MAX(internal_id) FROM users WHERE internal_id IS NOT NULL")
         result = await cursor.fetchone()
         max_id = result[0] if result[0] is not None else 0
         return max_id + 1
 
+class _UserRecord:
+    """Cached users row: shared column names plus a tuple of values."""
+    __slots__ = ("columns", "values", "expires_at")
+
+    def __init__(self, columns: Tuple, values: Tuple, expires_at: float):
+        self.columns = columns
+        self.values = values
+        self.expires_at = expires_at
+
+    def as_dict(self) -> Dict:
+        return dict(zip(self.columns, self.values))
+
+
+_user_cache: "OrderedDict[int, _UserRecord]" = OrderedDict()
+# колонки, которые меняют триггеры и воркер дохода в обход _invalidate_user, — в кэш не кладём
+_USER_UNCACHED_COLUMNS = frozenset({
+    "nft_count", "income_base", "income_boost", "income_rate", "income_until", "income_dirty",
+})
+# user_id -> токен текущей загрузки; инвалидация его снимает, и устаревшая строка не попадёт в кэш
+_user_loading: Dict[int, object] = {}
+_user_columns: Tuple = ()
+_user_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0, "invalidations": 0}
+
+
+def _invalidate_user(*user_ids) -> None:
+    for user_id in user_ids:
+        if user_id is None:
+            continue
+        user_id = int(user_id)
+        _rank_dirty.add(user_id)
+        _user_loading.pop(user_id, None)
+        if _user_cache.pop(user_id, None) is not None:
+            _user_cache_stats["invalidations"] += 1
+
+
+def _user_row(row) -> Dict:
+    """users row as a dict without the trigger-maintained columns."""
+    return {k: row[k] for k in row.keys() if k not in _USER_UNCACHED_COLUMNS}
+
+
+def _cache_get_user(user_id: int) -> Optional[Dict]:
+    if not USER_CACHE_ENABLED:
+        return None
+    record = _user_cache.get(user_id)
+    if record is None:
+        _user_cache_stats["misses"] += 1
+        return None
+    if record.expires_at <= time.monotonic():
+        del _user_cache[user_id]
+        _user_cache_stats["expired"] += 1
+        _user_cache_stats["misses"] += 1
+        return None
+    _user_cache.move_to_end(user_id)
+    _user_cache_stats["hits"] += 1
+    return record.as_dict()
+
+
+def _cache_begin_load(user_id: int) -> object:
+    token = object()
+    _user_loading[user_id] = token
+    return token
+
+
+def _cache_store_user(user_id: int, token: object, row) -> None:
+    global _user_columns
+    if _user_loading.get(user_id) is not token:
+        return
+    del _user_loading[user_id]
+    if not USER_CACHE_ENABLED or row is None:
+        return
+    record = _user_row(row)
+    columns = tuple(record)
+    if columns != _user_columns:
+        _user_columns = columns
+    _user_cache[user_id] = _UserRecord(_user_columns, tuple(record.values()), time.monotonic() + USER_CACHE_TTL)
+    _user_cache.move_to_end(user_id)
+    while len(_user_cache) > USER_CACHE_SIZE:
+        _user_cache.popitem(last=False)
+        _user_cache_stats["evictions"] += 1
+
+
+def set_user_cache_enabled(enabled: bool) -> None:
+    """Turns the users row cache on or off; the cache is emptied either way."""
+    global USER_CACHE_ENABLED
+    USER_CACHE_ENABLED = bool(enabled)
+    _user_cache.clear()
+    _user_loading.clear()
+
+
+def get_user_cache_stats() -> Dict:
+    stats = dict(_user_cache_stats)
+    stats["size"] = len(_user_cache)
+    stats["capacity"] = USER_CACHE_SIZE
+    return stats
+
+
+# user_id -> (username, full_name); username в нижнем регистре -> user_id
+_identity_cache: "OrderedDict[int, Tuple[Optional[str], Optional[str]]]" = OrderedDict()
+_username_ids: Dict[str, int] = {}
+
+
+def _cache_identity(user_id: int, username: Optional[str], full_name: Optional[str]) -> None:
+    old = _identity_cache.pop(user_id, None)
+    if old and old[0]:
+        _username_ids.pop(old[0].lower(), None)
+    _identity_cache[user_id] = (username, full_name)
+    if username:
+        _username_ids[username.lower()] = user_id
+    while len(_identity_cache) > IDENTITY_CACHE_SIZE:
+        _, (evicted, _) = _identity_cache.popitem(last=False)
+        if evicted:
+            _username_ids.pop(evicted.lower(), None)
+
+
+async def remember_identity(user_id: int, username: Optional[str], full_name: Optional[str]) -> None:
+    """Records the names seen in an update; writes only when they changed."""
+    user_id = int(user_id)
+    username = (username or "").strip().lstrip("@")[:64] or None
+    full_name = (full_name or "").strip()[:128] or None
+    if _identity_cache.get(user_id) == (username, full_name):
+        _identity_cache.move_to_end(user_id)
+        return
+
+    statements = []
+    if username:
+        # username в Telegram уникален: у прежнего владельца его больше нет
+        statements.append((
+            "UPDATE user_identities SET username = NULL WHERE username = ? AND user_id != ?",
+            (username, user_id)
+        ))
+    statements.append((
+        """
+        INSERT INTO user_identities (user_id, username, full_name, updated_at)
+        VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT (user_id) DO UPDATE SET
+            username = excluded.username,
+            full_name = excluded.full_name,
+            updated_at = excluded.updated_at
+        WHERE username IS NOT excluded.username OR full_name IS NOT excluded.full_name
+        """,
+        (user_id, username, full_name)
+    ))
+    await _write(statements)
+    if username:
+        previous = _username_ids.get(username.lower())
+        if previous is not None and previous != user_id:
+            _identity_cache.pop(previous, None)
+    _cache_identity(user_id, username, full_name)
+
+
+async def get_identities(user_ids) -> Dict[int, Dict]:
+    """{user_id: {'username', 'full_name'}} for the known users among user_ids."""
+    result: Dict[int, Dict] = {}
+    missing = []
+    for user_id in dict.fromkeys(int(u) for u in user_ids):
+        cached = _identity_cache.get(user_id)
+        if cached is None:
+            missing.append(user_id)
+            continue
+        _identity_cache.move_to_end(user_id)
+        result[user_id] = {'username': cached[0], 'full_name': cached[1]}
+
+    if missing:
+        async with get_db() as db:
+            for i in range(0, len(missing), 500):
+                chunk = missing[i:i + 500]
+                cursor = await db.execute(
+                    f"SELECT user_id, username, full_name FROM user_identities "
+                    f"WHERE user_id IN ({','.join('?' * len(chunk))})",
+                    chunk
+                )
+                for r in await cursor.fetchall():
+                    _cache_identity(r['user_id'], r['username'], r['full_name'])
+                    result[r['user_id']] = {'username': r['username'], 'full_name': r['full_name']}
+    return result
+
+
+async def get_identity(user_id: int) -> Optional[Dict]:
+    return (await get_identities([user_id])).get(int(user_id))
+
+
+async def find_user_id_by_username(username: str) -> Optional[int]:
+    username = (username or "").strip().lstrip("@")
+    if not username:
+        return None
+    user_id = _username_ids.get(username.lower())
+    if user_id is not None:
+        return user_id
+    async with get_db() as db:
+        cursor = await db.execute("SELECT user_id FROM user_identities WHERE username = ?", (username,))
+        row = await cursor.fetchone()
+    return row[0] if row else None
+
+
 async def get_or_create_user(user_id: int) -> Dict:
-    async with aiosqlite.connect(DB_NAME) as db:
+    cached = _cache_get_user(user_id)
+    if cached is not None:
+        return cached
+
+    token = _cache_begin_load(user_id)
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
+        # обычно пользователь уже есть — читаем без write-транзакции
+        cursor = await db.execute(
+            "SELECT * FROM users WHERE user_id = ?",
+            (user_id,)
+        )
+        user = await cursor.fetchone()
+        if user and user['internal_id'] is not None:
+            _cache_store_user(user_id, token, user)
+            return _user_row(user)
+
         await db.execute("BEGIN IMMEDIATE")
 
         cursor = await db.execute(
@@ -1261,6 +2425,11 @@ async def get_or_create_user(user_id: int) -> Dict:
                 "INSERT OR IGNORE INTO users (user_id, internal_id, stars, last_collect, xp, level) VALUES (?, ?, ?, ?, 0, 1)",
                 (user_id, internal_id, 200, datetime.now().isoformat())
             )
+            # новичок попадает в текущий сезон со стартовым балансом
+            await db.execute(
+                "INSERT OR IGNORE INTO season_snapshots (user_id, season_key, start_stars) VALUES (?, ?, ?)",
+                (user_id, _current_season_key(), 200)
+            )
 
         cursor = await db.execute(
             "SELECT * FROM users WHERE user_id = ?",
@@ -1281,7 +2450,9 @@ async def get_or_create_user(user_id: int) -> Dict:
             user = await cursor.fetchone()
 
         await db.commit()
-        return dict(user)
+        _rank_dirty.add(user_id)
+        _cache_store_user(user_id, token, user)
+        return _user_row(user)
 
 async def get_user_stars(user_id: int) -> int:
     user = await get_or_create_user(user_id)
@@ -1292,50 +2463,54 @@ async def get_user_crystals(user_id: int) -> int:
     return user.get('crystals', 0) or 0
 
 async def add_stars(user_id: int, amount: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            "UPDATE users SET stars = stars + ? WHERE user_id = ?",
-            (amount, user_id)
-        )
-        await db.commit()
+    await _write([(
+        "UPDATE users SET stars = stars + ? WHERE user_id = ?",
+        (amount, user_id)
+    )], user_ids=(user_id,))
 
 async def add_crystals(user_id: int, amount: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            "UPDATE users SET crystals = COALESCE(crystals, 0) + ? WHERE user_id = ?",
-            (amount, user_id)
-        )
+    await _write([(
+        "UPDATE users SET crystals = COALESCE(crystals, 0) + ? WHERE user_id = ?",
+        (amount, user_id)
+    )], user_ids=(user_id,))
+
+async def _debit(db: aiosqlite.Connection, user_id: int, stars: int = 0, crystals: int = 0) -> bool:
+    """Conditionally debit balances on an open connection; False if funds are short."""
+    stars = int(stars or 0)
+    crystals = int(crystals or 0)
+    if stars < 0 or crystals < 0:
+        return False
+    # проверка баланса и списание одним UPDATE — без гонки между SELECT и UPDATE
+    cursor = await db.execute(
+        """
+        UPDATE users
+        SET stars = stars - ?, crystals = COALESCE(crystals, 0) - ?
+        WHERE user_id = ? AND stars >= ? AND COALESCE(crystals, 0) >= ?
+        """,
+        (stars, crystals, user_id, stars, crystals)
+    )
+    return cursor.rowcount == 1
+
+async def debit_balances(user_id: int, stars: int = 0, crystals: int = 0) -> bool:
+    """Atomically debit stars and/or crystals; nothing is charged unless both cover."""
+    async with get_db() as db:
+        ok = await _debit(db, user_id, stars=stars, crystals=crystals)
         await db.commit()
+    if ok:
+        _invalidate_user(user_id)
+    return ok
 
 async def spend_stars(user_id: int, amount: int) -> bool:
-    current_stars = await get_user_stars(user_id)
-    if current_stars >= amount:
-        async with aiosqlite.connect(DB_NAME) as db:
-            await db.execute(
-                "UPDATE users SET stars = stars - ? WHERE user_id = ?",
-                (amount, user_id)
-            )
-            await db.commit()
-        return True
-    return False
+    return await debit_balances(user_id, stars=amount)
 
 async def spend_crystals(user_id: int, amount: int) -> bool:
-    current = await get_user_crystals(user_id)
-    if current >= amount:
-        async with aiosqlite.connect(DB_NAME) as db:
-            await db.execute(
-                "UPDATE users SET crystals = COALESCE(crystals, 0) - ? WHERE user_id = ?",
-                (amount, user_id)
-            )
-            await db.commit()
-        return True
-    return False
+    return await debit_balances(user_id, crystals=amount)
 
 async def transfer_crystals(from_user_id: int, to_user_id: int, amount: int) -> bool:
     if amount <= 0:
         return False
 
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         await db.execute("BEGIN IMMEDIATE")
 
         cursor = await db.execute(
@@ -1357,6 +2532,7 @@ async def transfer_crystals(from_user_id: int, to_user_id: int, amount: int) ->
             (amount, to_user_id)
         )
         await db.commit()
+        _invalidate_user(from_user_id, to_user_id)
         return True
 
 async def buy_farm(user_id: int, farm_type: str) -> bool:
@@ -1367,52 +2543,45 @@ async def buy_farm(user_id: int, farm_type: str) -> bool:
     
     price = FARM_TYPES[farm_type]["price"]
     
-    if await spend_stars(user_id, price):
-        async with aiosqlite.connect(DB_NAME) as db:
-            await db.execute(
-                "INSERT INTO farms (user_id, farm_type, last_activated, is_active) VALUES (?, ?, ?, 0)",
-                (user_id, farm_type, datetime.now().isoformat())
-            )
-            await db.commit()
-        return True
-    return False
+    async with get_db() as db:
+        if not await _debit(db, user_id, stars=price):
+            await db.rollback()
+            return False
+        await db.execute(
+            "INSERT INTO farms (user_id, farm_type, last_activated, is_active) VALUES (?, ?, ?, 0)",
+            (user_id, farm_type, datetime.now().isoformat())
+        )
+        await db.commit()
+    _invalidate_user(user_id)
+    return True
 
 async def activate_farms(user_id: int) -> tuple[int, int]:
-    farms = await get_user_farms(user_id)
-    if not farms:
-        return 0, 0
-    
-    activated_count = 0
     now = datetime.now()
-    
-    async with aiosqlite.connect(DB_NAME) as db:
-        for farm in farms:
-            farm_id = farm['id']
-            last_activated = farm.get('last_activated')
-            is_active = farm.get('is_active', 0)
-            
-            can_activate = False
-            if not last_activated or not is_active:
-                can_activate = True
-            else:
-                last_activated_dt = datetime.fromisoformat(last_activated)
-                hours_passed = (now - last_activated_dt).total_seconds() / 3600
-                if hours_passed >= 6:
-                    can_activate = True
-            
-            if can_activate:
-                await db.execute(
-                    "UPDATE farms SET last_activated = ?, is_active = 1 WHERE id = ?",
-                    (now.isoformat(), farm_id)
-                )
-                activated_count += 1
-        
+    cutoff = (now - timedelta(hours=FARM_ACTIVE_HOURS)).isoformat()
+
+    async with get_db() as db:
+        cursor = await db.execute(
+            """
+            UPDATE farms SET last_activated = ?, is_active = 1
+            WHERE user_id = ?
+              AND (COALESCE(is_active, 0) = 0 OR last_activated IS NULL OR last_activated <= ?)
+            """,
+            (now.isoformat(), user_id, cutoff)
+        )
+        activated_count = cursor.rowcount
         await db.commit()
-    
-    return activated_count, len(farms)
+
+        cursor = await db.execute(
+            "SELECT COALESCE(SUM(total), 0) FROM farm_holdings WHERE user_id = ?",
+            (user_id,)
+        )
+        row = await cursor.fetchone()
+        total = int(row[0]) if row else 0
+
+    return activated_count, total
 
 async def get_user_farms(user_id: int) -> List[Dict]:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             "SELECT * FROM farms WHERE user_id = ?",
@@ -1421,26 +2590,77 @@ async def get_user_farms(user_id: int) -> List[Dict]:
         farms = await cursor.fetchall()
         return [dict(farm) for farm in farms]
 
-async def buy_nft(user_id: int, nft_type: str) -> bool:
+async def _expire_user_farms(db: aiosqlite.Connection, user_id: int) -> None:
+    # активация, которой больше FARM_ACTIVE_HOURS часов, гаснет; farm_holdings обновит триггер.
+    # Вызывается только из пишущих путей — чтение считает активные фермы само
+    cutoff = (datetime.now() - timedelta(hours=FARM_ACTIVE_HOURS)).isoformat()
+    await db.execute(
+        "UPDATE farms SET is_active = 0 WHERE user_id = ? AND is_active = 1 AND last_activated <= ?",
+        (user_id, cutoff)
+    )
+
+async def get_user_farm_holdings(user_id: int) -> Dict[str, Dict]:
+    """Farm counts and summed levels per type: {farm_type: {total, active, ...}}.
+
+    farm_holdings.active may still count activations that have run out, so
+    active is counted from farms by last_activated instead.
+    """
+    cutoff = (datetime.now() - timedelta(hours=FARM_ACTIVE_HOURS)).isoformat()
+    async with get_db() as db:
+        cursor = await db.execute(
+            """
+            SELECT h.farm_type, h.total, COALESCE(a.active, 0) AS active,
+                   h.speed_level_sum, h.cap_level_sum
+            FROM farm_holdings h
+            LEFT JOIN (
+                SELECT farm_type, COUNT(*) AS active FROM farms
+                WHERE user_id = ? AND is_active = 1 AND last_activated > ?
+                GROUP BY farm_type
+            ) a ON a.farm_type = h.farm_type
+            WHERE h.user_id = ?
+            ORDER BY h.farm_type
+            """,
+            (user_id, cutoff, user_id)
+        )
+        rows = await cursor.fetchall()
+    return {row['farm_type']: dict(row) for row in rows}
+
+async def get_user_upgradable_farms(user_id: int, limit: int = 10) -> List[Dict]:
+    """First farms of the user that can be upgraded (case farms excluded)."""
+    async with get_db() as db:
+        cursor = await db.execute(
+            """
+            SELECT * FROM farms
+            WHERE user_id = ? AND substr(farm_type, 1, 5) != 'case_'
+            ORDER BY id ASC LIMIT ?
+            """,
+            (user_id, int(limit))
+        )
+        return [dict(row) for row in await cursor.fetchall()]
+
+async def buy_nft(user_id: int, nft_type: str) -> Tuple[bool, str]:
+    """Mints the NFT and debits its price in one transaction; (success, message)."""
     from config import NFT_GIFTS
     
     if nft_type not in NFT_GIFTS:
-        return False
+        return False, "❌ Такого NFT не существует!"
     
     price = NFT_GIFTS[nft_type]["price"]
     
-    if await spend_stars(user_id, price):
-        async with aiosqlite.connect(DB_NAME) as db:
-            await db.execute(
-                "INSERT INTO nfts (user_id, nft_type) VALUES (?, ?)",
-                (user_id, nft_type)
-            )
-            await db.commit()
-        return True
-    return False
+    async with get_db() as db:
+        if not await _mint_nft(db, user_id, nft_type):
+            await db.rollback()
+            return False, "❌ Этот NFT закончился"
+        if not await _debit(db, user_id, stars=price):
+            await db.rollback()
+            return False, "❌ Недостаточно звезд!"
+        await db.commit()
+    _nft_supply_changed()
+    _nfts_changed(user_id)
+    return True, f"✅ Вы купили {NFT_GIFTS[nft_type]['name']}!"
 
 async def get_user_nfts(user_id: int) -> List[Dict]:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             "SELECT * FROM nfts WHERE user_id = ?",
@@ -1449,21 +2669,76 @@ async def get_user_nfts(user_id: int) -> List[Dict]:
         nfts = await cursor.fetchall()
         return [dict(nft) for nft in nfts]
 
-async def calculate_total_boost(user_id: int) -> float:
+async def get_user_nft_holdings(user_id: int) -> Dict[str, int]:
+    """{nft_type: qty} for the user, read from nft_holdings."""
+    async with get_db() as db:
+        cursor = await db.execute(
+            "SELECT nft_type, qty FROM nft_holdings WHERE user_id = ?",
+            (user_id,)
+        )
+        return {r[0]: int(r[1]) for r in await cursor.fetchall()}
+
+
+async def user_has_nft(user_id: int, nft_type: str) -> bool:
+    async with get_db() as db:
+        cursor = await db.execute(
+            "SELECT 1 FROM nft_holdings WHERE user_id = ? AND nft_type = ?",
+            (user_id, nft_type)
+        )
+        return await cursor.fetchone() is not None
+
+
+def _nft_boost(holdings: Dict[str, int]) -> float:
+    """1.0 plus the NFT boosts; types are summed in sorted order so every caller gets the same float."""
     from config import NFT_GIFTS
-    
-    nfts = await get_user_nfts(user_id)
+
     total_boost = 1.0
-    
-    for nft in nfts:
-        nft_type = nft['nft_type']
+    for nft_type in sorted(holdings):
         if nft_type in NFT_GIFTS:
             b = float(NFT_GIFTS[nft_type].get("boost", 1.0))
-            total_boost += max(0.0, b - 1.0)
+            total_boost += max(0.0, b - 1.0) * holdings[nft_type]
+    return total_boost
+
+
+# user_id -> NFT-буст × бонус уровня; глобальный бафф домножается при чтении.
+# Сбрасывается _invalidate_boost() при смене NFT или уровня.
+_boost_cache: "OrderedDict[int, float]" = OrderedDict()
+_boost_loading: Dict[int, object] = {}
+
+
+def _invalidate_boost(*user_ids) -> None:
+    for user_id in user_ids:
+        if user_id is None:
+            continue
+        user_id = int(user_id)
+        _boost_cache.pop(user_id, None)
+        _boost_loading.pop(user_id, None)
+
+
+def _nfts_changed(*user_ids) -> None:
+    """Call after a commit that moved NFTs: nft_count and the boost of these users changed."""
+    _invalidate_user(*user_ids)
+    _invalidate_boost(*user_ids)
+
+
+async def calculate_total_boost(user_id: int) -> float:
+    user_id = int(user_id)
+    total_boost = _boost_cache.get(user_id)
+    if total_boost is None:
+        token = object()
+        _boost_loading[user_id] = token
+        total_boost = _nft_boost(await get_user_nft_holdings(user_id))
+        user = await get_or_create_user(user_id)
+        level = int(user.get('level', 1) or 1)
+        total_boost *= get_level_bonus_multiplier(level)
+        if _boost_loading.get(user_id) is token:
+            del _boost_loading[user_id]
+            _boost_cache[user_id] = total_boost
+            while len(_boost_cache) > USER_CACHE_SIZE:
+                _boost_cache.popitem(last=False)
+    else:
+        _boost_cache.move_to_end(user_id)
 
-    user = await get_or_create_user(user_id)
-    level = int(user.get('level', 1) or 1)
-    total_boost *= get_level_bonus_multiplier(level)
     try:
         buff = await get_active_global_buff()
         if buff:
@@ -1501,7 +2776,7 @@ async def add_xp(user_id: int, amount: int) -> Dict:
             'levels_gained': 0
         }
 
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         await db.execute("BEGIN IMMEDIATE")
         cursor = await db.execute("SELECT level, xp FROM users WHERE user_id = ?", (user_id,))
@@ -1524,6 +2799,9 @@ async def add_xp(user_id: int, amount: int) -> Dict:
 
         await db.execute("UPDATE users SET xp = ?, level = ? WHERE user_id = ?", (xp, level, user_id))
         await db.commit()
+        _invalidate_user(user_id)
+        if levels_gained:
+            _invalidate_boost(user_id)
 
         return {
             'level': level,
@@ -1533,104 +2811,133 @@ async def add_xp(user_id: int, amount: int) -> Dict:
             'levels_gained': levels_gained
         }
 
-async def collect_farm_income(user_id: int) -> int:
+def _config_hash(rows: List[tuple]) -> str:
+    return hashlib.sha1(json.dumps(rows, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+async def _config_changed(db: aiosqlite.Connection, name: str, digest: str) -> bool:
+    cursor = await db.execute("SELECT hash FROM config_sync WHERE name = ?", (name,))
+    row = await cursor.fetchone()
+    return row is None or row[0] != digest
+
+
+async def _store_config_hash(db: aiosqlite.Connection, name: str, digest: str) -> None:
+    await db.execute(
+        "INSERT INTO config_sync (name, hash) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET hash = excluded.hash",
+        (name, digest)
+    )
+
+
+async def _farm_rate_rows() -> List[tuple]:
+    """farm_rates rows from config (regular, case and Saturday farms)."""
     from config import FARM_TYPES, CASE_FARM_TYPES
-    
-    user = await get_or_create_user(user_id)
-    farms = await get_user_farms(user_id)
-    
-    if not farms:
-        return 0
-    
-    last_collect = datetime.fromisoformat(user['last_collect']) if user['last_collect'] else datetime.now()
-    now = datetime.now()
-    hours_passed = (now - last_collect).total_seconds() / 3600
-    
-    hours_passed = min(hours_passed, 24)
-    
-    total_income = 0
-    for farm in farms:
-        is_active = farm.get('is_active', 0)
-        if not is_active:
-            continue
-        
-        last_activated = farm.get('last_activated')
-        if last_activated:
-            last_activated_dt = datetime.fromisoformat(last_activated)
-            hours_since_activation = (now - last_activated_dt).total_seconds() / 3600
-            if hours_since_activation >= 6:
-                async with aiosqlite.connect(DB_NAME) as db:
-                    await db.execute(
-                        "UPDATE farms SET is_active = 0 WHERE id = ?",
-                        (farm['id'],)
-                    )
-                    await db.commit()
-                continue
-        
-        farm_type = farm['farm_type']
-        farm_defs = {}
-        farm_defs.update(FARM_TYPES)
-        farm_defs.update(CASE_FARM_TYPES)
-        try:
-            special = await get_special_farm_types()
-            farm_defs.update(special)
-        except Exception:
-            pass
-        if farm_type in farm_defs:
-            base_income_per_hour = farm_defs[farm_type]["income_per_hour"]
-            speed_level = int(farm.get('speed_level', 1) or 1)
-            cap_level = int(farm.get('cap_level', 1) or 1)
-
-            eff_income_per_hour = base_income_per_hour
-            if not str(farm_type).startswith("case_"):
-                eff_income_per_hour = int(round(base_income_per_hour * farm_speed_multiplier(speed_level)))
-
-            cap_h = farm_cap_hours(cap_level) if not str(farm_type).startswith("case_") else 6.0
-
-            if last_activated:
-                last_activated_dt = datetime.fromisoformat(last_activated)
-                cap_from = now - timedelta(hours=cap_h)
-                collect_from = max(last_activated_dt, last_collect, cap_from)
-                hours_for_income = (now - collect_from).total_seconds() / 3600
-                hours_for_income = min(hours_for_income, hours_passed)
+
+    farm_defs = {}
+    farm_defs.update(FARM_TYPES)
+    farm_defs.update(CASE_FARM_TYPES)
+    farm_defs.update(await get_special_farm_types())
+
+    rows = []
+    for farm_type, farm_data in farm_defs.items():
+        base_income_per_hour = farm_data["income_per_hour"]
+        is_case = str(farm_type).startswith("case_")
+        for level in range(1, 11):
+            if is_case:
+                rows.append((farm_type, level, base_income_per_hour, 6.0))
             else:
-                cap_from = now - timedelta(hours=cap_h)
-                collect_from = max(last_collect, cap_from)
-                hours_for_income = (now - collect_from).total_seconds() / 3600
-                hours_for_income = min(hours_for_income, hours_passed)
-            
-            total_income += eff_income_per_hour * hours_for_income
-    
+                rows.append((
+                    farm_type, level,
+                    int(round(base_income_per_hour * farm_speed_multiplier(level))),
+                    farm_cap_hours(level),
+                ))
+    return rows
+
+
+async def _fill_farm_rates(db: aiosqlite.Connection, rows: List[tuple], digest: str) -> None:
+    """Replaces farm_rates; caller commits."""
+    await db.execute("DELETE FROM farm_rates")
+    await db.executemany(
+        "INSERT INTO farm_rates (farm_type, level, income_per_hour, cap_hours) VALUES (?, ?, ?, ?)",
+        rows
+    )
+    await _store_config_hash(db, "farm_rates", digest)
+    # ставки поменялись — сохранённые income_rate устарели
+    await db.execute("UPDATE users SET income_dirty = 1")
+
+
+async def _sync_farm_rates(db: aiosqlite.Connection) -> None:
+    """Rebuilds farm_rates if the farm config changed since the last rebuild."""
+    rows = await _farm_rate_rows()
+    digest = _config_hash(rows)
+    if not await _config_changed(db, "farm_rates", digest):
+        return
+    await db.execute("BEGIN IMMEDIATE")
+    await _fill_farm_rates(db, rows, digest)
+    await db.commit()
+    logger.info("farm_rates rebuilt from config")
+
+
+async def collect_farm_income(user_id: int) -> int:
+    async with get_db() as db:
+        cursor = await db.execute("SELECT 1 FROM farm_holdings WHERE user_id = ? LIMIT 1", (user_id,))
+        if not await cursor.fetchone():
+            return 0
+
     boost = await calculate_total_boost(user_id)
-    total_income = int(total_income * boost)
-    
-    async with aiosqlite.connect(DB_NAME) as db:
+    now = datetime.now()
+
+    async with get_db() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        await _expire_user_farms(db, user_id)
+
+        cursor = await db.execute("SELECT last_collect FROM users WHERE user_id = ?", (user_id,))
+        row = await cursor.fetchone()
+        last_collect = datetime.fromisoformat(row['last_collect']) if row and row['last_collect'] else now
+        hours_passed = min((now - last_collect).total_seconds() / 3600, 24)
+
+        # доход каждой фермы: ставка по уровню скорости × часы с max(активации, прошлого сбора, now - лимит)
+        cursor = await db.execute(
+            """
+            SELECT COALESCE(SUM(r.income_per_hour * MIN(
+                (julianday(:now) - MAX(COALESCE(julianday(f.last_activated), julianday(:last_collect)),
+                                       julianday(:last_collect),
+                                       julianday(:now) - c.cap_hours / 24.0)) * 24.0,
+                :hours_passed
+            )), 0)
+            FROM farms f
+            JOIN farm_rates r
+              ON r.farm_type = f.farm_type AND r.level = MIN(MAX(COALESCE(f.speed_level, 1), 1), 10)
+            JOIN farm_rates c
+              ON c.farm_type = f.farm_type AND c.level = MIN(MAX(COALESCE(f.cap_level, 1), 1), 10)
+            WHERE f.user_id = :user_id AND f.is_active = 1
+            """,
+            {
+                "now": now.isoformat(),
+                "last_collect": last_collect.isoformat(),
+                "hours_passed": hours_passed,
+                "user_id": user_id,
+            }
+        )
+        total_income = int((await cursor.fetchone())[0] * boost)
+
         await db.execute(
-            "UPDATE users SET last_collect = ? WHERE user_id = ?",
-            (now.isoformat(), user_id)
+            "UPDATE users SET last_collect = ?, stars = stars + ? WHERE user_id = ?",
+            (now.isoformat(), total_income, user_id)
         )
         await db.commit()
-    
-    if total_income > 0:
-        await add_stars(user_id, total_income)
-    
+    _invalidate_user(user_id)
+
     return total_income
 
 async def collect_farm_income_with_crystals(user_id: int) -> tuple[int, int]:
     income = await collect_farm_income(user_id)
-    farms = await get_user_farms(user_id)
-    if not farms:
+    holdings = await get_user_farm_holdings(user_id)
+    if not holdings:
         return income, 0
 
     import random
-    crystals_gained = 0
-    active_farms = 0
-    for farm in farms:
-        if not farm.get('is_active', 0):
-            continue
-        active_farms += 1
-        if random.random() < 0.015:
-            crystals_gained += 1
+    active_farms = sum(h['active'] for h in holdings.values())
+    crystals_gained = sum(1 for _ in range(active_farms) if random.random() < 0.015)
 
     crystals_gained += active_farms // 40
 
@@ -1643,7 +2950,7 @@ async def create_farm_trade(seller_id: int, buyer_id: int, farm_id: int, price:
     if price <= 0:
         return None
 
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         cursor = await db.execute(
             "SELECT id FROM farms WHERE id = ? AND user_id = ?",
             (farm_id, seller_id)
@@ -1660,25 +2967,66 @@ async def create_farm_trade(seller_id: int, buyer_id: int, farm_id: int, price:
         return cursor.lastrowid
 
 async def get_farm_trade(trade_id: int) -> Optional[Dict]:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             "SELECT * FROM farm_trades WHERE id = ?",
             (trade_id,)
         )
-        trade = await cursor.fetchone()
-        return dict(trade) if trade else None
-
-async def set_farm_trade_status(trade_id: int, status: str):
-    async with aiosqlite.connect(DB_NAME) as db:
+        trade = await cursor.fetchone()
+        return dict(trade) if trade else None
+
+async def set_farm_trade_status(trade_id: int, status: str):
+    async with get_db() as db:
+        await db.execute(
+            "UPDATE farm_trades SET status = ? WHERE id = ?",
+            (status, trade_id)
+        )
+        await db.commit()
+
+async def complete_farm_trade(trade_id: int, buyer_id: int) -> Tuple[bool, str]:
+    """Pays for a pending farm trade and hands the farm over in one transaction; (success, message)."""
+    async with get_db() as db:
+        db.row_factory = aiosqlite.Row
+        await db.execute("BEGIN IMMEDIATE")
+        cursor = await db.execute(
+            "SELECT * FROM farm_trades WHERE id = ? AND status = 'pending'",
+            (trade_id,)
+        )
+        trade = await cursor.fetchone()
+        if not trade:
+            await db.rollback()
+            return False, "❌ Трейд не найден"
+        if trade['buyer_id'] != buyer_id:
+            await db.rollback()
+            return False, "❌ Это не ваш трейд"
+
+        price = int(trade['price'])
+        seller_id = int(trade['seller_id'])
+        if not await _debit(db, buyer_id, stars=price):
+            await db.rollback()
+            return False, "❌ Недостаточно звезд"
+        cursor = await db.execute(
+            "UPDATE farms SET user_id = ? WHERE id = ? AND user_id = ?",
+            (buyer_id, int(trade['farm_id']), seller_id)
+        )
+        if cursor.rowcount != 1:
+            await db.rollback()
+            return False, "❌ Ферма уже недоступна"
+        await db.execute(
+            "UPDATE users SET stars = stars + ? WHERE user_id = ?",
+            (price, seller_id)
+        )
         await db.execute(
-            "UPDATE farm_trades SET status = ? WHERE id = ?",
-            (status, trade_id)
+            "UPDATE farm_trades SET status = 'completed' WHERE id = ?",
+            (trade_id,)
         )
         await db.commit()
+    _invalidate_user(buyer_id, seller_id)
+    return True, "✅ Трейд завершен"
 
 async def transfer_farm_ownership(farm_id: int, from_user_id: int, to_user_id: int) -> bool:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         await db.execute("BEGIN IMMEDIATE")
         cursor = await db.execute(
             "SELECT id FROM farms WHERE id = ? AND user_id = ?",
@@ -1700,7 +3048,7 @@ async def register_referral(referrer_id: int, referred_id: int) -> bool:
     if referrer_id == referred_id:
         return False
     
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         cursor = await db.execute(
             "SELECT * FROM referrals WHERE referred_id = ?",
             (referred_id,)
@@ -1720,7 +3068,7 @@ async def register_referral(referrer_id: int, referred_id: int) -> bool:
 async def give_referral_reward(referred_id: int) -> bool:
     from config import REFERRAL_REWARD
     
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         cursor = await db.execute(
             "SELECT * FROM referrals WHERE referred_id = ? AND reward_given = 0",
             (referred_id,)
@@ -1740,7 +3088,7 @@ async def give_referral_reward(referred_id: int) -> bool:
         return True
 
 async def get_referral_count(user_id: int) -> int:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         cursor = await db.execute(
             "SELECT COUNT(*) as count FROM referrals WHERE referrer_id = ?",
             (user_id,)
@@ -1756,7 +3104,7 @@ async def create_auction(farm_type: str, starting_price: int, duration_hours: in
     
     end_time = datetime.now() + timedelta(hours=duration_hours)
     
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         cursor = await db.execute(
             "INSERT INTO auctions (farm_type, starting_price, current_bid, end_time, status) VALUES (?, ?, ?, ?, 'active')",
             (farm_type, starting_price, starting_price, end_time.isoformat())
@@ -1765,7 +3113,7 @@ async def create_auction(farm_type: str, starting_price: int, duration_hours: in
         return cursor.lastrowid
 
 async def get_active_auctions() -> List[Dict]:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             "SELECT * FROM auctions WHERE status = 'active' AND end_time > datetime('now') ORDER BY end_time ASC"
@@ -1774,7 +3122,7 @@ async def get_active_auctions() -> List[Dict]:
         return [dict(auction) for auction in auctions]
 
 async def place_bid(auction_id: int, user_id: int, bid_amount: int) -> tuple[bool, str]:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             "SELECT * FROM auctions WHERE id = ? AND status = 'active'",
@@ -1800,25 +3148,13 @@ async def place_bid(auction_id: int, user_id: int, bid_amount: int) -> tuple[boo
         if bid_amount <= current_bid:
             return False, f"Ставка должна быть больше {current_bid} "
         
-        user_stars = await get_user_stars(user_id)
-        if user_stars < bid_amount:
-            return False, "Недостаточно звезд"
-        
-        if auction_dict['current_bidder_id']:
-            await add_stars(auction_dict['current_bidder_id'], auction_dict['current_bid'])
-        
-        await spend_stars(user_id, bid_amount)
-        
-        await db.execute(
-            "UPDATE auctions SET current_bid = ?, current_bidder_id = ? WHERE id = ?",
-            (bid_amount, user_id, auction_id)
+        return await _apply_bid(
+            db, "auctions", auction_id, user_id, bid_amount,
+            current_bid, auction_dict['current_bidder_id']
         )
-        await db.commit()
-        
-        return True, f"Ставка принята: {bid_amount} "
 
 async def end_auction(auction_id: int) -> Optional[Dict]:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             "SELECT * FROM auctions WHERE id = ?",
@@ -1854,7 +3190,7 @@ async def end_auction(auction_id: int) -> Optional[Dict]:
 
 async def is_banned(user_id: int) -> bool:
     try:
-        async with aiosqlite.connect(DB_NAME) as db:
+        async with get_db() as db:
             cursor = await db.execute(
                 "SELECT 1 FROM bans WHERE user_id = ?",
                 (user_id,)
@@ -1865,7 +3201,7 @@ async def is_banned(user_id: int) -> bool:
         return False
 
 async def ban_user(user_id: int, reason: str, admin_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         await db.execute(
             "INSERT OR REPLACE INTO bans (user_id, reason, banned_by) VALUES (?, ?, ?)",
             (user_id, reason, admin_id)
@@ -1873,7 +3209,7 @@ async def ban_user(user_id: int, reason: str, admin_id: int):
         await db.commit()
 
 async def unban_user(user_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         await db.execute(
             "DELETE FROM bans WHERE user_id = ?",
             (user_id,)
@@ -1884,7 +3220,7 @@ async def admin_add_stars(user_id: int, amount: int):
     await add_stars(user_id, amount)
 
 async def admin_add_farm(user_id: int, farm_type: str):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         await db.execute(
             "INSERT INTO farms (user_id, farm_type, last_activated, is_active) VALUES (?, ?, ?, 0)",
             (user_id, farm_type, datetime.now().isoformat())
@@ -1892,29 +3228,41 @@ async def admin_add_farm(user_id: int, farm_type: str):
         await db.commit()
 
 async def admin_add_nft(user_id: int, nft_type: str):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            "INSERT INTO nfts (user_id, nft_type) VALUES (?, ?)",
-            (user_id, nft_type)
-        )
+    # выдача админом идёт сверх лимита, но в счётчик выпуска попадает
+    async with get_db() as db:
+        await _mint_nft(db, user_id, nft_type, enforce_limit=False)
+        await db.commit()
+    _nft_supply_changed()
+    _nfts_changed(user_id)
+
+
+async def grant_nft(user_id: int, nft_type: str) -> bool:
+    """Mints an NFT as a reward; False if the limited edition is sold out."""
+    async with get_db() as db:
+        if not await _mint_nft(db, user_id, nft_type):
+            await db.rollback()
+            return False
         await db.commit()
+    _nft_supply_changed()
+    _nfts_changed(user_id)
+    return True
 
 async def get_all_users() -> List[Dict]:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute("SELECT * FROM users")
         users = await cursor.fetchall()
         return [dict(user) for user in users]
 
 async def get_all_chats() -> List[Dict]:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute("SELECT * FROM chats")
         chats = await cursor.fetchall()
         return [dict(chat) for chat in chats]
 
 async def add_chat(chat_id: int, chat_type: str, title: str = None):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         await db.execute(
             "INSERT OR IGNORE INTO chats (chat_id, chat_type, title) VALUES (?, ?, ?)",
             (chat_id, chat_type, title)
@@ -1922,14 +3270,14 @@ async def add_chat(chat_id: int, chat_type: str, title: str = None):
         await db.commit()
 
 async def get_next_internal_id() -> int:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         cursor = await db.execute("SELECT MAX(internal_id) FROM users WHERE internal_id IS NOT NULL")
         result = await cursor.fetchone()
         max_id = result[0] if result[0] is not None else 0
         return max_id + 1
 
 async def get_user_by_internal_id(internal_id: int) -> Optional[Dict]:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             "SELECT * FROM users WHERE internal_id = ?",
@@ -1950,7 +3298,7 @@ async def get_user_info_by_internal_id(internal_id: int) -> Optional[Dict]:
     return None
 
 async def get_top_by_balance(limit: int = 5) -> List[Dict]:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             "SELECT user_id, stars, internal_id FROM users ORDER BY stars DESC LIMIT ?",
@@ -1959,80 +3307,240 @@ async def get_top_by_balance(limit: int = 5) -> List[Dict]:
         users = await cursor.fetchall()
         return [dict(user) for user in users]
 
-async def get_top_by_income_per_minute(limit: int = 5) -> List[Dict]:
+async def _income_rates_stale(db: aiosqlite.Connection, now: datetime) -> bool:
+    """Whether any user is dirty or past income_until; a plain read through the partial indexes."""
+    cursor = await db.execute(
+        """
+        SELECT EXISTS (SELECT 1 FROM users WHERE income_dirty = 1)
+            OR EXISTS (SELECT 1 FROM users WHERE income_until <= ? AND income_dirty = 0)
+        """,
+        (now.isoformat(),)
+    )
+    return bool((await cursor.fetchone())[0])
+
+
+async def _refresh_income_rates(buff_multiplier: float) -> None:
+    """Brings users.income_rate up to date: reprices on buff change, recomputes dirty/lapsed users.
+
+    Everything is checked with plain reads first; the write lock is taken
+    only when there is something to recompute.
+    """
     from config import FARM_TYPES
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute("SELECT user_id, internal_id FROM users")
-        all_users = await cursor.fetchall()
-        
-        user_incomes = []
-        for user_row in all_users:
-            user_id = user_row['user_id']
-            internal_id = user_row['internal_id']
-            
-            farms = await get_user_farms(user_id)
-            nfts = await get_user_nfts(user_id)
-            boost = await calculate_total_boost(user_id)
-            
-            total_income_per_hour = 0
-            from datetime import datetime
-            now = datetime.now()
-            
-            for farm in farms:
-                is_active = farm.get('is_active', 0)
-                if is_active:
-                    last_activated = farm.get('last_activated')
-                    if last_activated:
-                        last_activated_dt = datetime.fromisoformat(last_activated)
-                        hours_since_activation = (now - last_activated_dt).total_seconds() / 3600
-                        if hours_since_activation < 6:
-                            farm_type = farm['farm_type']
-                            if farm_type in FARM_TYPES:
-                                total_income_per_hour += FARM_TYPES[farm_type]['income_per_hour']
-            
-            total_income_per_hour = int(total_income_per_hour * boost)
-            total_income_per_minute = total_income_per_hour / 60
-            
-            user_incomes.append({
-                'user_id': user_id,
-                'internal_id': internal_id,
-                'income_per_minute': total_income_per_minute
-            })
-        
-        user_incomes.sort(key=lambda x: x['income_per_minute'], reverse=True)
-        return user_incomes[:limit]
+
+    async with get_db() as db:
+        cursor = await db.execute("SELECT buff_multiplier FROM income_rate_state WHERE id = 1")
+        row = await cursor.fetchone()
+        if row is None or row[0] != buff_multiplier:
+            await db.execute("BEGIN IMMEDIATE")
+            # перечитываем под блокировкой: параллельный вызов мог уже переоценить
+            cursor = await db.execute("SELECT buff_multiplier FROM income_rate_state WHERE id = 1")
+            row = await cursor.fetchone()
+            if row is None or row[0] != buff_multiplier:
+                # та же арифметика, что и ниже: int(base * min(boost * buff, 2.5)) / 60
+                await db.execute(
+                    """
+                    UPDATE users
+                    SET income_rate = CAST(income_base * MIN(income_boost * ?, 2.5) AS INTEGER) / 60.0
+                    WHERE income_base > 0
+                    """,
+                    (buff_multiplier,)
+                )
+                await db.execute(
+                    "INSERT OR REPLACE INTO income_rate_state (id, buff_multiplier) VALUES (1, ?)",
+                    (buff_multiplier,)
+                )
+            await db.commit()
+
+    while True:
+        now = datetime.now()
+        cutoff = (now - timedelta(hours=FARM_ACTIVE_HOURS)).isoformat()
+        async with get_db() as db:
+            if not await _income_rates_stale(db, now):
+                return
+            await db.execute("BEGIN IMMEDIATE")
+            cursor = await db.execute(
+                "SELECT user_id, level FROM users WHERE income_dirty = 1 LIMIT ?",
+                (INCOME_REFRESH_BATCH,)
+            )
+            levels = {r['user_id']: r['level'] for r in await cursor.fetchall()}
+            if len(levels) < INCOME_REFRESH_BATCH:
+                cursor = await db.execute(
+                    "SELECT user_id, level FROM users WHERE income_until <= ? AND income_dirty = 0 LIMIT ?",
+                    (now.isoformat(), INCOME_REFRESH_BATCH - len(levels))
+                )
+                levels.update({r['user_id']: r['level'] for r in await cursor.fetchall()})
+            if not levels:
+                await db.rollback()
+                return
+
+            user_ids = list(levels)
+            marks = ",".join("?" * len(user_ids))
+            base = dict.fromkeys(user_ids, 0)
+            until: Dict[int, str] = {}
+            cursor = await db.execute(
+                f"""
+                SELECT user_id, farm_type, COUNT(*) AS cnt, MIN(last_activated) AS first_activated
+                FROM farms
+                WHERE user_id IN ({marks}) AND is_active = 1 AND last_activated > ?
+                GROUP BY user_id, farm_type
+                """,
+                (*user_ids, cutoff)
+            )
+            for r in await cursor.fetchall():
+                if r['farm_type'] not in FARM_TYPES:
+                    continue
+                user_id = r['user_id']
+                base[user_id] += FARM_TYPES[r['farm_type']]['income_per_hour'] * r['cnt']
+                expires = (datetime.fromisoformat(r['first_activated']) + timedelta(hours=FARM_ACTIVE_HOURS)).isoformat()
+                if user_id not in until or expires < until[user_id]:
+                    until[user_id] = expires
+
+            # тот же _nft_boost, что и в calculate_total_boost, чтобы float совпадал до бита
+            holdings: Dict[int, Dict[str, int]] = {user_id: {} for user_id in user_ids}
+            cursor = await db.execute(
+                f"SELECT user_id, nft_type, qty FROM nft_holdings WHERE user_id IN ({marks})",
+                user_ids
+            )
+            for r in await cursor.fetchall():
+                holdings[r['user_id']][r['nft_type']] = r['qty']
+            boost = {user_id: _nft_boost(holdings[user_id]) for user_id in user_ids}
+
+            updates = []
+            for user_id in user_ids:
+                user_boost = boost[user_id] * get_level_bonus_multiplier(int(levels[user_id] or 1))
+                rate = int(base[user_id] * min(user_boost * buff_multiplier, 2.5)) / 60
+                updates.append((base[user_id], user_boost, rate, until.get(user_id), user_id))
+            await db.executemany(
+                """
+                UPDATE users
+                SET income_base = ?, income_boost = ?, income_rate = ?, income_until = ?, income_dirty = 0
+                WHERE user_id = ?
+                """,
+                updates
+            )
+            await db.commit()
+
+        if len(user_ids) < INCOME_REFRESH_BATCH:
+            return
+
+async def get_top_by_income_per_minute(limit: int = 5) -> List[Dict]:
+    buff = None
+    try:
+        buff = await get_active_global_buff()
+    except Exception:
+        pass
+    buff_multiplier = float(buff.get('multiplier', 1.0) or 1.0) if buff else 1.0
+    await _refresh_income_rates(buff_multiplier)
+
+    async with get_db() as db:
+        cursor = await db.execute(
+            """
+            SELECT user_id, internal_id, income_rate AS income_per_minute
+            FROM users
+            ORDER BY income_rate DESC, user_id ASC
+            LIMIT ?
+            """,
+            (limit,)
+        )
+        return [dict(row) for row in await cursor.fetchall()]
 
 async def get_top_by_nft_count(limit: int = 5) -> List[Dict]:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute("""
-            SELECT u.user_id, u.internal_id, COUNT(n.id) as nft_count
-            FROM users u
-            LEFT JOIN nfts n ON u.user_id = n.user_id
-            GROUP BY u.user_id, u.internal_id
-            ORDER BY nft_count DESC
+            SELECT user_id, internal_id, nft_count
+            FROM users
+            ORDER BY nft_count DESC, user_id ASC
             LIMIT ?
         """, (limit,))
         users = await cursor.fetchall()
         return [dict(user) for user in users]
 
 
+def _nft_supply_rows() -> List[tuple]:
+    from config import NFT_GIFTS
+
+    rows = []
+    for nft_type, nft in NFT_GIFTS.items():
+        limit = int(nft.get("limit") or 0)
+        rows.append((nft_type, limit if limit > 0 else None))
+    return rows
+
+
+async def _fill_nft_supply(db: aiosqlite.Connection, rows: List[tuple], digest: str) -> None:
+    """Makes sure every configured NFT has a supply row and the current limit; caller commits."""
+    await db.executemany(
+        """
+        INSERT INTO nft_supply (nft_type, minted, max_supply) VALUES (?, 0, ?)
+        ON CONFLICT (nft_type) DO UPDATE SET max_supply = excluded.max_supply
+        """,
+        rows
+    )
+    await _store_config_hash(db, "nft_supply", digest)
+
+
+async def _sync_nft_supply(db: aiosqlite.Connection) -> None:
+    """Applies NFT limits from config if they changed since the last sync."""
+    rows = _nft_supply_rows()
+    digest = _config_hash(rows)
+    if not await _config_changed(db, "nft_supply", digest):
+        return
+    await db.execute("BEGIN IMMEDIATE")
+    await _fill_nft_supply(db, rows, digest)
+    await db.commit()
+    _nft_supply_changed()
+
+
+async def _mint_nft(db: aiosqlite.Connection, user_id: int, nft_type: str, enforce_limit: bool = True) -> bool:
+    """Reserves one unit of supply and gives the NFT; False if sold out. Caller commits."""
+    cursor = await db.execute(
+        """
+        INSERT INTO nft_supply (nft_type, minted) VALUES (?, 1)
+        ON CONFLICT (nft_type) DO UPDATE SET minted = minted + 1
+        WHERE ? = 0 OR max_supply IS NULL OR minted < max_supply
+        """,
+        (nft_type, 1 if enforce_limit else 0)
+    )
+    if cursor.rowcount != 1:
+        return False
+    await db.execute("INSERT INTO nfts (user_id, nft_type) VALUES (?, ?)", (user_id, nft_type))
+    return True
+
+
+# nft_type -> {'minted', 'limit'}; сбрасывается после каждого выпуска
+_nft_supply_cache: Optional[Dict[str, Dict]] = None
+_nft_supply_generation = 0
+
+
+def _nft_supply_changed() -> None:
+    global _nft_supply_cache, _nft_supply_generation
+    _nft_supply_cache = None
+    _nft_supply_generation += 1
+
+
+async def get_nft_supply() -> Dict[str, Dict]:
+    """{nft_type: {'minted': n, 'limit': max_supply or None}} for all NFT types."""
+    global _nft_supply_cache
+    if _nft_supply_cache is not None:
+        return _nft_supply_cache
+    generation = _nft_supply_generation
+    async with get_db() as db:
+        cursor = await db.execute("SELECT nft_type, minted, max_supply FROM nft_supply")
+        supply = {r[0]: {'minted': int(r[1]), 'limit': r[2]} for r in await cursor.fetchall()}
+    if generation == _nft_supply_generation:
+        _nft_supply_cache = supply
+    return supply
+
+
 async def get_total_nft_count(nft_type: Optional[str] = None) -> int:
     """Returns total minted NFT count.
 
     If nft_type is provided, returns count only for that nft_type.
     """
-    async with aiosqlite.connect(DB_NAME) as db:
-        if nft_type:
-            cursor = await db.execute(
-                "SELECT COUNT(*) FROM nfts WHERE nft_type = ?",
-                (str(nft_type),)
-            )
-        else:
-            cursor = await db.execute("SELECT COUNT(*) FROM nfts")
-        row = await cursor.fetchone()
-        return int(row[0] or 0)
+    supply = await get_nft_supply()
+    if nft_type:
+        return supply.get(str(nft_type), {}).get('minted', 0)
+    return sum(s['minted'] for s in supply.values())
 
 
 async def _is_saturday_now() -> bool:
@@ -2064,7 +3572,7 @@ async def get_or_create_saturday_offers() -> None:
     from config import SATURDAY_FARM_POOL
 
     offer_date = datetime.now().date().isoformat()
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         await db.execute("BEGIN IMMEDIATE")
 
@@ -2101,7 +3609,7 @@ async def get_or_create_saturday_offers() -> None:
 
 async def get_active_saturday_offers() -> List[Dict]:
     offer_date = datetime.now().date().isoformat()
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             """
@@ -2121,7 +3629,7 @@ async def buy_saturday_offer(user_id: int, offer_id: int) -> Tuple[bool, str]:
         return False, "Сегодня субботнего магазина нет"
 
     offer_date = datetime.now().date().isoformat()
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             """
@@ -2141,21 +3649,20 @@ async def buy_saturday_offer(user_id: int, offer_id: int) -> Tuple[bool, str]:
     farm_key = str(offer.get('farm_key'))
     name = str(offer.get('name', farm_key))
 
-    if pc > 0:
-        ok = await spend_crystals(user_id, pc)
-        if not ok:
-            return False, "Недостаточно кристаллов"
-    else:
-        ok = await spend_stars(user_id, ps)
-        if not ok:
+    async with get_db() as db:
+        if pc > 0:
+            if not await _debit(db, user_id, crystals=pc):
+                await db.rollback()
+                return False, "Недостаточно кристаллов"
+        elif not await _debit(db, user_id, stars=ps):
+            await db.rollback()
             return False, "Недостаточно звезд"
-
-    async with aiosqlite.connect(DB_NAME) as db:
         await db.execute(
             "INSERT INTO farms (user_id, farm_type, last_activated, is_active) VALUES (?, ?, ?, 0)",
             (user_id, farm_key, datetime.now().isoformat()),
         )
         await db.commit()
+    _invalidate_user(user_id)
 
     return True, f"Куплено: {name}"
 
@@ -2167,6 +3674,36 @@ def _current_season_key() -> str:
     return f"{iso_year}-W{int(iso_week):02d}"
 
 
+async def ensure_season_snapshots(season_key: Optional[str] = None) -> None:
+    """Snapshots every user's balance for the season, once per season."""
+    global _snapshot_season_key
+    season_key = season_key or _current_season_key()
+    if _snapshot_season_key == season_key:
+        return
+
+    async with get_db() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        cursor = await db.execute("SELECT snapshot_at FROM seasons WHERE season_key = ?", (season_key,))
+        row = await cursor.fetchone()
+        if not row or row[0] is None:
+            await db.execute(
+                """
+                INSERT OR IGNORE INTO season_snapshots (user_id, season_key, start_stars)
+                SELECT user_id, ?, COALESCE(stars, 0) FROM users
+                """,
+                (season_key,)
+            )
+            await db.execute(
+                """
+                INSERT INTO seasons (season_key, snapshot_at, ends_at) VALUES (?, CURRENT_TIMESTAMP, ?)
+                ON CONFLICT (season_key) DO UPDATE SET snapshot_at = excluded.snapshot_at
+                """,
+                (season_key, _season_ends_at(season_key))
+            )
+        await db.commit()
+    _snapshot_season_key = season_key
+
+
 async def get_top_by_season_score(limit: int = 50) -> List[Dict]:
     limit = int(limit or 50)
     if limit <= 0:
@@ -2175,35 +3712,18 @@ async def get_top_by_season_score(limit: int = 50) -> List[Dict]:
         limit = 200
 
     season_key = _current_season_key()
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        users_cur = await db.execute("SELECT user_id, internal_id, stars FROM users")
-        users = await users_cur.fetchall()
-
-        # ensure snapshot exists for this season for all users
-        await db.execute("BEGIN IMMEDIATE")
-        for u in users:
-            uid = int(u[0])  # user_id is the first column
-            stars = int(u[2] or 0)  # stars is the third column
-            cursor = await db.execute(
-                "SELECT 1 FROM season_snapshots WHERE user_id = ? AND season_key = ? LIMIT 1",
-                (uid, season_key),
-            )
-            if not await cursor.fetchone():
-                await db.execute(
-                    "INSERT INTO season_snapshots (user_id, season_key, start_stars) VALUES (?, ?, ?)",
-                    (uid, season_key, stars),
-                )
-        await db.commit()
+    await ensure_season_snapshots(season_key)
 
+    async with get_db() as db:
+        db.row_factory = aiosqlite.Row
         snap_cur = await db.execute(
             """
             SELECT u.user_id, u.internal_id, u.stars,
                    (u.stars - s.start_stars) AS season_score
-            FROM users u
-            JOIN season_snapshots s
-              ON s.user_id = u.user_id AND s.season_key = ?
-            ORDER BY season_score DESC
+            FROM season_snapshots s
+            JOIN users u ON u.user_id = s.user_id
+            WHERE s.season_key = ?
+            ORDER BY season_score DESC, s.user_id ASC
             LIMIT ?
             """,
             (season_key, limit),
@@ -2220,6 +3740,248 @@ async def get_top_by_season_score(limit: int = 50) -> List[Dict]:
         ]
 
 
+async def _sync_ranks() -> None:
+    """Brings the in-memory leaderboards up to date: full load on a new season, else dirty users only."""
+    global _ranks_season_key
+    season_key = _current_season_key()
+    await ensure_season_snapshots(season_key)
+
+    async with _ranks_lock:
+        if _ranks_season_key != season_key:
+            _rank_dirty.clear()
+            async with get_db() as db:
+                cursor = await db.execute("SELECT user_id, COALESCE(stars, 0) FROM users")
+                _balance_ranks.build(await cursor.fetchall())
+                cursor = await db.execute(
+                    """
+                    SELECT s.user_id, COALESCE(u.stars, 0) - s.start_stars
+                    FROM season_snapshots s
+                    JOIN users u ON u.user_id = s.user_id
+                    WHERE s.season_key = ?
+                    """,
+                    (season_key,)
+                )
+                _season_ranks.build(await cursor.fetchall())
+            _ranks_season_key = season_key
+            return
+
+        if not _rank_dirty:
+            return
+        dirty = list(_rank_dirty)
+        _rank_dirty.clear()
+        async with get_db() as db:
+            for i in range(0, len(dirty), 500):
+                chunk = dirty[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                cursor = await db.execute(
+                    f"""
+                    SELECT u.user_id, COALESCE(u.stars, 0) AS stars, s.start_stars
+                    FROM users u
+                    LEFT JOIN season_snapshots s ON s.user_id = u.user_id AND s.season_key = ?
+                    WHERE u.user_id IN ({placeholders})
+                    """,
+                    (season_key, *chunk)
+                )
+                found = set()
+                for r in await cursor.fetchall():
+                    found.add(r['user_id'])
+                    _balance_ranks.update(r['user_id'], r['stars'])
+                    if r['start_stars'] is None:
+                        _season_ranks.remove(r['user_id'])
+                    else:
+                        _season_ranks.update(r['user_id'], r['stars'] - r['start_stars'])
+                for user_id in chunk:
+                    if user_id not in found:
+                        _balance_ranks.remove(user_id)
+                        _season_ranks.remove(user_id)
+
+
+def _ranks_for(board: str) -> RankIndex:
+    if board == "balance":
+        return _balance_ranks
+    if board == "season":
+        return _season_ranks
+    raise ValueError(f"unknown leaderboard: {board}")
+
+
+async def get_leaderboard_rank(user_id: int, board: str = "season") -> Optional[Dict]:
+    """Place of the user on the board ("season" or "balance"), or None if not ranked."""
+    ranks = _ranks_for(board)
+    await _sync_ranks()
+    rank = ranks.get_rank(user_id)
+    if rank is None:
+        return None
+    return {'rank': rank, 'score': ranks.get_score(user_id), 'total': len(ranks)}
+
+
+async def get_leaderboard_page(offset: int = 0, limit: int = 50, board: str = "season") -> List[Dict]:
+    ranks = _ranks_for(board)
+    await _sync_ranks()
+    offset = max(int(offset or 0), 0)
+    return [
+        {'rank': offset + i, 'user_id': user_id, 'score': score}
+        for i, (user_id, score) in enumerate(ranks.get_page(offset, limit), start=1)
+    ]
+
+
+def _season_end(season_key: str) -> datetime:
+    """Start of the Monday after the season's ISO week."""
+    year, week = season_key.split("-W")
+    start = datetime.fromisocalendar(int(year), int(week), 1)
+    return start + timedelta(days=7)
+
+
+def _season_ends_at(season_key: str) -> str:
+    # в формате datetime('now', 'localtime'), с которым его сравнивает trg_users_season_close
+    return _season_end(season_key).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _seconds_until_next_season() -> float:
+    now = datetime.now()
+    next_monday = (now + timedelta(days=7 - now.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+    return (next_monday - now).total_seconds()
+
+
+async def _archive_season(db: aiosqlite.Connection, season_key: str, next_season_key: str) -> List[int]:
+    """Archives the season's top, pays rewards, opens the next season; returns rewarded user ids.
+
+    Scores use the balance at the season's end (end_stars, else the unchanged
+    users.stars), so the result does not depend on how late this runs.
+    """
+    from config import SEASON_REWARDS, SEASON_ARCHIVE_TOP
+
+    cursor = await db.execute(
+        """
+        SELECT s.user_id, u.internal_id, (COALESCE(s.end_stars, u.stars) - s.start_stars) AS season_score
+        FROM season_snapshots s
+        JOIN users u ON u.user_id = s.user_id
+        WHERE s.season_key = ?
+        ORDER BY season_score DESC, s.user_id ASC
+        LIMIT ?
+        """,
+        (season_key, SEASON_ARCHIVE_TOP)
+    )
+    archive = []
+    for rank, r in enumerate(await cursor.fetchall(), start=1):
+        score = int(r['season_score'] or 0)
+        reward = int(SEASON_REWARDS[rank - 1]) if rank <= len(SEASON_REWARDS) and score > 0 else 0
+        archive.append((season_key, rank, r['user_id'], r['internal_id'], score, reward))
+    await db.executemany(
+        """
+        INSERT INTO season_archive (season_key, rank, user_id, internal_id, season_score, reward_stars)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        archive
+    )
+
+    # снимок нового сезона до начисления наград, чтобы награда не считалась приростом;
+    # новый сезон начинается с баланса на границе, даже если снимок уже сделан позже неё
+    await db.execute(
+        """
+        INSERT OR IGNORE INTO season_snapshots (user_id, season_key, start_stars)
+        SELECT u.user_id, ?, COALESCE(s.end_stars, u.stars, 0)
+        FROM users u
+        LEFT JOIN season_snapshots s ON s.user_id = u.user_id AND s.season_key = ?
+        """,
+        (next_season_key, season_key)
+    )
+    await db.execute(
+        """
+        UPDATE season_snapshots SET start_stars = (
+            SELECT s.end_stars FROM season_snapshots s
+            WHERE s.user_id = season_snapshots.user_id AND s.season_key = :season
+        )
+        WHERE season_key = :next_season AND user_id IN (
+            SELECT user_id FROM season_snapshots WHERE season_key = :season AND end_stars IS NOT NULL
+        )
+        """,
+        {"season": season_key, "next_season": next_season_key}
+    )
+    await db.execute(
+        """
+        INSERT INTO seasons (season_key, snapshot_at, ends_at) VALUES (?, CURRENT_TIMESTAMP, ?)
+        ON CONFLICT (season_key) DO UPDATE SET snapshot_at = COALESCE(snapshot_at, excluded.snapshot_at)
+        """,
+        (next_season_key, _season_ends_at(next_season_key))
+    )
+
+    rewarded = "SELECT user_id FROM season_archive WHERE season_key = :season AND reward_stars > 0"
+    reward_of = (
+        "(SELECT reward_stars FROM season_archive a "
+        "WHERE a.season_key = :season AND a.user_id = {}.user_id)"
+    )
+    params = {"season": season_key, "next_season": next_season_key}
+    await db.execute(
+        f"UPDATE users SET stars = stars + {reward_of.format('users')} WHERE user_id IN ({rewarded})",
+        params
+    )
+    await db.execute(
+        f"""
+        UPDATE season_snapshots SET start_stars = start_stars + {reward_of.format('season_snapshots')}
+        WHERE season_key = :next_season AND user_id IN ({rewarded})
+        """,
+        params
+    )
+
+    await db.execute("DELETE FROM season_snapshots WHERE season_key <= ?", (season_key,))
+    await db.execute(
+        """
+        INSERT INTO seasons (season_key, archived_at) VALUES (?, CURRENT_TIMESTAMP)
+        ON CONFLICT (season_key) DO UPDATE SET archived_at = excluded.archived_at
+        """,
+        (season_key,)
+    )
+    # более старые незакрытые сезоны (бот был выключен) не награждаем — итоги уже не восстановить
+    await db.execute(
+        "UPDATE seasons SET archived_at = CURRENT_TIMESTAMP WHERE season_key < ? AND archived_at IS NULL",
+        (season_key,)
+    )
+    return [row[2] for row in archive if row[5] > 0]
+
+
+async def rollover_season() -> Optional[str]:
+    """Closes the most recent finished season, if any; returns its key."""
+    global _snapshot_season_key, _ranks_season_key
+    current = _current_season_key()
+    async with get_db() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        cursor = await db.execute(
+            """
+            SELECT season_key FROM seasons
+            WHERE season_key < ? AND archived_at IS NULL
+            ORDER BY season_key DESC LIMIT 1
+            """,
+            (current,)
+        )
+        row = await cursor.fetchone()
+        if not row:
+            await db.rollback()
+            return None
+        season_key = row[0]
+        rewarded = await _archive_season(db, season_key, current)
+        await db.commit()
+
+    _invalidate_user(*rewarded)
+    _season_archive_cache.clear()
+    _snapshot_season_key = current
+    # стартовые балансы нового сезона могли быть пересчитаны — доску сезона строим заново
+    async with _ranks_lock:
+        _ranks_season_key = None
+    logger.info("Season %s archived, %d players rewarded", season_key, len(rewarded))
+    return season_key
+
+
+async def _season_rollover_loop() -> None:
+    while True:
+        try:
+            await rollover_season()
+            await ensure_season_snapshots()
+        except Exception as e:
+            logger.warning(f"Season rollover failed: {e}")
+        # просыпаемся на границе недели, но не реже раза в час
+        await asyncio.sleep(min(_seconds_until_next_season() + 1, 3600))
+
+
 async def get_season_archive(limit_seasons: int = 5, limit_rows: int = 10) -> List[Dict]:
     limit_seasons = int(limit_seasons or 5)
     limit_rows = int(limit_rows or 10)
@@ -2230,80 +3992,338 @@ async def get_season_archive(limit_seasons: int = 5, limit_rows: int = 10) -> Li
     if limit_rows > 50:
         limit_rows = 50
 
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        seasons_cur = await db.execute(
-            "SELECT DISTINCT season_key FROM season_archive ORDER BY season_key DESC LIMIT ?",
-            (limit_seasons,),
-        )
-        seasons = [r[0] for r in await seasons_cur.fetchall()]
-        if not seasons:
-            return []
+    cached = _season_archive_cache.get((limit_seasons, limit_rows))
+    if cached is not None:
+        return cached
 
-        result: List[Dict] = []
-        for sk in seasons:
-            rows_cur = await db.execute(
-                """
-                SELECT rank, internal_id, season_score, reward_stars
-                FROM season_archive
-                WHERE season_key = ?
-                ORDER BY rank ASC
+    async with get_db() as db:
+        cursor = await db.execute(
+            """
+            WITH recent AS (
+                SELECT DISTINCT season_key FROM season_archive
+                ORDER BY season_key DESC
                 LIMIT ?
-                """,
-                (sk, limit_rows),
+            ),
+            ranked AS (
+                SELECT a.season_key, a.rank, a.user_id, a.internal_id, a.season_score, a.reward_stars,
+                       ROW_NUMBER() OVER (PARTITION BY a.season_key ORDER BY a.rank) AS rn
+                FROM season_archive a
+                WHERE a.season_key IN recent
             )
-            rows = await rows_cur.fetchall()
-            result.append({'season': sk, 'rows': [dict(r) for r in rows]})
-        return result
+            SELECT season_key, rank, user_id, internal_id, season_score, reward_stars
+            FROM ranked
+            WHERE rn <= ?
+            ORDER BY season_key DESC, rn ASC
+            """,
+            (limit_seasons, limit_rows),
+        )
+        rows = await cursor.fetchall()
 
+    result: List[Dict] = []
+    for r in rows:
+        if not result or result[-1]['season'] != r['season_key']:
+            result.append({'season': r['season_key'], 'rows': []})
+        result[-1]['rows'].append({
+            'rank': r['rank'],
+            'user_id': r['user_id'],
+            'internal_id': r['internal_id'],
+            'season_score': r['season_score'],
+            'reward_stars': r['reward_stars'],
+        })
+    _season_archive_cache[(limit_seasons, limit_rows)] = result
+    return result
 
-async def increment_user_stat(user_id: int, stat: str, amount: int = 1) -> None:
-    stat = (stat or '').strip()
-    if not stat:
-        return
-    amount = int(amount or 0)
-    if amount == 0:
-        return
-    if stat not in ('stars_collected', 'farms_bought', 'cases_opened'):
-        return
 
-    async with aiosqlite.connect(DB_NAME) as db:
+USER_STATS = ('stars_collected', 'farms_bought', 'cases_opened')
+_achievement_index: Optional[AchievementIndex] = None
+
+
+def _get_achievement_index() -> AchievementIndex:
+    global _achievement_index
+    if _achievement_index is None:
+        from config import ACHIEVEMENTS
+        _achievement_index = AchievementIndex(ACHIEVEMENTS)
+    return _achievement_index
+
+
+async def _grant_achievements(db: aiosqlite.Connection, user_id: int, achievements: List[Dict]) -> List[Dict]:
+    """Records achievements and credits their rewards; returns the newly granted ones. Caller commits.
+
+    Like the backfill in _grant_reached_achievements, the star reward is added
+    to the current season snapshot too: rewards are not season progress.
+    """
+    granted = []
+    for a in achievements:
+        cursor = await db.execute(
+            "INSERT OR IGNORE INTO user_achievements (user_id, achievement_id) VALUES (?, ?)",
+            (user_id, str(a.get('id')))
+        )
+        if cursor.rowcount == 1:
+            granted.append(a)
+    stars = sum(int(a.get('reward_stars', 0) or 0) for a in granted)
+    crystals = sum(int(a.get('reward_crystals', 0) or 0) for a in granted)
+    if stars or crystals:
         await db.execute(
-            "INSERT OR IGNORE INTO user_stats (user_id) VALUES (?)",
-            (int(user_id),),
+            "UPDATE users SET stars = stars + ?, crystals = COALESCE(crystals, 0) + ? WHERE user_id = ?",
+            (stars, crystals, user_id)
         )
+    if stars:
         await db.execute(
-            f"UPDATE user_stats SET {stat} = {stat} + ? WHERE user_id = ?",
-            (amount, int(user_id)),
+            "UPDATE season_snapshots SET start_stars = start_stars + ? WHERE user_id = ? AND season_key = ?",
+            (stars, user_id, _current_season_key())
         )
-        await db.commit()
+    return granted
 
 
-async def get_user_stats(user_id: int) -> Dict:
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            "SELECT stars_collected, farms_bought, cases_opened FROM user_stats WHERE user_id = ?",
-            (int(user_id),),
+def _achievement_rows() -> List[tuple]:
+    return sorted(
+        (str(a['id']), a['stat'], int(a['target']))
+        for a in _get_achievement_index().all() if a['stat'] in USER_STATS
+    )
+
+
+async def _grant_reached_achievements(db: aiosqlite.Connection, rows: List[tuple], digest: str) -> None:
+    """Grants every achievement a player's stats already reach, once; caller commits.
+
+    The reward is added to the player's current season snapshot as well, so the
+    payout does not count as season progress (same as _grant_achievements).
+    """
+    from config import ACHIEVEMENTS
+
+    rewards = {str(a['id']): a for a in ACHIEVEMENTS}
+    for aid, stat, target in rows:
+        missing = f"""
+            SELECT s.user_id FROM user_stats s
+            WHERE s.{stat} >= ? AND NOT EXISTS (
+                SELECT 1 FROM user_achievements ua WHERE ua.user_id = s.user_id AND ua.achievement_id = ?
+            )
+        """
+        reward_stars = int(rewards[aid].get('reward_stars', 0) or 0)
+        reward_crystals = int(rewards[aid].get('reward_crystals', 0) or 0)
+        # сначала награда, потом запись — иначе NOT EXISTS уже не найдёт этих игроков
+        if reward_stars or reward_crystals:
+            await db.execute(
+                f"""UPDATE users SET stars = stars + ?, crystals = COALESCE(crystals, 0) + ?
+                    WHERE user_id IN ({missing})""",
+                (reward_stars, reward_crystals, target, aid)
+            )
+        if reward_stars:
+            await db.execute(
+                f"""UPDATE season_snapshots SET start_stars = start_stars + ?
+                    WHERE season_key = ? AND user_id IN ({missing})""",
+                (reward_stars, _current_season_key(), target, aid)
+            )
+        await db.execute(
+            f"INSERT OR IGNORE INTO user_achievements (user_id, achievement_id) SELECT user_id, ? FROM ({missing})",
+            (aid, target, aid)
         )
-        row = await cursor.fetchone()
-        if not row:
-            return {'stars_collected': 0, 'farms_bought': 0, 'cases_opened': 0}
-        d = dict(row)
-        d['stars_collected'] = int(d.get('stars_collected', 0) or 0)
-        d['farms_bought'] = int(d.get('farms_bought', 0) or 0)
-        d['cases_opened'] = int(d.get('cases_opened', 0) or 0)
-        return d
+    await _store_config_hash(db, "achievements", digest)
+
+
+async def _sync_achievements(db: aiosqlite.Connection) -> None:
+    """Grants already reached achievements if the achievement list changed since the last sync."""
+    rows = _achievement_rows()
+    digest = _config_hash(rows)
+    if not await _config_changed(db, "achievements", digest):
+        return
+    await db.execute("BEGIN IMMEDIATE")
+    await _grant_reached_achievements(db, rows, digest)
+    await db.commit()
+    logger.info("Achievements synced with config")
+
+
+# Счётчики user_stats пишутся отложенно: прирост копится в _stat_deltas и уходит
+# одним executemany раз в STAT_FLUSH_MS. _stat_values хранит текущие значения
+# (записанное + ожидающее), по ним же ищутся пересечённые пороги достижений;
+# открытые достижения и награды пишутся тем же сбросом, в одной транзакции с приростом.
+# Игрок с незаписанным приростом (в очереди или в записи) из кэша не вытесняется,
+# поэтому для игрока вне кэша строка в базе всегда точна.
+_stat_values: "OrderedDict[int, Dict[str, int]]" = OrderedDict()
+_stat_deltas: Dict[int, Dict[str, int]] = {}
+_stat_unlocks: Dict[int, List[Dict]] = {}
+_stat_unlocks_writing: Dict[int, List[Dict]] = {}
+_stat_inflight: Dict[int, int] = {}
+_stat_loading: Dict[int, asyncio.Future] = {}
+_stat_flush_timer: Optional[asyncio.TimerHandle] = None
+_stat_flush_lock = asyncio.Lock()  # только между сбросами; инкременты его не ждут
+
+
+def _add_stat_delta(pending: Dict[int, Dict[str, int]], user_id: int, delta: Dict[str, int]) -> None:
+    row = pending.setdefault(user_id, dict.fromkeys(USER_STATS, 0))
+    for stat, value in delta.items():
+        row[stat] += value
+
+
+def _trim_stat_values() -> None:
+    excess = len(_stat_values) - USER_CACHE_SIZE
+    if excess <= 0:
+        return
+    # последнюю запись не трогаем: её только что загрузили под инкремент
+    for user_id in list(_stat_values)[:-1]:
+        if user_id not in _stat_deltas and user_id not in _stat_inflight:
+            del _stat_values[user_id]
+            excess -= 1
+            if not excess:
+                break
+
+
+@asynccontextmanager
+async def _stat_write(user_ids):
+    """Pins users in the cache while their deltas are being written."""
+    for user_id in user_ids:
+        _stat_inflight[user_id] = _stat_inflight.get(user_id, 0) + 1
+    try:
+        yield
+    finally:
+        for user_id in user_ids:
+            if _stat_inflight[user_id] == 1:
+                del _stat_inflight[user_id]
+            else:
+                _stat_inflight[user_id] -= 1
+        _trim_stat_values()
+
+
+async def _load_user_stats(user_id: int) -> Dict[str, int]:
+    """Current stats of a user (stored + pending), cached; concurrent loads share one read."""
+    while True:
+        values = _stat_values.get(user_id)
+        if values is not None:
+            _stat_values.move_to_end(user_id)
+            return values
+        loading = _stat_loading.get(user_id)
+        if loading is None:
+            break
+        await asyncio.shield(loading)
+
+    loading = asyncio.get_running_loop().create_future()
+    _stat_loading[user_id] = loading
+    try:
+        async with get_db() as db:
+            cursor = await db.execute(
+                f"SELECT {', '.join(USER_STATS)} FROM user_stats WHERE user_id = ?", (user_id,)
+            )
+            row = await cursor.fetchone()
+        values = {stat: int((row[i] if row else 0) or 0) for i, stat in enumerate(USER_STATS)}
+        _stat_values[user_id] = values
+        _trim_stat_values()
+        return values
+    finally:
+        # при ошибке ожидающие просто повторят загрузку сами
+        del _stat_loading[user_id]
+        loading.set_result(None)
+
+
+def _upsert_stats_sql() -> str:
+    columns = ', '.join(USER_STATS)
+    updates = ', '.join(f"{stat} = {stat} + excluded.{stat}" for stat in USER_STATS)
+    return (
+        f"INSERT INTO user_stats (user_id, {columns}) VALUES (?{', ?' * len(USER_STATS)}) "
+        f"ON CONFLICT (user_id) DO UPDATE SET {updates}"
+    )
+
+
+def _stat_rows(pending: Dict[int, Dict[str, int]]) -> List[tuple]:
+    return [(user_id, *(delta[stat] for stat in USER_STATS)) for user_id, delta in pending.items()]
+
+
+def _schedule_stat_flush() -> None:
+    global _stat_flush_timer
+    if _stat_flush_timer is None:
+        _stat_flush_timer = asyncio.get_running_loop().call_later(STAT_FLUSH_MS / 1000, _start_stat_flush)
+
+
+def _start_stat_flush() -> None:
+    global _stat_flush_timer
+    _stat_flush_timer = None
+    task = asyncio.get_running_loop().create_task(_flush_user_stats_safe())
+    _flush_tasks.add(task)
+    task.add_done_callback(_flush_tasks.discard)
+
+
+async def _flush_user_stats_safe() -> None:
+    try:
+        await flush_user_stats()
+    except Exception as e:
+        logger.error(f"User stats flush failed: {e}")
+        _schedule_stat_flush()
+
+
+async def flush_user_stats() -> None:
+    """Writes pending stat deltas and the unlocks they caused in one transaction."""
+    async with _stat_flush_lock:
+        await _flush_user_stats_locked()
+
+
+async def _flush_user_stats_locked() -> None:
+    global _stat_deltas, _stat_unlocks, _stat_unlocks_writing
+    if not _stat_deltas and not _stat_unlocks:
+        return
+    pending, _stat_deltas = _stat_deltas, {}
+    unlocks, _stat_unlocks = _stat_unlocks, {}
+    _stat_unlocks_writing = unlocks
+    async with _stat_write(list(pending)):
+        try:
+            async with get_db() as db:
+                await db.execute("BEGIN IMMEDIATE")
+                await db.executemany(_upsert_stats_sql(), _stat_rows(pending))
+                for user_id, achievements in unlocks.items():
+                    await _grant_achievements(db, user_id, achievements)
+                await db.commit()
+        except Exception:
+            for user_id, delta in pending.items():
+                _add_stat_delta(_stat_deltas, user_id, delta)
+            for user_id, achievements in unlocks.items():
+                _stat_unlocks.setdefault(user_id, []).extend(achievements)
+            raise
+        finally:
+            _stat_unlocks_writing = {}
+    if unlocks:
+        _invalidate_user(*unlocks)
+
+
+async def increment_user_stat(user_id: int, stat: str, amount: int = 1) -> Tuple[int, List[Dict]]:
+    """Adds to a stat; returns (new value, newly unlocked achievements).
+
+    Thresholds are checked against the in-memory value; the delta, the
+    user_achievements rows and the rewards are written by the next flush,
+    in one transaction.
+    """
+    stat = (stat or '').strip()
+    amount = int(amount or 0)
+    if stat not in USER_STATS:
+        return 0, []
+
+    user_id = int(user_id)
+    values = await _load_user_stats(user_id)
+    old = values[stat]
+    if amount == 0:
+        return old, []
+    values[stat] = old + amount
+    _add_stat_delta(_stat_deltas, user_id, {stat: amount})
+    unlocked = _get_achievement_index().crossed(stat, old, old + amount)
+    if unlocked:
+        _stat_unlocks.setdefault(user_id, []).extend(unlocked)
+    _schedule_stat_flush()
+    return old + amount, unlocked
+
+
+async def get_user_stats(user_id: int) -> Dict:
+    """Stats with pending deltas merged in."""
+    return dict(await _load_user_stats(int(user_id)))
 
 
 async def get_user_achievement_ids(user_id: int) -> List[str]:
-    async with aiosqlite.connect(DB_NAME) as db:
+    """Granted achievement ids, including unlocks still waiting for the flush."""
+    async with get_db() as db:
         cursor = await db.execute(
             "SELECT achievement_id FROM user_achievements WHERE user_id = ?",
             (int(user_id),),
         )
-        rows = await cursor.fetchall()
-        return [str(r[0]) for r in rows]
+        ids = [str(r[0]) for r in await cursor.fetchall()]
+    for a in _stat_unlocks.get(int(user_id), []) + _stat_unlocks_writing.get(int(user_id), []):
+        if str(a.get('id')) not in ids:
+            ids.append(str(a.get('id')))
+    return ids
 
 
 async def create_nft_listing(user_id: int, nft_type: str, price: int, fee_pct: float = 0.0) -> Tuple[bool, str]:
@@ -2318,7 +4338,7 @@ async def create_nft_listing(user_id: int, nft_type: str, price: int, fee_pct: f
     if fee_pct < 0 or fee_pct > 100:
         fee_pct = 0.0
 
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         # Проверяем, есть ли у пользователя NFT такого типа
         cursor = await db.execute(
             "SELECT id FROM nfts WHERE user_id = ? AND nft_type = ? LIMIT 1",
@@ -2344,6 +4364,7 @@ async def create_nft_listing(user_id: int, nft_type: str, price: int, fee_pct: f
         )
         
         await db.commit()
+        _nfts_changed(user_id)
         return True, f" NFT {nft_type} выставлен на продажу за {price}"
             
 async def get_active_nft_listings(limit: int = 25, offset: int = 0) -> List[Dict]:
@@ -2353,7 +4374,7 @@ async def get_active_nft_listings(limit: int = 25, offset: int = 0) -> List[Dict
     limit = max(1, min(int(limit or 25), 100))
     offset = max(0, int(offset or 0))
     
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             """
@@ -2378,19 +4399,18 @@ async def buy_nft_listing(buyer_id: int, listing_id: int) -> Tuple[bool, str]:
     if not listing_id or not buyer_id:
         return False, " Некорректные параметры"
     
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         await db.execute("BEGIN IMMEDIATE")
         
         try:
             # Получаем объявление
             cursor = await db.execute(
                 """
-                SELECT l.*, u.stars as buyer_stars
+                SELECT l.*
                 FROM nft_listings l
-                JOIN users u ON u.user_id = ?
                 WHERE l.id = ? AND l.status = 'active' AND l.seller_id != ?
                 """,
-                (buyer_id, listing_id, buyer_id)
+                (listing_id, buyer_id)
             )
             listing = await cursor.fetchone()
             
@@ -2403,20 +4423,14 @@ async def buy_nft_listing(buyer_id: int, listing_id: int) -> Tuple[bool, str]:
             nft_type = listing['nft_type']
             fee_pct = float(listing.get('fee_pct', 0.0))
             
-            # Проверяем баланс покупателя
-            buyer_stars = int(listing.get('buyer_stars', 0))
-            if buyer_stars < price:
-                return False, f" Недостаточно звёзд. Нужно: {price} "
-            
             # Вычисляем комиссию
             fee_amount = int(price * (fee_pct / 100.0))
             seller_gets = price - fee_amount
             
-            # Списание у покупателя
-            await db.execute(
-                "UPDATE users SET stars = stars - ? WHERE user_id = ?",
-                (price, buyer_id)
-            )
+            # Списание у покупателя (с проверкой баланса)
+            if not await _debit(db, buyer_id, stars=price):
+                await db.rollback()
+                return False, f" Недостаточно звёзд. Нужно: {price} "
             
             # Зачисление продавцу (за вычетом комиссии)
             if seller_gets > 0:
@@ -2444,6 +4458,8 @@ async def buy_nft_listing(buyer_id: int, listing_id: int) -> Tuple[bool, str]:
             )
             
             await db.commit()
+            _invalidate_user(seller_id)
+            _nfts_changed(buyer_id)
             return True, f" Вы купили NFT {nft_type} за {price} "
             
         except Exception as e:
@@ -2464,17 +4480,16 @@ async def upgrade_farm(farm_id: int, user_id: int) -> Tuple[bool, str]:
         (1.0, 0.50, 0)      # 50% chance for no boost (зеленый)
     ]
     
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_db() as db:
         db.row_factory = aiosqlite.Row
+        await db.execute("BEGIN IMMEDIATE")
         cursor = await db.execute(
             """
             SELECT f.id, f.user_id, f.farm_type, 
                    COALESCE(fu.income_boost, 1.0) as income_boost,
-                   COALESCE(fu.upgrade_level, 0) as upgrade_level,
-                   u.stars
+                   COALESCE(fu.upgrade_level, 0) as upgrade_level
             FROM farms f
             LEFT JOIN farm_upgrades fu ON f.id = fu.farm_id
-            JOIN users u ON f.user_id = u.user_id
             WHERE f.id = ? AND f.user_id = ?
             """, 
             (farm_id, user_id)
@@ -2490,16 +4505,11 @@ async def upgrade_farm(farm_id: int, user_id: int) -> Tuple[bool, str]:
         # Calculate upgrade cost (increases with level)
         upgrade_cost = 100 * (current_level + 1)
         
-        # Check if user has enough stars
-        if farm['stars'] < upgrade_cost:
+        # Deduct stars (fails if the balance is short)
+        if not await _debit(db, user_id, stars=upgrade_cost):
+            await db.rollback()
             return False, f"❌ Недостаточно звезд! Нужно {upgrade_cost}⭐"
         
-        # Deduct stars
-        await db.execute(
-            "UPDATE users SET stars = stars - ? WHERE user_id = ?",
-            (upgrade_cost, user_id)
-        )
-        
         # Roll for upgrade
         roll = random.random()
         cumulative = 0
@@ -2542,6 +4552,7 @@ async def upgrade_farm(farm_id: int, user_id: int) -> Tuple[bool, str]:
             )
         
         await db.commit()
+        _invalidate_user(user_id)
         
         if new_boost > 1.0:
             return True, (
@@ -2582,7 +4593,7 @@ async def get_farm_income(
     
     # Apply upgrade boost if farm_id is provided
     if farm_id:
-        async with aiosqlite.connect(DB_NAME) as db:
+        async with get_db() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute(
                 "SELECT income_boost FROM farm_upgrades WHERE farm_id = ?", 
@@ -1,6 +1,7 @@
 import asyncio
 import logging
 import os
+import time
 from aiohttp import web
 from datetime import datetime
 from typing import Optional
@@ -14,18 +15,19 @@ from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKe
 from aiogram.filters import Command, CommandStart
 from config import BOT_TOKEN, FARM_TYPES, NFT_GIFTS, GAME_NAME, ADMIN_IDS, CRYSTAL_SHOP, CRYSTAL_CASES, CASE_ITEMS, CONTESTS, STAR_FARM_CASES, CASE_FARM_TYPES
 from database import (
-    init_db, get_or_create_user, get_user_stars, 
+    init_db, start_db_tasks, close_db, get_db, get_or_create_user, get_user_stars, 
     buy_farm, get_user_farms, buy_nft, get_user_nfts,
     calculate_total_boost, collect_farm_income,
     register_referral, give_referral_reward, get_referral_count,
     create_auction, get_active_auctions, place_bid, end_auction,
-    activate_farms, is_banned, ban_user, unban_user,
+    activate_farms, get_user_farm_holdings, get_user_upgradable_farms,
+    is_banned, ban_user, unban_user,
     admin_add_stars, admin_add_farm, admin_add_nft,
     get_all_users, get_all_chats, add_chat, spend_stars, add_stars,
     get_user_by_internal_id, get_user_info_by_internal_id,
     get_top_by_balance, get_top_by_income_per_minute, get_top_by_nft_count,
     get_user_items, add_item, transfer_item, transfer_stars,
-    get_user_prefix, set_user_prefix,
+    get_user_prefix, get_user_prefixes, set_user_prefix,
     create_item_auction, get_active_item_auctions, place_item_bid, end_item_auction
 )
 
@@ -42,11 +44,14 @@ from database import add_case_drop, get_case_drops
 from database import upgrade_farm
 
 from database import get_or_create_global_quest, add_global_quest_progress, get_active_global_buff
+from database import get_global_quest_top
 
 from database import get_or_create_saturday_offers, get_active_saturday_offers, buy_saturday_offer, get_special_farm_types
 
-from database import get_total_nft_count
-from database import get_top_by_season_score, get_season_archive
+from database import get_total_nft_count, get_nft_supply, grant_nft
+from database import get_user_nft_holdings, user_has_nft
+from database import get_top_by_season_score, get_season_archive, get_leaderboard_rank
+from database import remember_identity, get_identity, get_identities, find_user_id_by_username
 
 from database import increment_user_stat, get_user_stats, get_user_achievement_ids
 from database import create_nft_listing, get_active_nft_listings, buy_nft_listing
@@ -54,7 +59,7 @@ from database import create_nft_listing, get_active_nft_listings, buy_nft_listin
 from database import (
     get_user_crystals, transfer_crystals, collect_farm_income_with_crystals,
     spend_crystals, add_crystals,
-    create_farm_trade, get_farm_trade, set_farm_trade_status, transfer_farm_ownership
+    create_farm_trade, get_farm_trade, set_farm_trade_status, complete_farm_trade
 )
 from keyboards import (
     get_main_menu, get_farm_shop_keyboard, 
@@ -97,8 +102,13 @@ async def resolve_target_user(target: str):
 
     if target.startswith("@"):
         try:
-            chat = await bot.get_chat(target)
-            user = await get_or_create_user(chat.id)
+            user_id = await find_user_id_by_username(target)
+            if user_id is None:
+                chat = await fetch_chat(target)
+                if chat is None:
+                    return None
+                user_id = chat.id
+            user = await get_or_create_user(user_id)
             return {
                 'user_id': user['user_id'],
                 'internal_id': user.get('internal_id')
@@ -148,6 +158,57 @@ mines_games = {}
 pending_bets = {}
 pending_mines_bets = {}
 
+# Имена берём из identity-кэша; get_chat — только запасной путь, не чаще GET_CHAT_RATE в секунду
+GET_CHAT_RATE = 5
+_get_chat_calls = []
+
+
+def format_user_name(identity: Optional[dict], fallback: str) -> str:
+    if identity:
+        if identity.get('username'):
+            return f"@{identity['username']}"
+        if identity.get('full_name'):
+            return identity['full_name']
+    return fallback
+
+
+async def get_user_labels(user_ids, fallbacks: Optional[dict] = None) -> dict:
+    """{user_id: "[PREFIX] name"} for many users with two bulk lookups and no get_chat."""
+    ids = [u for u in dict.fromkeys(user_ids) if u]
+    prefixes = await get_user_prefixes(ids)
+    identities = await get_identities(ids)
+    labels = {}
+    for user_id in ids:
+        name = format_user_name(identities.get(user_id), (fallbacks or {}).get(user_id) or f"ID {user_id}")
+        pfx = prefixes.get(user_id)
+        labels[user_id] = f"{pfx} {name}" if pfx else name
+    return labels
+
+
+async def fetch_chat(chat_id):
+    """bot.get_chat within the rate limit; None if over the limit or on error."""
+    now = time.monotonic()
+    _get_chat_calls[:] = [t for t in _get_chat_calls if now - t < 1.0]
+    if len(_get_chat_calls) >= GET_CHAT_RATE:
+        return None
+    _get_chat_calls.append(now)
+    try:
+        chat = await bot.get_chat(chat_id)
+    except Exception:
+        return None
+    if getattr(chat, 'type', 'private') == 'private':
+        try:
+            await remember_identity(chat.id, getattr(chat, 'username', None), getattr(chat, 'full_name', None))
+        except Exception:
+            pass
+    return chat
+
+# /top рендерится фоном: ответ берётся из кэша, устаревший отдаётся, пока идёт пересчёт
+TOP_CACHE_TTL = 60  # секунд
+TOP_REFRESH_INTERVAL = 30  # секунд
+_top_cache = {"text": None, "built_at": 0.0}
+_top_refresh_task: Optional[asyncio.Task] = None
+
 async def ban_check_middleware(handler, event, data):
     if isinstance(event, (Message, CallbackQuery)):
         if hasattr(event, 'from_user') and event.from_user:
@@ -164,6 +225,17 @@ async def ban_check_middleware(handler, event, data):
                 logger.error(f"Ошибка проверки бана для user_id {user_id}: {db_error}")
     return await handler(event, data)
 
+async def identity_middleware(handler, event, data):
+    user = getattr(event, 'from_user', None)
+    if user and not user.is_bot:
+        try:
+            await remember_identity(user.id, user.username, user.full_name)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить имя пользователя {user.id}: {e}")
+    return await handler(event, data)
+
+dp.message.middleware(identity_middleware)
+dp.callback_query.middleware(identity_middleware)
 dp.message.middleware(ban_check_middleware)
 dp.callback_query.middleware(ban_check_middleware)
 
@@ -420,7 +492,7 @@ async def open_star_case(callback: CallbackQuery):
 
     farm_def = CASE_FARM_TYPES.get(farm_key, {})
     farm_name = farm_def.get('name', farm_key)
-    async with aiosqlite.connect("game_bot.db") as db:
+    async with get_db() as db:
         await db.execute(
             "INSERT INTO farms (user_id, farm_type, last_activated, is_active) VALUES (?, ?, ?, 0)",
             (user_id, farm_key, datetime.now().isoformat())
@@ -453,44 +525,82 @@ async def open_star_case(callback: CallbackQuery):
 async def referral_button(message: Message):
     await cmd_referral(message)
 
-@dp.message(Command("top"))
-async def cmd_top(message: Message):
+async def render_top_text() -> str:
     top = await get_top_by_season_score(limit=50)
     if not top:
-        await message.reply("🏆 Топ игроков пока пуст")
-        return
+        return ""
 
+    labels = await get_user_labels(
+        [row.get('user_id') for row in top],
+        fallbacks={row.get('user_id'): f"ID {row.get('internal_id', 'N/A')}" for row in top},
+    )
     lines = ["🏆 ТОП-50 недели (прирост ⭐)\n"]
     for idx, row in enumerate(top, start=1):
         user_id = row.get('user_id')
         score = int(row.get('season_score', 0) or 0)
         stars = row.get('stars', 0)
-        internal_id = row.get('internal_id', 'N/A')
-        name = f"ID {internal_id}"
-        try:
-            pfx = await get_user_prefix(user_id)
-        except Exception:
-            pfx = ""
-        if pfx:
-            name = f"{pfx} {name}"
+        name = labels.get(user_id, f"ID {user_id}")
 
-        try:
-            chat = await bot.get_chat(user_id)
-            if getattr(chat, 'username', None):
-                base = f"@{chat.username}"
-                name = f"{pfx} {base}" if pfx else base
-            else:
-                full_name = getattr(chat, 'full_name', None) or getattr(chat, 'first_name', None)
-                if full_name:
-                    name = f"{pfx} {full_name}" if pfx else full_name
-        except Exception:
-            pass
-
-        lines.append(f"{idx}. {name} — +{score} ⭐ (всего {stars})")
+        lines.append(f"{idx}. {name} — {score:+d} ⭐ (всего {stars})")
 
     text = "\n".join(lines)
     if len(text) > 3800:
         text = text[:3800] + "\n..."
+    return text
+
+
+async def _rebuild_top_cache() -> Optional[str]:
+    try:
+        text = await render_top_text()
+    except Exception as e:
+        # оставляем прежний текст (None, если его ещё не было), следующая попытка — по расписанию
+        logger.warning(f"Не удалось обновить /top: {e}")
+        return _top_cache["text"]
+    _top_cache["text"] = text
+    _top_cache["built_at"] = time.monotonic()
+    return text
+
+
+def refresh_top_cache() -> asyncio.Task:
+    """Starts a rebuild of the cached /top, or returns the one already running."""
+    global _top_refresh_task
+    if _top_refresh_task is None or _top_refresh_task.done():
+        _top_refresh_task = asyncio.create_task(_rebuild_top_cache())
+    return _top_refresh_task
+
+
+async def get_top_text() -> Optional[str]:
+    """Cached /top text; None if it has never been built successfully."""
+    text = _top_cache["text"]
+    if text is None:
+        return await asyncio.shield(refresh_top_cache())
+    if time.monotonic() - _top_cache["built_at"] > TOP_CACHE_TTL:
+        refresh_top_cache()
+    return text
+
+
+async def top_refresh_loop():
+    while True:
+        await refresh_top_cache()
+        await asyncio.sleep(TOP_REFRESH_INTERVAL)
+
+
+@dp.message(Command("top"))
+async def cmd_top(message: Message):
+    text = await get_top_text()
+    if text is None:
+        await message.reply("❌ Топ временно недоступен. Попробуйте позже.")
+        return
+    if not text:
+        await message.reply("🏆 Топ игроков пока пуст")
+        return
+
+    try:
+        me = await get_leaderboard_rank(message.from_user.id)
+    except Exception:
+        me = None
+    if me:
+        text += f"\n\n📍 Ваше место: {me['rank']} из {me['total']} ({int(me['score']):+d} ⭐)"
 
     if message.chat.type == "private":
         await message.answer(text)
@@ -514,20 +624,25 @@ async def cmd_top_archive(message: Message):
         await message.reply("📜 Архив топа пуст")
         return
 
+    rows_all = [r for block in data for r in block.get('rows', [])]
+    labels = await get_user_labels(
+        [r.get('user_id') for r in rows_all],
+        fallbacks={r.get('user_id'): f"ID {r.get('internal_id', 'N/A')}" for r in rows_all},
+    )
+
     text = "📜 Архив сезонов (последние 5)\n\n"
     for block in data:
-        s = block.get('season', {})
+        key = block.get('season') or '—'
         rows = block.get('rows', [])
-        key = s.get('season_key', '—')
         text += f"🏁 Сезон {key}\n"
         if not rows:
             text += "- нет данных\n\n"
             continue
         for r in rows:
-            rid = r.get('internal_id', 'N/A')
+            name = labels.get(r.get('user_id')) or f"ID {r.get('internal_id', 'N/A')}"
             score = int(r.get('season_score', 0) or 0)
             reward = int(r.get('reward_stars', 0) or 0)
-            text += f"{int(r.get('rank'))}. ID {rid} — +{score} ⭐ | награда {reward} ⭐\n"
+            text += f"{int(r.get('rank'))}. {name} — {score:+d} ⭐ | награда {reward} ⭐\n"
         text += "\n"
 
     if len(text) > 3800:
@@ -732,13 +847,18 @@ async def cmd_nftmarket(message: Message):
         await message.reply("🛍 NFT Маркет\n\nПока пусто.\nПродать: /nftsell <nft_key> <price>")
         return
 
+    sellers = await get_user_labels(
+        [l.get('seller_id') for l in listings],
+        fallbacks={l.get('seller_id'): f"ID {l.get('seller_internal_id', 'N/A')}" for l in listings},
+    )
+
     text = "🛍 NFT Маркет\n\n"
     for l in listings:
         lid = l.get('id')
         nft_type = l.get('nft_type')
         price = l.get('price')
         name = NFT_GIFTS.get(nft_type, {}).get('name', str(nft_type))
-        text += f"🆔 {lid} — {name} — {price} ⭐\n"
+        text += f"🆔 {lid} — {name} — {price} ⭐ | {sellers.get(l.get('seller_id'), '—')}\n"
 
     text += "\nКупить: /nftbuy <id>\nПродать: /nftsell <nft_key> <price>"
     if message.chat.type == "private":
@@ -899,37 +1019,28 @@ async def cmd_profile_id(message: Message):
         
         user_id = user['user_id']
         stars = user['stars']
-        farms = await get_user_farms(user_id)
-        special_defs = await get_special_farm_types()
-        nfts = await get_user_nfts(user_id)
+        holdings = await get_user_farm_holdings(user_id)
+        nft_holdings = await get_user_nft_holdings(user_id)
         boost = await calculate_total_boost(user_id)
         referrals = await get_referral_count(user_id)
         
-        from datetime import datetime
-        active_farms = 0
-        for farm in farms:
-            is_active = farm.get('is_active', 0)
-            if is_active:
-                last_activated = farm.get('last_activated')
-                if last_activated:
-                    last_activated_dt = datetime.fromisoformat(last_activated)
-                    hours_passed = (datetime.now() - last_activated_dt).total_seconds() / 3600
-                    if hours_passed < 6:
-                        active_farms += 1
+        total_farms = sum(h['total'] for h in holdings.values())
+        active_farms = sum(h['active'] for h in holdings.values())
         
-        try:
-            tg_user = await bot.get_chat(user_id)
-            username = f"@{tg_user.username}" if tg_user.username else tg_user.full_name or "Неизвестно"
-        except:
-            username = "Неизвестно"
+        identity = await get_identity(user_id)
+        if identity is None:
+            chat = await fetch_chat(user_id)
+            if chat is not None:
+                identity = {'username': chat.username, 'full_name': chat.full_name}
+        username = format_user_name(identity, "Неизвестно")
         
         profile_text = (
             f"👤 Профиль пользователя\n\n"
             f"🆔 ID: {internal_id}\n"
             f"📱 Telegram: {username} ({user_id})\n"
             f"⭐ Звезд: {stars}\n"
-            f"🌾 Ферм: {len(farms)} (активных: {active_farms})\n"
-            f"🎁 NFT: {len(nfts)}\n"
+            f"🌾 Ферм: {total_farms} (активных: {active_farms})\n"
+            f"🎁 NFT: {sum(nft_holdings.values())}\n"
             f"⚡ Буст к доходу: {int((boost - 1) * 100)}%\n"
             f"🔗 Рефералов: {referrals}\n"
         )
@@ -948,22 +1059,13 @@ async def show_profile_handler(message: Message):
     xp_needed = xp_needed_for_next_level(level)
     level_bonus_pct = round((get_level_bonus_multiplier(level) - 1) * 100, 2)
     
-    farms = await get_user_farms(user_id)
-    nfts = await get_user_nfts(user_id)
+    holdings = await get_user_farm_holdings(user_id)
+    nft_holdings = await get_user_nft_holdings(user_id)
     boost = await calculate_total_boost(user_id)
     referrals = await get_referral_count(user_id)
     
-    from datetime import datetime
-    active_farms = 0
-    for farm in farms:
-        is_active = farm.get('is_active', 0)
-        if is_active:
-            last_activated = farm.get('last_activated')
-            if last_activated:
-                last_activated_dt = datetime.fromisoformat(last_activated)
-                hours_passed = (datetime.now() - last_activated_dt).total_seconds() / 3600
-                if hours_passed < 6:
-                    active_farms += 1
+    total_farms = sum(h['total'] for h in holdings.values())
+    active_farms = sum(h['active'] for h in holdings.values())
     
     internal_id = user.get('internal_id', 'N/A')
     prefix = await get_user_prefix(user_id)
@@ -976,34 +1078,17 @@ async def show_profile_handler(message: Message):
         f"Уровень: {level} | XP: {xp}/{xp_needed}\n"
         f"Бонус уровня: +{level_bonus_pct}% к доходу\n\n"
         f"Баланс: {stars} ⭐ | {crystals} 💎\n"
-        f"Фермы: {len(farms)} (активных {active_farms})\n"
-        f"NFT: {len(nfts)} | Буст: {int((boost - 1) * 100)}%\n"
+        f"Фермы: {total_farms} (активных {active_farms})\n"
+        f"NFT: {sum(nft_holdings.values())} | Буст: {int((boost - 1) * 100)}%\n"
         f"Рефералы: {referrals}\n\n"
     )
     
-    if farms:
+    if holdings:
         profile_text += "Ваши фермы:\n"
-        from datetime import datetime
-        farm_counts = {}
-        for farm in farms:
-            farm_type = farm['farm_type']
-            if farm_type not in farm_counts:
-                farm_counts[farm_type] = {'total': 0, 'active': 0}
-            farm_counts[farm_type]['total'] += 1
-
-            is_active = farm.get('is_active', 0)
-            if is_active:
-                last_activated = farm.get('last_activated')
-                if last_activated:
-                    last_activated_dt = datetime.fromisoformat(last_activated)
-                    hours_passed = (datetime.now() - last_activated_dt).total_seconds() / 3600
-                    if hours_passed < 6:
-                        farm_counts[farm_type]['active'] += 1
-
         total_active_base_per_hour = 0
         total_all_base_per_hour = 0
 
-        for farm_type, data in farm_counts.items():
+        for farm_type, data in holdings.items():
             farm_defs = {}
             farm_defs.update(FARM_TYPES)
             farm_defs.update(CASE_FARM_TYPES)
@@ -1042,14 +1127,9 @@ async def show_profile_handler(message: Message):
             f"⚡ Итого (все фермы) с бустом: {round(total_all_boosted_per_hour / 60, 2)} ⭐/мин | {total_all_boosted_per_hour} ⭐/час\n"
         )
     
-    if nfts:
+    if nft_holdings:
         profile_text += "\nВаши NFT:\n"
-        nft_counts = {}
-        for nft in nfts:
-            nft_type = nft['nft_type']
-            nft_counts[nft_type] = nft_counts.get(nft_type, 0) + 1
-        
-        for nft_type, count in nft_counts.items():
+        for nft_type, count in nft_holdings.items():
             if nft_type in NFT_GIFTS:
                 profile_text += f"  {NFT_GIFTS[nft_type]['name']}: {count} шт.\n"
     
@@ -1068,9 +1148,9 @@ async def show_farms(message: Message):
 
 async def show_farms_handler(message: Message):
     user_id = message.from_user.id
-    farms = await get_user_farms(user_id)
+    holdings = await get_user_farm_holdings(user_id)
     
-    if not farms:
+    if not holdings:
         response = "🌾 Фермы\n\nПока пусто. Открой магазин: /shop"
         if message.chat.type == "private":
             await message.answer(response)
@@ -1078,31 +1158,8 @@ async def show_farms_handler(message: Message):
             await message.reply(response)
         return
     
-    from datetime import datetime
-    farm_counts = {}
-    active_count = 0
-    inactive_count = 0
-    
-    for farm in farms:
-        farm_type = farm['farm_type']
-        farm_counts[farm_type] = farm_counts.get(farm_type, {'total': 0, 'active': 0})
-        farm_counts[farm_type]['total'] += 1
-        
-        is_active = farm.get('is_active', 0)
-        if is_active:
-            last_activated = farm.get('last_activated')
-            if last_activated:
-                last_activated_dt = datetime.fromisoformat(last_activated)
-                hours_passed = (datetime.now() - last_activated_dt).total_seconds() / 3600
-                if hours_passed < 6:
-                    farm_counts[farm_type]['active'] += 1
-                    active_count += 1
-                else:
-                    inactive_count += 1
-            else:
-                inactive_count += 1
-        else:
-            inactive_count += 1
+    active_count = sum(h['active'] for h in holdings.values())
+    inactive_count = sum(h['total'] for h in holdings.values()) - active_count
     
     farms_text = "🌾 Фермы\n\n"
     boost = await calculate_total_boost(user_id)
@@ -1117,7 +1174,7 @@ async def show_farms_handler(message: Message):
     except Exception:
         pass
 
-    for farm_type, data in farm_counts.items():
+    for farm_type, data in holdings.items():
         if farm_type in farm_defs:
             farm_data = farm_defs[farm_type]
             total = data['total']
@@ -1151,7 +1208,7 @@ async def show_farms_handler(message: Message):
     if inactive_count > 0:
         farms_text += f"\n⚠️ {inactive_count} ферм требуют активации! Используйте /activate"
 
-    upgrade_farms = [f for f in farms if not str(f.get('farm_type', '')).startswith('case_')]
+    upgrade_farms = await get_user_upgradable_farms(user_id, limit=10)
     if upgrade_farms:
         farms_text += "\n\n🔧 Улучшения ферм\n"
         farms_text += "💎 — улучшить доход (шанс 1.2x-2.0x)\n"
@@ -1169,7 +1226,7 @@ async def show_farms_handler(message: Message):
             # Get current boost level if any
             boost = 1.0
             if farm_id:
-                async with aiosqlite.connect(DB_NAME) as db:
+                async with get_db() as db:
                     db.row_factory = aiosqlite.Row
                     cursor = await db.execute(
                         "SELECT income_boost, upgrade_level FROM farm_upgrades WHERE farm_id = ?",
@@ -1198,7 +1255,7 @@ async def show_farms_handler(message: Message):
                 
             # Get current upgrade level for cost calculation
             current_level = 0
-            async with aiosqlite.connect(DB_NAME) as db:
+            async with get_db() as db:
                 db.row_factory = aiosqlite.Row
                 cursor = await db.execute(
                     "SELECT upgrade_level FROM farm_upgrades WHERE farm_id = ?",
@@ -1372,8 +1429,8 @@ async def view_farm_card(callback: CallbackQuery):
     income_per_min = round(income_per_hour / 60, 2)
     owned = 0
     try:
-        farms = await get_user_farms(user_id)
-        owned = sum(1 for f in farms if f.get('farm_type') == farm_id)
+        holdings = await get_user_farm_holdings(user_id)
+        owned = holdings.get(farm_id, {}).get('total', 0)
     except Exception:
         owned = 0
 
@@ -1491,6 +1548,7 @@ async def show_nft_shop_handler(message: Message):
 
 async def build_nft_shop_keyboard() -> InlineKeyboardMarkup:
     keyboard = InlineKeyboardMarkup(inline_keyboard=[])
+    supply = await get_nft_supply()
     for nft_id, nft in NFT_GIFTS.items():
         boost = int((float(nft.get("boost", 1.0)) - 1) * 100)
         price = int(nft.get('price', 0) or 0)
@@ -1505,7 +1563,7 @@ async def build_nft_shop_keyboard() -> InlineKeyboardMarkup:
             except Exception:
                 limit_int = 0
             if limit_int > 0:
-                minted = await get_total_nft_count(nft_id)
+                minted = supply.get(nft_id, {}).get('minted', 0)
                 left = max(0, limit_int - minted)
                 label = f"{nft['name']} - {price}⭐ (+{boost}%) | {left}/{limit_int}"
                 if left <= 0:
@@ -1532,13 +1590,13 @@ async def view_nft_card(callback: CallbackQuery):
 
     owned = 0
     try:
-        nfts = await get_user_nfts(user_id)
-        owned = sum(1 for x in nfts if x.get('nft_type') == nft_id)
+        owned = (await get_user_nft_holdings(user_id)).get(nft_id, 0)
     except Exception:
         owned = 0
 
     limit = nft.get('limit')
     left_txt = ""
+    sold_out = False
     if limit is not None:
         try:
             limit_int = int(limit)
@@ -1548,6 +1606,7 @@ async def view_nft_card(callback: CallbackQuery):
             minted = await get_total_nft_count(nft_id)
             left = max(0, limit_int - minted)
             left_txt = f"\nОсталось: {left}/{limit_int}"
+            sold_out = left <= 0
 
     text = (
         f"🎁 {nft.get('name')}\n\n"
@@ -1557,16 +1616,7 @@ async def view_nft_card(callback: CallbackQuery):
         f"{left_txt}"
     )
 
-    buy_cb = f"buy_nft_{nft_id}"
-    if limit is not None:
-        try:
-            limit_int = int(limit)
-        except Exception:
-            limit_int = 0
-        if limit_int > 0:
-            minted = await get_total_nft_count(nft_id)
-            if minted >= limit_int:
-                buy_cb = "nft_sold_out"
+    buy_cb = "nft_sold_out" if sold_out else f"buy_nft_{nft_id}"
 
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=f"Купить за {price} ⭐", callback_data=buy_cb)],
@@ -1698,6 +1748,13 @@ async def cmd_quests(message: Message):
         mult = float(buff.get('multiplier', 1.0) or 1.0)
         text += f"\n🔥 Активный баф: x{mult}{buff_left}"
 
+    top = await get_global_quest_top(q['id'], limit=5)
+    if top:
+        labels = await get_user_labels([row['user_id'] for row in top])
+        text += "\n\n🏅 Больше всех вложили:\n"
+        for i, row in enumerate(top, 1):
+            text += f"{i}. {labels.get(row['user_id'], row['user_id'])} — {row['amount']} ⭐\n"
+
     if message.chat.type == "private":
         await message.answer(text)
     else:
@@ -1929,13 +1986,14 @@ async def open_case(callback: CallbackQuery):
     elif rtype == 'nft':
         nft_key = pick_random_nft_key()
         if nft_key:
-            already = await get_user_nfts(user_id)
-            if any(item.get('nft_type') == nft_key for item in already):
+            if await user_has_nft(user_id, nft_key):
                 await add_stars(user_id, 500)
                 reward_text = f"🎁 NFT-дубликат → ⭐ 500 звезд"
-            else:
-                await admin_add_nft(user_id, nft_key)
+            elif await grant_nft(user_id, nft_key):
                 reward_text = f"🎁 NFT: {NFT_GIFTS[nft_key]['name']}"
+            else:
+                await add_stars(user_id, 500)
+                reward_text = f"🎁 NFT распродан → ⭐ 500 звезд"
         else:
             await add_stars(user_id, 200)
             reward_text = "⭐ 200 звезд"
@@ -2032,23 +2090,11 @@ async def accept_farm_trade(callback: CallbackQuery):
 
     price = int(trade.get('price'))
     seller_id = int(trade.get('seller_id'))
-    farm_id = int(trade.get('farm_id'))
 
-    ok = await spend_stars(buyer_id, price)
+    ok, msg = await complete_farm_trade(trade_id, buyer_id)
+    await callback.answer(msg, show_alert=True)
     if not ok:
-        await callback.answer("❌ Недостаточно звезд", show_alert=True)
-        return
-
-    await add_stars(seller_id, price)
-    transferred = await transfer_farm_ownership(farm_id, seller_id, buyer_id)
-    if not transferred:
-        await add_stars(buyer_id, price)
-        await spend_stars(seller_id, price)
-        await callback.answer("❌ Ферма уже недоступна", show_alert=True)
         return
-
-    await set_farm_trade_status(trade_id, 'completed')
-    await callback.answer("✅ Трейд завершен", show_alert=True)
     try:
         await bot.send_message(seller_id, f"✅ Вашу ферму купили! Trade {trade_id} (+{price} ⭐)")
     except Exception:
@@ -2113,6 +2159,19 @@ async def cmd_auction(message: Message):
             await message.reply("🔨 Аукцион\n\nСейчас нет активных аукционов.")
         return
 
+    lots = list(auctions or []) + list(item_auctions or []) + user_farm_auctions + user_nft_auctions
+    labels = await get_user_labels(
+        [a.get('seller_id') for a in lots] + [a.get('current_bidder_id') for a in lots]
+    )
+
+    def people_lines(a) -> str:
+        lines = ""
+        if a.get('seller_id'):
+            lines += f"👤 Продавец: {labels.get(a['seller_id'])}\n"
+        if a.get('current_bidder_id'):
+            lines += f"🏆 Лидер: {labels.get(a['current_bidder_id'])}\n"
+        return lines
+
     text = "🔨 Аукцион\n\nАктивные лоты:\n\n"
     now = datetime.now()
     if auctions:
@@ -2141,6 +2200,7 @@ async def cmd_auction(message: Message):
             f"🆔 ID: {auction.get('id')}\n"
             f"🌾 Лот: {farm_name}\n"
             f"💰 Текущая ставка: {auction.get('current_bid')} ⭐\n"
+            f"{people_lines(auction)}"
             f"{time_left_text}"
             "\n"
         )
@@ -2165,6 +2225,7 @@ async def cmd_auction(message: Message):
                 f"🆔 ID: {a.get('id')}\n"
                 f"🎁 Лот: {item_display_name(a.get('item_key'))} x{a.get('qty')}\n"
                 f"💰 Текущая ставка: {a.get('current_bid')} ⭐\n"
+                f"{people_lines(a)}"
                 f"{time_left_text}"
                 "\n"
             )
@@ -2194,6 +2255,7 @@ async def cmd_auction(message: Message):
                 f"🆔 ID: {a.get('id')}\n"
                 f"🌾 Лот: {farm_name}\n"
                 f"💰 Текущая ставка: {a.get('current_bid')} ⭐\n"
+                f"{people_lines(a)}"
                 f"{time_left_text}"
                 "\n"
             )
@@ -2220,6 +2282,7 @@ async def cmd_auction(message: Message):
                 f"🆔 ID: {a.get('id')}\n"
                 f"🎁 Лот: {nft_name}\n"
                 f"💰 Текущая ставка: {a.get('current_bid')} ⭐\n"
+                f"{people_lines(a)}"
                 f"{time_left_text}"
                 "\n"
             )
@@ -2363,9 +2426,9 @@ async def cmd_end_unft(message: Message):
 
 async def collect_income_handler(message: Message):
     user_id = message.from_user.id
-    farms = await get_user_farms(user_id)
+    holdings = await get_user_farm_holdings(user_id)
     
-    if not farms:
+    if not holdings:
         response = "У вас нет ферм для сбора дохода! Купите фермы в магазине. 🛒"
         if message.chat.type == "private":
             await message.answer(response)
@@ -2378,21 +2441,12 @@ async def collect_income_handler(message: Message):
     crystals = await get_user_crystals(user_id)
     boost = await calculate_total_boost(user_id)
     
-    from datetime import datetime
     total_income_per_hour = 0
     active_farms_count = 0
-    for farm in farms:
-        is_active = farm.get('is_active', 0)
-        if is_active:
-            last_activated = farm.get('last_activated')
-            if last_activated:
-                last_activated_dt = datetime.fromisoformat(last_activated)
-                hours_passed = (datetime.now() - last_activated_dt).total_seconds() / 3600
-                if hours_passed < 6:
-                    farm_type = farm['farm_type']
-                    if farm_type in FARM_TYPES:
-                        total_income_per_hour += FARM_TYPES[farm_type]['income_per_hour']
-                        active_farms_count += 1
+    for farm_type, data in holdings.items():
+        if farm_type in FARM_TYPES and data['active']:
+            total_income_per_hour += FARM_TYPES[farm_type]['income_per_hour'] * data['active']
+            active_farms_count += data['active']
     
     total_income_per_hour_boosted = int(total_income_per_hour * boost)
     total_income_per_min_boosted = round(total_income_per_hour_boosted / 60, 2)
@@ -2400,7 +2454,7 @@ async def collect_income_handler(message: Message):
     
     if income > 0:
         try:
-            await add_global_quest_progress(income)
+            await add_global_quest_progress(income, user_id)
         except Exception:
             pass
 
@@ -2515,37 +2569,17 @@ async def handle_buy_nft(callback: CallbackQuery):
             await callback.answer("❌ Такого NFT не существует!", show_alert=True)
             return
 
-        limit = NFT_GIFTS[nft_id].get('limit')
-        if limit is not None:
-            try:
-                limit_int = int(limit)
-            except Exception:
-                limit_int = 0
-            if limit_int > 0:
-                minted = await get_total_nft_count(nft_id)
-                if minted >= limit_int:
-                    await callback.answer("❌ Этот NFT закончился", show_alert=True)
-                    return
-
-        user_stars = await get_user_stars(user_id)
-        nft_price = int(NFT_GIFTS[nft_id].get("price", 0) or 0)
-
-        if user_stars < nft_price:
-            await callback.answer("❌ Недостаточно звезд!", show_alert=True)
-            return
-
-        already = await get_user_nfts(user_id)
-        if any(item.get('nft_type') == nft_id for item in already):
+        if await user_has_nft(user_id, nft_id):
             await callback.answer("❌ У вас уже есть этот NFT!", show_alert=True)
             return
 
-        success = await buy_nft(user_id, nft_id)
+        # лимит и баланс проверяются условными UPDATE внутри buy_nft
+        success, msg = await buy_nft(user_id, nft_id)
+        await callback.answer(msg, show_alert=True)
         if not success:
-            await callback.answer("❌ Ошибка при покупке NFT. Попробуйте позже.", show_alert=True)
             return
 
         stars_now = await get_user_stars(user_id)
-        await callback.answer(f"✅ Вы купили {NFT_GIFTS[nft_id]['name']}!", show_alert=True)
         await callback.message.edit_text(
             f"✅ Куплено: {NFT_GIFTS[nft_id]['name']}\n\n⭐ Осталось звезд: {stars_now}",
             reply_markup=await build_nft_shop_keyboard()
@@ -2594,7 +2628,9 @@ async def handle_mines_bet(message: Message):
 
         if pending_game == "slots":
             pending_bets.pop(user_id, None)
-            await spend_stars(user_id, bet_amount)
+            if not await spend_stars(user_id, bet_amount):
+                await message.reply("❌ Недостаточно звезд!", reply_markup=get_casino_menu())
+                return
 
             slots_msg = await bot.send_dice(chat_id=message.chat.id, emoji="🎰")
             value = slots_msg.dice.value
@@ -2643,17 +2679,13 @@ async def dice_play(callback: CallbackQuery):
 
     choice = parts[2]
     bet_amount = int(parts[3])
-    stars = await get_user_stars(user_id)
-
-    if bet_amount > stars:
-        await callback.answer("❌ Недостаточно звезд!", show_alert=True)
-        return
-
     if bet_amount < 10:
         await callback.answer("❌ Минимальная ставка: 10 ⭐", show_alert=True)
         return
 
-    await spend_stars(user_id, bet_amount)
+    if not await spend_stars(user_id, bet_amount):
+        await callback.answer("❌ Недостаточно звезд!", show_alert=True)
+        return
     dice_msg = await bot.send_dice(chat_id=callback.message.chat.id, emoji="🎲")
     value = dice_msg.dice.value
 
@@ -2672,17 +2704,13 @@ async def dice_play(callback: CallbackQuery):
 async def slots_start(callback: CallbackQuery):
     user_id = callback.from_user.id
     bet_amount = int(callback.data.split("_")[2])
-    stars = await get_user_stars(user_id)
-
-    if bet_amount > stars:
-        await callback.answer("❌ Недостаточно звезд!", show_alert=True)
-        return
-
     if bet_amount < 10:
         await callback.answer("❌ Минимальная ставка: 10 ⭐", show_alert=True)
         return
 
-    await spend_stars(user_id, bet_amount)
+    if not await spend_stars(user_id, bet_amount):
+        await callback.answer("❌ Недостаточно звезд!", show_alert=True)
+        return
     slots_msg = await bot.send_dice(chat_id=callback.message.chat.id, emoji="🎰")
     value = slots_msg.dice.value
 
@@ -2740,16 +2768,13 @@ async def mines_select_difficulty(callback: CallbackQuery):
     if pending_mines_bets.get(user_id) != bet_amount:
         pending_mines_bets[user_id] = bet_amount
 
-    stars = await get_user_stars(user_id)
-    if bet_amount > stars:
-        await callback.answer("❌ Недостаточно звезд!", show_alert=True)
-        return
-
     if mines_count not in (3, 5, 7, 10):
         await callback.answer("❌ Неверная сложность", show_alert=True)
         return
 
-    await spend_stars(user_id, bet_amount)
+    if not await spend_stars(user_id, bet_amount):
+        await callback.answer("❌ Недостаточно звезд!", show_alert=True)
+        return
     pending_mines_bets.pop(user_id, None)
 
     import random
@@ -2909,18 +2934,15 @@ async def cmd_roulette(message: Message):
     
     try:
         bet = int(args[1])
-        stars = await get_user_stars(user_id)
         
         if bet < 10:
             await message.reply("❌ Минимальная ставка: 10 ⭐")
             return
         
-        if bet > stars:
+        if not await spend_stars(user_id, bet):
             await message.reply("❌ Недостаточно звезд!")
             return
         
-        await spend_stars(user_id, bet)
-        
         import random
         colors = ["🔴", "⚫", "🟢"]
         player_color = random.choice(colors)
@@ -2978,15 +3000,23 @@ async def main():
     import os
     
     await init_db()
+    start_db_tasks()
     logger.info("База данных инициализирована")
     
     http_runner = await start_http_server()
+    top_task = asyncio.create_task(top_refresh_loop())
     
     try:
         logger.info("Бот запущен")
         await dp.start_polling(bot)
     finally:
+        top_task.cancel()
+        try:
+            await top_task
+        except asyncio.CancelledError:
+            pass
         await http_runner.cleanup()
+        await close_db()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,137 @@
+from bisect import bisect_left, insort
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+class RankIndex:
+    """Leaderboard kept sorted in memory: score DESC, then user_id ASC.
+
+    Entries live in buckets of a few hundred sorted keys; a Fenwick tree over
+    bucket sizes turns "position of a key" and "key at a position" into
+    O(log n) lookups, so a rank or a page never scans the whole board.
+    """
+
+    BUCKET_SIZE = 512
+
+    def __init__(self) -> None:
+        self._scores: Dict[int, int] = {}
+        self._buckets: List[List[Tuple[int, int]]] = []
+        self._maxes: List[Tuple[int, int]] = []
+        self._tree: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._scores
+
+    def build(self, items: Iterable[Tuple[int, int]]) -> None:
+        """Replaces the contents with (user_id, score) pairs."""
+        self._scores = {int(user_id): int(score) for user_id, score in items}
+        keys = sorted((-score, user_id) for user_id, score in self._scores.items())
+        size = self.BUCKET_SIZE
+        self._buckets = [keys[i:i + size] for i in range(0, len(keys), size)]
+        self._rebuild_tree()
+
+    def update(self, user_id: int, score: int) -> None:
+        user_id, score = int(user_id), int(score)
+        old = self._scores.get(user_id)
+        if old == score:
+            return
+        if old is not None:
+            self._discard((-old, user_id))
+        self._scores[user_id] = score
+        self._insert((-score, user_id))
+
+    def remove(self, user_id: int) -> None:
+        old = self._scores.pop(int(user_id), None)
+        if old is not None:
+            self._discard((-old, int(user_id)))
+
+    def get_score(self, user_id: int) -> Optional[int]:
+        return self._scores.get(int(user_id))
+
+    def get_rank(self, user_id: int) -> Optional[int]:
+        """1-based place of the user, or None if not on the board."""
+        score = self._scores.get(int(user_id))
+        if score is None:
+            return None
+        key = (-score, int(user_id))
+        i = bisect_left(self._maxes, key)
+        return self._prefix(i) + bisect_left(self._buckets[i], key) + 1
+
+    def get_page(self, offset: int, limit: int) -> List[Tuple[int, int]]:
+        """(user_id, score) pairs at places offset+1 .. offset+limit."""
+        offset, limit = max(int(offset), 0), int(limit)
+        if limit <= 0 or offset >= len(self._scores):
+            return []
+        i, pos = self._locate(offset)
+        page: List[Tuple[int, int]] = []
+        while i < len(self._buckets) and len(page) < limit:
+            for neg_score, user_id in self._buckets[i][pos:pos + limit - len(page)]:
+                page.append((user_id, -neg_score))
+            i, pos = i + 1, 0
+        return page
+
+    def _insert(self, key: Tuple[int, int]) -> None:
+        if not self._buckets:
+            self._buckets.append([key])
+            self._rebuild_tree()
+            return
+        i = min(bisect_left(self._maxes, key), len(self._buckets) - 1)
+        bucket = self._buckets[i]
+        insort(bucket, key)
+        if len(bucket) > 2 * self.BUCKET_SIZE:
+            half = len(bucket) // 2
+            self._buckets[i:i + 1] = [bucket[:half], bucket[half:]]
+            self._rebuild_tree()
+            return
+        self._maxes[i] = bucket[-1]
+        self._add(i, 1)
+
+    def _discard(self, key: Tuple[int, int]) -> None:
+        i = bisect_left(self._maxes, key)
+        bucket = self._buckets[i]
+        del bucket[bisect_left(bucket, key)]
+        if not bucket:
+            del self._buckets[i]
+            self._rebuild_tree()
+            return
+        self._maxes[i] = bucket[-1]
+        self._add(i, -1)
+
+    # Fenwick tree по размерам корзин (индексы с 1)
+    def _rebuild_tree(self) -> None:
+        self._maxes = [bucket[-1] for bucket in self._buckets]
+        tree = [0] * (len(self._buckets) + 1)
+        for i, bucket in enumerate(self._buckets, start=1):
+            tree[i] += len(bucket)
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _add(self, i: int, delta: int) -> None:
+        i += 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, i: int) -> int:
+        """Number of keys in buckets [0, i)."""
+        total = 0
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def _locate(self, offset: int) -> Tuple[int, int]:
+        """(bucket, position in bucket) of the key at 0-based offset."""
+        i = 0
+        step = 1 << (len(self._tree).bit_length() - 1)
+        while step:
+            j = i + step
+            if j < len(self._tree) and self._tree[j] <= offset:
+                i = j
+                offset -= self._tree[j]
+            step >>= 1
+        return i, offset
@@ -0,0 +1,84 @@
+"""EXPLAIN QUERY PLAN checks for the hot per-screen queries (migration 2 indexes).
+
+The SQL mirrors the statements in database.py; keep them in sync.
+"""
+import asyncio
+
+import pytest
+
+import database
+
+HOT_QUERIES = {
+    "get_user_farms": ("SELECT * FROM farms WHERE user_id = ?", (1,)),
+    "get_user_nfts": ("SELECT * FROM nfts WHERE user_id = ?", (1,)),
+    "get_case_drops": (
+        "SELECT case_type, reward_text, created_at FROM case_drops WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+        (1, 20),
+    ),
+    "get_referral_count": ("SELECT COUNT(*) as count FROM referrals WHERE referrer_id = ?", (1,)),
+    "get_active_nft_listings": (
+        """
+        SELECT l.*, u.internal_id as seller_internal_id
+        FROM nft_listings l
+        JOIN users u ON l.seller_id = u.user_id
+        WHERE l.status = 'active'
+        ORDER BY l.price ASC, l.created_at ASC
+        LIMIT ? OFFSET ?
+        """,
+        (25, 0),
+    ),
+    "get_active_auctions": (
+        "SELECT * FROM auctions WHERE status = 'active' AND end_time > datetime('now') ORDER BY end_time ASC",
+        (),
+    ),
+    "get_active_user_auctions (farms)": (
+        "SELECT * FROM user_farm_auctions WHERE status = 'active' AND end_time > datetime('now') ORDER BY end_time ASC",
+        (),
+    ),
+    "get_active_user_auctions (nfts)": (
+        "SELECT * FROM user_nft_auctions WHERE status = 'active' AND end_time > datetime('now') ORDER BY end_time ASC",
+        (),
+    ),
+    "get_active_item_auctions": (
+        "SELECT * FROM item_auctions WHERE status = 'active' AND end_time > datetime('now') ORDER BY end_time ASC",
+        (),
+    ),
+}
+
+
+@pytest.fixture(scope="module")
+def query_plans(tmp_path_factory):
+    """{name: [plan detail, ...]} from a fresh database built by init_db."""
+    db_name = database.DB_NAME
+    database.DB_NAME = str(tmp_path_factory.mktemp("db") / "bot.db")
+
+    async def explain():
+        await database.init_db()
+        try:
+            plans = {}
+            async with database.get_db() as db:
+                for name, (sql, params) in HOT_QUERIES.items():
+                    cursor = await db.execute("EXPLAIN QUERY PLAN " + sql, params)
+                    plans[name] = [row[3] for row in await cursor.fetchall()]
+            return plans
+        finally:
+            await database.close_db()
+
+    try:
+        yield asyncio.run(explain())
+    finally:
+        database.DB_NAME = db_name
+
+
+@pytest.mark.parametrize("name", list(HOT_QUERIES))
+def test_hot_query_uses_index(query_plans, name):
+    plan = query_plans[name]
+    lookups = [step for step in plan if step.startswith(("SEARCH", "SCAN"))]
+    assert lookups, plan
+    for step in lookups:
+        assert not step.startswith("SCAN"), plan
+        assert (
+            "USING INDEX" in step
+            or "USING COVERING INDEX" in step
+            or "USING INTEGER PRIMARY KEY" in step
+        ), plan